@@ -40,6 +40,56 @@ class Parser:
                                help='send email to multiple '
                                     'recipients at once',
                                action='store_true')
+        self.file.add_argument('--metrics',
+                               help='file for SMTP metrics written during '
+                                    'a batch run (.prom or .txt for '
+                                    'Prometheus text, JSON otherwise)')
+        self.file.add_argument('--metrics-interval',
+                               help='seconds between metrics dumps',
+                               type=float, default=10)
+        self.file.add_argument('--rcpt-limit',
+                               help='recipients per message with '
+                                    '--batch-bcc (lowered when the server '
+                                    'answers 452)',
+                               type=int, default=15)
+        self.file.add_argument('--session-limit',
+                               help='messages sent over one connection '
+                                    'before reconnecting (0 - no limit)',
+                               type=int, default=100)
+        self.file.add_argument('-w', '--workers',
+                               help='number of parallel deliveries',
+                               type=int, default=1)
+        self.file.add_argument('--processes',
+                               help='split the batch file between '
+                                    'this many processes',
+                               type=int, default=1)
+        self.file.add_argument('--host-connections',
+                               help='max simultaneous connections '
+                                    'to the server', type=int, default=4)
+        self.file.add_argument('--rate',
+                               help='max messages per second (0 - no limit)',
+                               type=float, default=0)
+        self.file.add_argument('--recipient-rate',
+                               help='max recipients per second '
+                                    '(0 - no limit)', type=float, default=0)
+        self.file.add_argument('--throttle-config',
+                               help='JSON file with per-server rate '
+                                    'settings', default=None)
+        self.file.add_argument('--retry-delay',
+                               help='seconds before the first retry after '
+                                    'a temporary failure', type=float,
+                               default=60)
+        self.file.add_argument('--retry-max-age',
+                               help='seconds after which a temporarily '
+                                    'failing recipient is bounced',
+                               type=float, default=86400)
+        self.file.add_argument('--cache-size',
+                               help='memory for encoded attachments '
+                                    'in MB', type=int, default=64)
+        self.file.add_argument('--cache-dir',
+                               help='directory for encoded attachments '
+                                    'that do not fit into memory',
+                               default=None)
 
         self.data = self.parser.add_argument_group(
             'Email',
@@ -70,16 +120,27 @@ class Parser:
                                 action='store_true')
         self.other.add_argument('--no-ssl', help='disable secure connection',
                                 action='store_true')
+        self.other.add_argument('--ssl',
+                                help='use implicit TLS (SMTPS), '
+                                     'default for port 465',
+                                action='store_true')
+        self.other.add_argument('--insecure',
+                                help='do not verify server certificate',
+                                action='store_true')
         self.other.add_argument('-v', '--verbose',
                                 help='provide all program logs to console',
                                 action='store_true')
+        self.other.add_argument('--log-sample',
+                                help='fraction of info records logged in '
+                                     'verbose mode',
+                                type=float, default=1.0)
         self.other.add_argument('-e', '--encoding', default=None)
         self.other.add_argument('-m', '--max-file-size',
                                 help='max file size in MB', type=int,
                                 default=0)
 
-    def parse(self) -> ap.Namespace:
-        args = self.parser.parse_args()
+    def parse(self, argv: list = None) -> ap.Namespace:
+        args = self.parser.parse_args(argv)
 
         if args.password is None:
             args.password = getpass()
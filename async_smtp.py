@@ -0,0 +1,296 @@
+from smtp import SMTPException, Reply, Capabilities, chunked, normalized, \
+    tls_context, tls_lock, known_capabilities, CHUNK_SIZE, \
+    encode_credential, plain_credentials, rejected_recipients, \
+    check_envelope, rejects_message
+import asyncio
+import logging
+import ssl
+
+
+class AsyncSMTP:
+    """
+    Асинхронный клиент на потоках asyncio с тем же набором команд, что и
+    у smtp.SMTP. Один цикл событий может обслуживать много соединений.
+    STARTTLS работает начиная с Python 3.7.
+    """
+    def __init__(self, verbose=False, timeout: float = 10) -> None:
+        self.reader = None
+        self.writer = None
+        self.host = None
+        self.port = None
+        self.encrypted = False
+        self.greeted = False
+        self.authorized = False
+        self.capabilities = Capabilities()
+        self.timeout = timeout
+        self.retries = 3
+        self.encoding = 'ascii'
+
+        self.client = logging.getLogger('Client')
+        self.server = logging.getLogger('Server')
+
+    async def connect(self, host: str, port: int) -> None:
+        """Подключаемся к серверу."""
+        self.client.info('Connecting to server.')
+        for i in range(self.retries):
+            try:
+                self.reader, self.writer = await asyncio.wait_for(
+                    asyncio.open_connection(host, port), self.timeout)
+                self.host = host
+                self.port = port
+                self.client.info('Connected successfully.')
+            except (asyncio.TimeoutError, OSError):
+                self.client.info('Attempt %d unsuccessful, retrying.', i)
+                continue
+            else:
+                return
+        raise SMTPException('Server unavailable.')
+
+    async def send(self, content: (str, bytes), b64=False) -> None:
+        """Отправляем серверу данное содержимое."""
+        if b64:
+            content = content + b'\r\n'
+        else:
+            content = self.to_bytes(content + '\r\n')
+        self.writer.write(content)
+        await self.writer.drain()
+
+    async def read_line(self) -> bytes:
+        try:
+            return await asyncio.wait_for(
+                self.reader.readuntil(b'\r\n'), self.timeout)
+        except asyncio.TimeoutError:
+            raise SMTPException('Server didn\'t send any response.')
+        except asyncio.IncompleteReadError:
+            raise SMTPException('Connection closed by server.')
+
+    async def reply(self) -> Reply:
+        """Получаем полный, возможно многострочный, ответ сервера."""
+        lines = [await self.read_line()]
+        while lines[-1][3:4] == b'-':
+            lines.append(await self.read_line())
+        reply = Reply(lines)
+        self.server.info('%s', reply)
+        return reply
+
+    async def receive(self) -> bytes:
+        """Получаем ответ сервера на отправленную команду."""
+        return (await self.reply()).raw
+
+    async def check_code(self, ok_code: bytes) -> Reply:
+        resp = await self.reply()
+        if not resp.startswith(ok_code):
+            raise SMTPException(resp.raw, resp.code)
+        return resp
+
+    async def hello(self) -> None:
+        """Отправляем команду приветствия."""
+        if not self.greeted:
+            await self.check_code(b'220')
+            self.greeted = True
+        self.client.info('Sending greeting to server.')
+        await self.send('ehlo localhost')
+        resp = await self.check_code(b'250')
+        self.capabilities = Capabilities.parse(resp.lines)
+        self.encoding = self.capabilities.encoding
+        with tls_lock:
+            known_capabilities[(self.host, self.port)] = self.capabilities
+
+    @property
+    def extensions(self) -> dict:
+        return self.capabilities.extensions
+
+    @extensions.setter
+    def extensions(self, extensions: dict) -> None:
+        self.capabilities = Capabilities(extensions)
+
+    def has_extension(self, name: str) -> bool:
+        """Проверяем, объявил ли сервер расширение в ответе на EHLO."""
+        return self.capabilities.has(name)
+
+    async def start_tls(self) -> None:
+        """Начинаем передачу по защищённому соединению."""
+        self.client.info('Sending TLS connection request.')
+        await self.send('starttls')
+        resp = await self.reply()
+        if not resp.startswith(b'220'):
+            raise SMTPException('Unable to establish a secure connection.',
+                                resp.code)
+
+    async def wrap_socket(self, context: ssl.SSLContext = None) -> None:
+        """
+        Переводим уже открытое соединение на TLS. Для этого нужен
+        Python 3.7 или новее: в 3.6 у цикла событий нет start_tls.
+        """
+        context = context or tls_context(self.host)
+        if hasattr(self.writer, 'start_tls'):
+            await self.writer.start_tls(context, server_hostname=self.host)
+        else:
+            loop = asyncio.get_event_loop()
+            if not hasattr(loop, 'start_tls'):
+                raise SMTPException('STARTTLS in AsyncSMTP requires '
+                                    'Python 3.7 or newer.')
+            transport = self.writer.transport
+            protocol = transport.get_protocol()
+            transport = await loop.start_tls(transport, protocol, context,
+                                             server_hostname=self.host)
+            self.writer = asyncio.StreamWriter(transport, protocol,
+                                               self.reader, loop)
+        self.encrypted = True
+        self.client.info('Secure socket ready.')
+
+    async def encrypt(self, context: ssl.SSLContext = None) -> None:
+        """
+        Запрашиваем передачу данных по защищённому соединению, переводим
+        на него поток и заново запрашиваем возможности сервера.
+        """
+        await self.start_tls()
+        await self.wrap_socket(context)
+        await self.hello()
+
+    async def authorize(self, login: str, password: str) -> None:
+        """
+        Авторизуемся на сервере: механизмом PLAIN одной командой, если
+        сервер его объявил, иначе LOGIN.
+        """
+        if self.authorized:
+            return
+        if 'PLAIN' in self.capabilities.auth:
+            self.client.info('Sending plain auth request.')
+            await self.send(b'auth plain ' + plain_credentials(
+                login, password, self.encoding), b64=True)
+            await self.check_code(b'235')
+        else:
+            self.client.info('Sending auth request.')
+            await self.send('auth login')
+            await self.check_code(b'334')
+            self.client.info('Sending login.')
+            await self.send(encode_credential(login, self.encoding),
+                            b64=True)
+            await self.check_code(b'334')
+            self.client.info('Sending password.')
+            await self.send(encode_credential(password, self.encoding),
+                            b64=True)
+            await self.check_code(b'235')
+        self.authorized = True
+        self.client.info('Authorized successfully.')
+
+    async def mail_from(self, sender: str) -> None:
+        """Отправляем серверу адрес отправителя."""
+        self.client.info('Sending sender name.')
+        await self.send('mail from: <{}>'.format(sender))
+        await self.check_code(b'250')
+
+    async def mail_to(self, recipient: str) -> None:
+        """Отправляем серверу адрес получателя."""
+        self.client.info('Sending recipient name')
+        await self.send('rcpt to: <{}>'.format(recipient))
+        await self.check_code(b'250')
+
+    async def envelope(self, sender: str, recipients: list) -> dict:
+        """
+        Передаём отправителя, получателей и команду DATA, при PIPELINING
+        одним пакетом. Возвращаем отклонённых получателей.
+        """
+        if not self.has_extension('PIPELINING'):
+            await self.mail_from(sender)
+            rejected = {}
+            for recipient in recipients:
+                try:
+                    await self.mail_to(recipient)
+                except SMTPException as e:
+                    if e.code is None:
+                        raise
+                    rejected[recipient] = e
+            check_envelope(recipients, rejected)
+            with rejects_message():
+                await self.data()
+            return rejected
+
+        self.client.info('Sending pipelined envelope.')
+        commands = ['mail from: <{}>'.format(sender)]
+        commands.extend('rcpt to: <{}>'.format(r) for r in recipients)
+        commands.append('data')
+        await self.send('\r\n'.join(commands))
+
+        sender_resp = await self.reply()
+        replies = [await self.reply() for _ in recipients]
+        rejected = rejected_recipients(recipients, replies)
+        data_resp = await self.reply()
+
+        if data_resp.startswith(b'354') and \
+                (not sender_resp.startswith(b'250') or
+                 len(rejected) == len(recipients)):
+            await self.send('.')
+            await self.reply()
+        check_envelope(recipients, rejected, sender_resp, data_resp)
+        return rejected
+
+    async def data(self) -> None:
+        """Начинаем передачу содержимого письма."""
+        self.client.info('Starting data transfer.')
+        await self.send('data')
+        await self.check_code(b'354')
+
+    async def letter(self, content) -> None:
+        """Передаём серверу содержимое письма."""
+        self.client.info('Sending the letter.')
+        if isinstance(content, str):
+            content = self.to_bytes(content)
+        if isinstance(content, (bytes, bytearray, memoryview)) or \
+                hasattr(content, 'read'):
+            content = chunked(content, CHUNK_SIZE)
+        for chunk in normalized(content):
+            self.writer.write(chunk)
+            await self.writer.drain()
+        await self.check_code(b'250')
+
+    async def send_letter(self, content) -> None:
+        """Отправляем письмо."""
+        await self.data()
+        await self.letter(content)
+        self.client.info('Mail sent successfully.')
+
+    async def send_message(self, sender: str, recipients: list,
+                           content) -> dict:
+        """Отправляем письмо целиком: конверт и содержимое."""
+        rejected = await self.envelope(sender, recipients)
+        with rejects_message():
+            await self.letter(content)
+        self.client.info('Mail sent successfully.')
+        return rejected
+
+    async def noop(self) -> None:
+        """Проверяем, что сервер всё ещё отвечает."""
+        await self.send('noop')
+        await self.check_code(b'250')
+
+    async def reset(self) -> None:
+        """Сбрасываем текущую транзакцию, не разрывая соединение."""
+        self.client.info('Resetting transaction.')
+        await self.send('rset')
+        await self.check_code(b'250')
+
+    async def disconnect(self) -> None:
+        """Закрываем соединение."""
+        self.client.info('Closing connection.')
+        try:
+            await self.send('quit')
+        finally:
+            await self.close()
+
+    async def close(self) -> None:
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except (OSError, ssl.SSLError, AttributeError):
+                pass
+        self.reader = self.writer = None
+        self.encrypted = False
+        self.greeted = False
+        self.authorized = False
+        self.capabilities = Capabilities()
+
+    def to_bytes(self, s: str) -> bytes:
+        return s.encode(self.encoding)
@@ -0,0 +1,134 @@
+from collections import OrderedDict
+from email_builder import encode_blocks
+from hashlib import sha1
+import mmap
+import os
+import threading
+
+SLICE_SIZE = 1048576
+
+
+class AttachmentCache:
+    """
+    Кэш вложений, уже закодированных в base64. Ключ — устройство, inode,
+    размер и время изменения файла. В памяти держим не больше max_bytes
+    байт, вытесняя давно не использованные записи; если указан spill_dir,
+    вытесненные и слишком большие записи сохраняются на диск и при
+    повторном использовании отображаются в память через mmap.
+    """
+    def __init__(self, max_bytes: int = 67108864,
+                 spill_dir: str = None) -> None:
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.size = 0
+        self.memory = OrderedDict()
+        self.mapped = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        if spill_dir is not None:
+            os.makedirs(spill_dir, exist_ok=True)
+
+    @staticmethod
+    def key(file) -> tuple:
+        stat = os.fstat(file.fileno())
+        return stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+    def spill_path(self, key: tuple) -> str:
+        name = sha1(repr(key).encode('ascii')).hexdigest()
+        return os.path.join(self.spill_dir, name + '.b64')
+
+    def encoded(self, file):
+        """Выдаём содержимое файла в base64, кодируя его не больше раза."""
+        key = self.key(file)
+        data = self.lookup(key)
+        if data is None:
+            self.misses += 1
+            data = self.store(key, file)
+        else:
+            self.hits += 1
+        if data is None:
+            file.seek(0)
+            yield from encode_blocks(file)
+            return
+
+        view = memoryview(data)
+        for start in range(0, len(view), SLICE_SIZE):
+            yield view[start:start + SLICE_SIZE]
+
+    def lookup(self, key: tuple):
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                return self.memory[key]
+            if key in self.mapped:
+                return self.mapped[key]
+        if self.spill_dir is not None and os.path.exists(self.spill_path(key)):
+            return self.map(key)
+        return None
+
+    def store(self, key: tuple, file):
+        """Кодируем файл и кладём результат в память или на диск."""
+        encoded_size = (key[2] + 56) // 57 * 77
+        if encoded_size <= self.max_bytes:
+            file.seek(0)
+            data = b''.join(encode_blocks(file))
+            with self.lock:
+                if key not in self.memory:
+                    self.memory[key] = data
+                    self.size += len(data)
+                evicted = self.evict()
+            for old_key, old_data in evicted:
+                self.spill(old_key, old_data)
+            return data
+
+        if self.spill_dir is None:
+            return None
+        path = self.spill_path(key)
+        temporary = '{}.{}.tmp'.format(path, threading.get_ident())
+        file.seek(0)
+        with open(temporary, 'wb') as f:
+            for block in encode_blocks(file):
+                f.write(block)
+        os.replace(temporary, path)
+        return self.map(key)
+
+    def evict(self) -> list:
+        evicted = []
+        while self.size > self.max_bytes and self.memory:
+            old_key, old_data = self.memory.popitem(last=False)
+            self.size -= len(old_data)
+            evicted.append((old_key, old_data))
+        return evicted
+
+    def spill(self, key: tuple, data: bytes) -> None:
+        if self.spill_dir is None:
+            return
+        path = self.spill_path(key)
+        if os.path.exists(path):
+            return
+        temporary = '{}.{}.tmp'.format(path, threading.get_ident())
+        with open(temporary, 'wb') as f:
+            f.write(data)
+        os.replace(temporary, path)
+
+    def map(self, key: tuple):
+        with open(self.spill_path(key), 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                data = b''
+            else:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        with self.lock:
+            self.mapped.setdefault(key, data)
+            return self.mapped[key]
+
+    def close(self) -> None:
+        """Освобождаем отображённые в память файлы."""
+        with self.lock:
+            for data in self.mapped.values():
+                if isinstance(data, mmap.mmap):
+                    data.close()
+            self.mapped.clear()
+            self.memory.clear()
+            self.size = 0
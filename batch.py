@@ -1,90 +1,449 @@
 from simple import run
 from argparse import Namespace
-from smtp import SMTPException
-import json
-import re
+from smtp import SMTPException, MessageRejected
+from pool import SessionPool
+from attachment_cache import AttachmentCache
+from throttle import Throttles
+from recipient_index import RecipientIndex
+from journal import Journal
+from retry import RetryQueue
+from planner import RecipientPlanner
+from metrics import metrics
+from concurrent.futures import ThreadPoolExecutor
+from queue import Empty
+import multiprocessing
+import logging
+import logs
 import os
+import threading
+import time
 
 
 SAVE_DELAY = 10
+SHARD_POLL = 1
 
 
 class BatchSender:
-    def __init__(self, recipients: str, args: Namespace):
-        self.recipients = open(recipients, 'r')
+    def __init__(self, recipients: str, args: Namespace, start: int = 0,
+                 end: int = None, shard: int = None, report=None):
+        self.recipients = RecipientIndex.open(recipients)
         self.args = args
+        self.workers = max(args.workers, 1)
+        self.pool = SessionPool(max_size=min(self.workers,
+                                             args.host_connections),
+                                max_messages=args.session_limit)
+        self.cache = AttachmentCache(args.cache_size * 1048576,
+                                     args.cache_dir)
+        self.templates = {}
+        self.throttles = Throttles.from_args(args)
 
-        self.position = 0
-        self.retry = []
-        self.backup = 'backup.json'
-        self.temporary_file = 'temp.json'
+        self.start = start
+        self.end = len(self.recipients) if end is None else end
+        self.report = report
+        self.position = start
+        self.finished = {}
+        self.partial = {}
+        self.outstanding = {}
+        self.lock = threading.Lock()
+        self.active = 0
+        self.error = None
+        self.queue = RetryQueue(base_delay=args.retry_delay,
+                                max_age=args.retry_max_age)
+        self.retrying = set()
+        suffix = '' if shard is None else '.{}'.format(shard)
+        self.journal = Journal('journal{}.jsonl'.format(suffix),
+                               commit_every=SAVE_DELAY)
+        self.bounces = 'bounces{}.txt'.format(suffix)
+        self.bounced = []
+        self.metrics_path = None
+        if getattr(args, 'metrics', None):
+            name, ext = os.path.splitext(args.metrics)
+            self.metrics_path = name + suffix + ext
+        self.metrics_interval = getattr(args, 'metrics_interval', 10)
+        self.metrics_dumped = time.monotonic()
 
-        self.bcc_limit = 15
+        self.planner = RecipientPlanner(args.rcpt_limit)
         self.before_save = SAVE_DELAY
-
-        self.email = re.compile(r'\S+@\S+')
+        self.client = logging.getLogger('Client')
 
         self.load()
+        self.resumed = self.position
+        self.started = time.monotonic()
 
     def load(self):
-        try:
-            with open(self.backup, 'r') as f:
-                state = json.loads(f.read())
-                self.position = state['position']
-                self.retry = state['retry']
-        except (OSError, json.JSONDecodeError, FileNotFoundError):
-            pass
+        self.position, self.finished, self.partial, retry = \
+            self.journal.load(self.start, self.end)
+        for recipient in retry:
+            self.queue.schedule(recipient)
 
     def save(self):
-        try:
-            with open(self.temporary_file, 'w') as f:
-                state = {'position': self.position, 'retry': self.retry}
-                f.write(json.dumps(state))
-            os.rename(self.temporary_file, self.backup)
-        except OSError:
-            pass
+        if self.journal.should_compact():
+            self.journal.compact(self.start, self.end, self.position,
+                                 self.finished, self.queue.pending() +
+                                 sorted(self.retrying), self.partial)
+        if self.report is not None:
+            self.report(self.position, len(self.queue))
+        done, total, eta = self.progress()
+        self.client.info('Sent %d of %d recipients, %.0f s left.',
+                         done, total, eta)
 
-    def broadcast(self):
-        self.recipients.seek(self.position)
+    def progress(self) -> tuple:
+        """Возвращаем число обработанных адресов, их общее число и ETA."""
+        done = self.position - self.start
+        total = self.end - self.start
+        sent = self.position - self.resumed
+        elapsed = time.monotonic() - self.started
+        eta = (total - done) * elapsed / sent if sent else float('inf')
+        return done, total, eta
 
-        while True:
-            recipient = self.recipients.readline().rstrip()
-            if not recipient:
-                break
-            if not self.email.match(recipient):
+    def groups(self):
+        """
+        Выдаём окна индекса с номерами первого и следующего за последним
+        адреса и группами пар (номер, адрес) для отдельных писем. При
+        --batch-bcc адреса окна группируются по доменам.
+        """
+        size = self.planner.window if self.args.batch_bcc else 1
+        start = self.position
+        while start < self.end:
+            with self.lock:
+                done = max(self.position, self.finished.get(start, start))
+                sent = self.partial.get(start, ())
+            if done > start:
+                start = done
                 continue
-
-            recipients = [recipient]
+            end = min(start + size, self.end)
+            entries = [entry for entry in
+                       enumerate(self.recipients.read(start, end), start)
+                       if entry[0] not in sent]
             if self.args.batch_bcc:
-                while True:
-                    new = self.recipients.readline().rstrip()
-                    if not new:
-                        break
-                    recipients.append(new)
-                    if len(recipients) >= self.bcc_limit:
-                        break
+                yield start, end, self.planner.plan(entries)
+            else:
+                yield start, end, [entries] if entries else []
+            start = end
 
-            self.args.recipient = recipient
-            self.args.recipients = recipients
-            try:
-                run(self.args)
-            except SMTPException:
-                self.retry.append(recipient)
-            self.position = self.recipients.tell()
+    def send(self, recipients: list) -> dict:
+        """
+        Отправляем одно письмо и возвращаем отклонённых получателей. По
+        получателям разбираем только ответы на RCPT и DATA; временная
+        ошибка соединения, EHLO, AUTH или MAIL FROM откладывает всю
+        группу, а постоянная останавливает рассылку.
+        """
+        args = Namespace(**vars(self.args))
+        args.recipient = recipients[0]
+        args.recipients = recipients
+        try:
+            return run(args, self.pool, self.cache, self.templates,
+                       self.throttles, attempts=1)
+        except MessageRejected as e:
+            rejected = {recipient: e for recipient in recipients}
+            rejected.update(e.rejected)
+            return rejected
+        except (SMTPException, OSError) as e:
+            if RetryQueue.permanent(e):
+                raise
+            return {recipient: e for recipient in recipients}
+
+    def transmit(self, recipients: list) -> dict:
+        """
+        Отправляем письмо группе не более чем по planner.limit адресов за
+        транзакцию; адресатов, которых сервер отложил ответом 452,
+        досылаем следующими транзакциями и уменьшаем предел. Возвращаем
+        окончательно отклонённых получателей.
+        """
+        rejected = {}
+        while recipients:
+            limit = self.planner.limit
+            current, recipients = recipients[:limit], recipients[limit:]
+            result = self.send(current)
+            deferred = self.planner.deferred(current, result)
+            if len(deferred) == len(current):
+                deferred = []
+            elif deferred:
+                self.planner.learn(len(current) - len(deferred))
+            rejected.update((recipient, error)
+                            for recipient, error in result.items()
+                            if recipient not in deferred)
+            recipients = deferred + recipients
+        return rejected
+
+    def deliver(self, start: int, end: int, group: list):
+        """Отправляем письмо группе получателей и отмечаем её в журнале."""
+        indices = [index for index, _ in group]
+        failed = []
+        rejected = self.transmit([recipient for _, recipient in group])
+        for recipient, error in rejected.items():
+            if self.queue.fail(recipient, error):
+                failed.append(recipient)
+
+        with self.lock:
+            self.outstanding[start] -= 1
+            last = not self.outstanding[start]
+            if last:
+                del self.outstanding[start]
+                self.partial.pop(start, None)
+            else:
+                self.journal.part(start, indices, failed)
+                self.partial.setdefault(start, set()).update(indices)
+        if last:
+            self.complete(start, end, failed)
+
+    def retry_due(self, executor):
+        """
+        Запускаем повторы, время которых подошло. Пока повтор идёт, адрес
+        числится в retrying, чтобы попасть в снимок журнала.
+        """
+        for entry in self.queue.due():
+            with self.lock:
+                self.retrying.add(entry[0])
+            self.submit(executor, self.redeliver, *entry)
+
+    def redeliver(self, recipient: str, attempts: int, first_failed: float):
+        """Повторяем отправку адресу из очереди отложенных."""
+        error = self.send([recipient]).get(recipient)
+        with self.lock:
+            self.retrying.discard(recipient)
+            if error is None:
+                self.journal.retried(recipient, True)
+            elif self.queue.fail(recipient, error, attempts, first_failed):
+                self.journal.retried(recipient, False)
+            else:
+                self.journal.bounced(recipient)
+                self.write_bounce()
+
+    def write_bounce(self):
+        """Дописываем в файл отказов новые адреса из очереди."""
+        bounces = self.queue.take_bounces()
+        if not bounces:
+            return
+        with open(self.bounces, 'a') as f:
+            for recipient, reason in bounces:
+                if isinstance(reason, bytes):
+                    reason = reason.decode('utf-8', 'replace').strip()
+                f.write('{}\t{}\n'.format(recipient, reason))
+                self.bounced.append(recipient)
+
+    def complete(self, start: int, end: int, failed: list = ()):
+        """
+        Сдвигаем позицию возобновления только через непрерывно
+        обработанный участок индекса: группы могут завершаться не по
+        порядку.
+        """
+        with self.lock:
+            self.journal.done(start, end, list(failed))
+            self.write_bounce()
+            self.finished[start] = end
+            while self.position in self.finished:
+                self.position = self.finished.pop(self.position)
             self.before_save -= 1
 
             if self.before_save == 0:
                 self.before_save = SAVE_DELAY
                 self.save()
+            if self.metrics_path is not None and time.monotonic() - \
+                    self.metrics_dumped >= self.metrics_interval:
+                self.dump_metrics()
 
-        while self.retry:
-            recipient = self.retry.pop()
+    def dump_metrics(self):
+        """Сохраняем метрики SMTP в файл, указанный в --metrics."""
+        self.metrics_dumped = time.monotonic()
+        try:
+            metrics.dump(self.metrics_path)
+        except OSError as e:
+            self.client.warning('Unable to write metrics: {}'.format(e))
+
+    def abort(self, error: Exception):
+        """
+        Запоминаем ошибку задачи: новые письма больше не отправляются, а
+        журнал остаётся для возобновления.
+        """
+        self.client.error('Batch task failed: %r', error)
+        with self.lock:
+            if self.error is None:
+                self.error = error
+
+    def submit(self, executor, func, *job):
+        """Запускаем задачу в пуле потоков или сразу, если поток один."""
+        if executor is None:
             try:
-                run(self.args)
-            except SMTPException:
-                self.retry.append(recipient)
+                func(*job)
+            except Exception as e:
+                self.abort(e)
+            return
 
-        try:
-            os.remove('backup.json')
-        except OSError:
-            pass
+        def finished(future):
+            if future.exception() is not None:
+                self.abort(future.exception())
+            with self.lock:
+                self.active -= 1
+            self.slots.release()
+
+        self.slots.acquire()
+        with self.lock:
+            self.active += 1
+        executor.submit(func, *job).add_done_callback(finished)
+
+    def broadcast(self) -> list:
+        """
+        Рассылаем письма, вставляя между новыми группами повторы, время
+        которых подошло. Возвращаем адреса, попавшие в отказы. Если
+        задача завершилась ошибкой, дожидаемся начатых и поднимаем её.
+        """
+        executor = None
+        if self.workers > 1:
+            executor = ThreadPoolExecutor(self.workers)
+            self.slots = threading.Semaphore(self.workers * 2)
+
+        for start, end, groups in self.groups():
+            if self.error is not None:
+                break
+            with self.lock:
+                if groups:
+                    self.outstanding[start] = len(groups)
+                else:
+                    self.partial.pop(start, None)
+            if not groups:
+                self.complete(start, end)
+            for group in groups:
+                self.retry_due(executor)
+                self.submit(executor, self.deliver, start, end, group)
+
+        while True:
+            if self.error is None:
+                self.retry_due(executor)
+            with self.lock:
+                active = self.active
+            if not active and (not len(self.queue) or
+                               self.error is not None):
+                break
+            time.sleep(min(self.queue.wait_time(), 1) if len(self.queue)
+                       else 0.05)
+
+        if executor is not None:
+            executor.shutdown()
+        self.pool.close()
+        self.cache.close()
+        self.recipients.close()
+        if self.report is not None:
+            self.report(self.position, len(self.queue))
+        if self.metrics_path is not None:
+            self.dump_metrics()
+
+        self.journal.close(remove=self.error is None and
+                           not self.outstanding and
+                           self.position == self.end)
+        if self.error is not None:
+            raise self.error
+        return self.bounced
+
+
+def shard_bounds(count: int, shards: int) -> list:
+    """Делим count адресов индекса на shards почти равных участков."""
+    bounds = [(count * i // shards, count * (i + 1) // shards)
+              for i in range(shards)]
+    return [(start, end) for start, end in bounds if start < end]
+
+
+def deliver_shard(path: str, args: Namespace, start: int, end: int,
+                  shard: int, queue) -> None:
+    """
+    Рассылаем письма по одному участку индекса в отдельном процессе.
+    Сообщение о завершении отправляется и при ошибке, тогда вместо
+    списка отказов в нём None.
+    """
+    def report(position: int, failed: int):
+        queue.put(('progress', shard, position, failed))
+
+    failed = None
+    try:
+        logs.setup(args.verbose, getattr(args, 'log_sample', 1.0))
+        sender = BatchSender(path, args, start, end, shard, report)
+        failed = sender.broadcast()
+    finally:
+        queue.put(('done', shard, failed))
+
+
+class ShardedSender:
+    """
+    Делит индекс получателей на участки и рассылает каждый из них в
+    отдельном процессе со своими соединениями и позицией возобновления.
+    """
+    def __init__(self, recipients: str, args: Namespace):
+        self.path = recipients
+        self.args = args
+        index = RecipientIndex.open(recipients)
+        self.bounds = shard_bounds(len(index), max(args.processes, 1))
+        index.close()
+        self.positions = {i: start
+                          for i, (start, _) in enumerate(self.bounds)}
+        self.failed = {}
+        self.errors = {}
+        self.client = logging.getLogger('Client')
+
+    def progress(self) -> float:
+        total = sum(end - start for start, end in self.bounds)
+        done = sum(self.positions[i] - start
+                   for i, (start, _) in enumerate(self.bounds))
+        return done / total if total else 1
+
+    def receive(self, message: tuple, running: set):
+        """Учитываем сообщение процесса о ходе или завершении работы."""
+        if message[0] == 'progress':
+            _, shard, position, _ = message
+            self.positions[shard] = position
+            self.client.info('Progress: %.1f%%', self.progress() * 100)
+            return
+        _, shard, failed = message
+        if failed is None:
+            self.errors[shard] = None
+        else:
+            self.errors.pop(shard, None)
+            self.failed[shard] = failed
+            self.positions[shard] = self.bounds[shard][1]
+        running.discard(shard)
+
+    def broadcast(self) -> list:
+        """
+        Запускаем процессы и собираем их отказы. Процесс, завершившийся
+        без сообщения о конце работы, считается упавшим; если упал хотя
+        бы один, после остальных поднимаем RuntimeError.
+        """
+        queue = multiprocessing.Queue()
+        processes = [multiprocessing.Process(target=deliver_shard,
+                                             args=(self.path, self.args,
+                                                   start, end, i, queue))
+                     for i, (start, end) in enumerate(self.bounds)]
+        for process in processes:
+            process.start()
+
+        running = set(range(len(processes)))
+        while running:
+            try:
+                self.receive(queue.get(timeout=SHARD_POLL), running)
+            except Empty:
+                exited = [shard for shard in running
+                          if processes[shard].exitcode is not None]
+                while True:
+                    try:
+                        self.receive(queue.get_nowait(), running)
+                    except Empty:
+                        break
+                for shard in exited:
+                    if shard in running:
+                        self.errors[shard] = processes[shard].exitcode
+                        running.discard(shard)
+
+        for process in processes:
+            process.join()
+        for shard in sorted(self.errors):
+            self.client.error('Shard %d failed, exit code %s.', shard,
+                              processes[shard].exitcode)
+
+        failed = [r for shard in sorted(self.failed)
+                  for r in self.failed[shard]]
+        if failed:
+            self.client.warning('Failed to deliver to {} '
+                                'recipients.'.format(len(failed)))
+        if self.errors:
+            raise RuntimeError('{} of {} shards failed.'.format(
+                len(self.errors), len(processes)))
+        return failed
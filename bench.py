@@ -0,0 +1,232 @@
+from argparser import Parser
+from batch import BatchSender
+from fake_server import FakeServer, DEFAULT_CAPABILITIES, self_signed_context
+from pool import SessionPool
+from simple import run
+import argparse as ap
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+METRICS_HIGHER_IS_BETTER = ('msgs_per_sec', 'bytes_per_sec')
+METRICS_LOWER_IS_BETTER = ('p50_ms', 'p99_ms', 'peak_rss_kb')
+
+
+def client_args(server: FakeServer, options: ap.Namespace,
+                *extra: str) -> ap.Namespace:
+    """Собираем аргументы клиента так же, как их разбирает main.py."""
+    argv = ['--host', server.host, '-p', str(server.port), '-l',
+            'bench@localhost', '--password', 'secret', '-r',
+            'rcpt@localhost', '--subject', 'Benchmark', '-t', 'Hello!']
+    argv += ['--insecure'] if options.tls else ['--no-ssl']
+    return Parser().parse(argv + list(extra))
+
+
+def write_file(path: str, size: int) -> str:
+    with open(path, 'wb') as f:
+        for _ in range(size // 1048576):
+            f.write(os.urandom(1048576))
+        f.write(os.urandom(size % 1048576))
+    return path
+
+
+def write_recipients(path: str, count: int) -> str:
+    with open(path, 'w') as f:
+        for i in range(count):
+            f.write('user{}@domain{}.example\n'.format(i, i % 7))
+    return path
+
+
+def single(server: FakeServer, options: ap.Namespace) -> None:
+    """Отдельные письма одному получателю через общее соединение."""
+    pool = SessionPool(max_size=1)
+    args = client_args(server, options)
+    for _ in range(options.messages):
+        run(args, pool)
+    pool.close()
+
+
+def batch(server: FakeServer, options: ap.Namespace) -> None:
+    """Рассылка по списку, по письму на каждого получателя."""
+    path = write_recipients('recipients.txt', options.messages)
+    args = client_args(server, options, '--batch', path,
+                       '-w', str(options.workers))
+    BatchSender(path, args).broadcast()
+
+
+def batch_bcc(server: FakeServer, options: ap.Namespace) -> None:
+    """Рассылка по списку с несколькими получателями в письме."""
+    path = write_recipients('recipients.txt', options.messages * 15)
+    args = client_args(server, options, '--batch', path, '--batch-bcc',
+                       '-w', str(options.workers))
+    BatchSender(path, args).broadcast()
+
+
+def attachment(server: FakeServer, options: ap.Namespace) -> None:
+    """Письма с большим вложением."""
+    path = write_file('attachment.bin', options.attachment_mb * 1048576)
+    pool = SessionPool(max_size=1)
+    args = client_args(server, options, '-a', path)
+    for _ in range(max(options.messages // 50, 1)):
+        run(args, pool)
+    pool.close()
+
+
+def split(server: FakeServer, options: ap.Namespace) -> None:
+    """Большое вложение, разделённое на несколько писем."""
+    path = write_file('attachment.bin', options.attachment_mb * 1048576)
+    args = client_args(server, options, '-a', path, '-m',
+                       str(max(options.attachment_mb // 4, 1)))
+    run(args)
+
+
+SCENARIOS = {'single': single, 'batch': batch, 'batch_bcc': batch_bcc,
+             'attachment': attachment, 'split': split}
+
+
+def client(scenario: str, server: FakeServer, options: ap.Namespace,
+           queue) -> None:
+    """Выполняем сценарий в отдельном процессе и сообщаем время и память."""
+    directory = tempfile.mkdtemp()
+    os.chdir(directory)
+    try:
+        started = time.monotonic()
+        SCENARIOS[scenario](server, options)
+        elapsed = time.monotonic() - started
+    finally:
+        os.chdir(os.path.dirname(directory))
+        shutil.rmtree(directory, ignore_errors=True)
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        rss //= 1024
+    queue.put((elapsed, rss))
+
+
+def percentile(values: list, fraction: float) -> float:
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1,
+                      int(round(fraction * (len(values) - 1))))]
+
+
+def measure(scenario: str, server: FakeServer,
+            options: ap.Namespace) -> dict:
+    """
+    Запускаем сценарий и собираем результат. Задержка — время на
+    сервере от MAIL FROM до итогового ответа на письмо.
+    """
+    server.reset()
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=client,
+                                      args=(scenario, server, options, queue))
+    process.start()
+    elapsed, rss = queue.get()
+    process.join()
+    stats = server.stats()
+    return {'messages': stats['messages'],
+            'recipients': stats['recipients'],
+            'connections': stats['connections'],
+            'seconds': round(elapsed, 3),
+            'msgs_per_sec': round(stats['messages'] / elapsed, 2),
+            'bytes_per_sec': round(stats['bytes'] / elapsed),
+            'p50_ms': round(percentile(stats['latencies'], 0.5) * 1000, 3),
+            'p99_ms': round(percentile(stats['latencies'], 0.99) * 1000, 3),
+            'peak_rss_kb': rss}
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    """Возвращаем описания метрик, ухудшившихся больше чем на tolerance."""
+    regressions = []
+    for scenario, result in results.items():
+        previous = baseline.get(scenario)
+        if previous is None:
+            continue
+        for metric in METRICS_HIGHER_IS_BETTER + METRICS_LOWER_IS_BETTER:
+            old, new = previous.get(metric), result.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            if metric in METRICS_HIGHER_IS_BETTER:
+                change = -change
+            if change > tolerance:
+                regressions.append('{}: {} {} -> {} ({:+.1%})'.format(
+                    scenario, metric, old, new, (new - old) / old))
+    return regressions
+
+
+def parse(argv: list = None) -> ap.Namespace:
+    parser = ap.ArgumentParser(description='Benchmark the SMTP client '
+                                           'against a local fake server.')
+    parser.add_argument('-s', '--scenario', action='append',
+                        choices=sorted(SCENARIOS),
+                        help='scenario to run (default: all)')
+    parser.add_argument('-n', '--messages', type=int, default=200,
+                        help='messages per scenario')
+    parser.add_argument('-w', '--workers', type=int, default=4,
+                        help='worker threads in batch scenarios')
+    parser.add_argument('--attachment-mb', type=int, default=20,
+                        help='attachment size in MB')
+    parser.add_argument('--delay', type=float, default=0,
+                        help='server delay before each reply in ms')
+    parser.add_argument('--tls', action='store_true',
+                        help='require STARTTLS with a self-signed '
+                             'certificate')
+    parser.add_argument('--capability', action='append',
+                        help='EHLO keyword announced by the server '
+                             '(default: {})'.format(
+                                 ', '.join(DEFAULT_CAPABILITIES)))
+    parser.add_argument('-o', '--output', default='bench.json',
+                        help='file for the results')
+    parser.add_argument('-b', '--baseline',
+                        help='results to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='allowed relative regression')
+    return parser.parse_args(argv)
+
+
+def main(argv: list = None) -> int:
+    options = parse(argv)
+    tls = None
+    if options.tls:
+        tls = self_signed_context()
+        if tls is None:
+            print('openssl is not available, running without TLS.')
+            options.tls = False
+    server = FakeServer(options.capability or DEFAULT_CAPABILITIES, tls,
+                        options.delay / 1000)
+    server.start()
+
+    results = {}
+    try:
+        for scenario in options.scenario or list(SCENARIOS):
+            results[scenario] = measure(scenario, server, options)
+            print('{:<12}{:>10.1f} msg/s{:>10.1f} MB/s  p50 {:.2f} ms  '
+                  'p99 {:.2f} ms  rss {} KB'.format(
+                      scenario, results[scenario]['msgs_per_sec'],
+                      results[scenario]['bytes_per_sec'] / 1048576,
+                      results[scenario]['p50_ms'],
+                      results[scenario]['p99_ms'],
+                      results[scenario]['peak_rss_kb']))
+    finally:
+        server.stop()
+
+    with open(options.output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+    if options.baseline:
+        with open(options.baseline) as f:
+            regressions = compare(results, json.load(f), options.tolerance)
+        for regression in regressions:
+            print('Regression in ' + regression)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
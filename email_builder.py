@@ -1,6 +1,45 @@
 from datetime import datetime
 from mimetypes import guess_type
-from base64 import b64encode
+from base64 import encodebytes
+import mmap
+import os
+import re
+
+ENCODE_BLOCK = 57 * 1024
+SLOT = '\x00{}\x00'
+
+
+def encode_blocks(source):
+    """
+    Кодируем источник в base64 со строками по 76 символов. Источник
+    читается блоками, кратными 57 байтам, поэтому строки не рвутся на
+    границах блоков.
+    """
+    if isinstance(source, memoryview):
+        for start in range(0, len(source), ENCODE_BLOCK):
+            yield encodebytes(source[start:start + ENCODE_BLOCK])
+        return
+
+    while True:
+        block = source.read(ENCODE_BLOCK)
+        if not block:
+            return
+        yield encodebytes(block)
+
+
+def encoded_size(size: int) -> int:
+    """
+    Длина base64 от size байт со строками по 76 символов в том виде, в
+    каком она уходит на сервер: каждая строка заканчивается CRLF.
+    """
+    lines, rest = divmod(size, 57)
+    return lines * 78 + (4 * ((rest + 2) // 3) + 2 if rest else 0)
+
+
+def wire_size(data: bytes) -> int:
+    """Длина данных после замены одиночных CR и LF на CRLF."""
+    return len(data) + data.count(b'\r') + data.count(b'\n') - \
+        2 * data.count(b'\r\n')
 
 
 class EmailException(Exception):
@@ -13,7 +52,8 @@ class Email:
     def __init__(self, sender: str, recipient: str, sender_name: str,
                  cc: set = (), attachments: set = (), subject: str = None,
                  text: str = None, encoding: str = 'utf-8',
-                 attch_part: tuple = None) -> None:
+                 attch_part: tuple = None, streaming: bool = False,
+                 cache=None) -> None:
         self.date = datetime.strftime(datetime.now(), '%a, %d %b %Y %H:%M:%S')
         self.sender = sender
         self.sender_name = sender_name
@@ -24,9 +64,11 @@ class Email:
         self.attachments = attachments
         self.attch_part = attch_part
         self.encoding = encoding
+        self.streaming = streaming
+        self.cache = cache
         self.subject_text = self.format_subject()
         self.cc_text = self.format_cc()
-        self.attachments_text = self.format_attachments()
+        self.attachments_text = '' if streaming else self.format_attachments()
 
     def format_cc(self) -> str:
         if not self.cc:
@@ -39,34 +81,83 @@ class Email:
         return 'Subject: {}\n'.format(self.subject)
 
     def format_attachments(self):
+        return b''.join(self.iter_attachments()).decode(self.encoding)
+
+    def iter_attachments(self, attachments=None):
+        """
+        Выдаём вложения письма блоками байт, кодируя их по частям. Если
+        передан attachments, берём файлы оттуда, а не из письма.
+        """
         if self.attch_part:
-            return self.format_attachment_part()
-
-        text = []
-        attachment = ('Content-Disposition: attachment; filename="{}"\n'
-                      'Content-Transfer-Encoding: base64\n'
-                      'Content-Type: {}; name="{}"\n\n\n{}\n--frontier\n')
-
-        for fname, new_name in self.attachments:
-            file_name = new_name if new_name else fname[0].name
-            text.append(attachment.format(
-                file_name,
-                guess_type(fname[0].name)[0],
-                fname[0].name,
-                b64encode(fname[0].read()).decode(self.encoding)))
-        return ' '.join(text)
-
-    def format_attachment_part(self):
-        attachment = ('Content-Disposition: attachment; filename="{}"\n'
-                      'Content-Transfer-Encoding: base64\n'
-                      'Content-Type: {}; name="{}"\n\n\n{}\n--frontier\n')
-        return attachment.format(
-            self.attch_part[0],
-            guess_type(self.attch_part[0]),
-            self.attch_part[0],
-            b64encode(self.attch_part[1]).decode(self.encoding))
+            yield from self.iter_part(*self.attch_part)
+            return
 
-    def to_string(self) -> str:
+        if attachments is None:
+            attachments = self.attachments
+        for file, new_name in attachments or ():
+            file.seek(0)
+            yield from self.iter_attachment(
+                new_name if new_name else file.name, file.name,
+                self.cache.encoded(file)
+                if self.cache and hasattr(file, 'fileno') else file)
+
+    def iter_attachment(self, file_name: str, name: str, source):
+        """
+        Выдаём одно вложение: заголовки и содержимое в base64. Источником
+        может быть файл, memoryview или уже закодированные блоки из кэша.
+        """
+        yield self.attachment_header(file_name, name)
+
+        if isinstance(source, memoryview) or hasattr(source, 'read'):
+            source = encode_blocks(source)
+        yield from source
+        yield b'\n--frontier\n'
+
+    def iter_part(self, path: str, offset: int, length: int):
+        """
+        Выдаём часть большого файла как отдельное вложение, читая её
+        через mmap только в момент отправки.
+        """
+        with open(path, 'rb') as file, \
+                mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            view = memoryview(data)
+            part = view[offset:offset + length]
+            try:
+                yield from self.iter_attachment(path, path, part)
+            finally:
+                part.release()
+                view.release()
+
+    def attachment_header(self, file_name: str, name: str) -> bytes:
+        header = ('Content-Disposition: attachment; filename="{}"\n'
+                  'Content-Transfer-Encoding: base64\n'
+                  'Content-Type: {}; name="{}"\n\n\n')
+        return header.format(file_name, guess_type(name)[0],
+                             name).encode(self.encoding)
+
+    def attachment_sizes(self):
+        """Выдаём имя, исходное имя и размер в байтах каждого вложения."""
+        if self.attch_part:
+            path, _, length = self.attch_part
+            yield path, path, length
+            return
+
+        for file, new_name in self.attachments or ():
+            yield new_name if new_name else file.name, file.name, \
+                file.seek(0, os.SEEK_END)
+
+    def size(self) -> int:
+        """
+        Размер письма в байтах на проводе, с CRLF в концах строк,
+        посчитанный без кодирования вложений.
+        """
+        size = wire_size(self.format_headers().encode(self.encoding))
+        for file_name, name, length in self.attachment_sizes():
+            size += wire_size(self.attachment_header(file_name, name)) + \
+                encoded_size(length) + wire_size(b'\n--frontier\n')
+        return size
+
+    def format_headers(self) -> str:
         template = ('From: {} <{}>\nTo: {}\n{}{}'
                     'MIME-Version: 1.0\nDate: {}\n'
                     'Content-Type: multipart/mixed; boundary=frontier\n'
@@ -77,5 +168,63 @@ class Email:
 
         return template.format(self.sender_name, self.sender, self.recipient,
                                self.cc_text, self.subject_text,
-                               self.date, self.sender,
-                               self.text) + self.attachments_text
+                               self.date, self.sender, self.text)
+
+    def chunks(self):
+        """Выдаём письмо последовательностью байтовых блоков."""
+        yield self.format_headers().encode(self.encoding)
+        yield from self.iter_attachments()
+
+    def to_string(self) -> str:
+        if self.streaming:
+            return b''.join(self.chunks()).decode(self.encoding)
+        return self.format_headers() + self.attachments_text
+
+
+class EmailTemplate:
+    """
+    Письмо, неизменная часть которого один раз переведена в байты. Для
+    каждого получателя подставляются только заголовки To и Date и поля
+    вида {{name}} из текста письма. Вложения в шаблоне не хранятся:
+    файлы открывает каждый вызов run(), и они передаются в render().
+    """
+    def __init__(self, email: Email) -> None:
+        self.email = email
+        self.encoding = email.encoding
+        email.recipient = SLOT.format('to')
+        email.date = SLOT.format('date')
+        email.text = re.sub(r'\{\{(\w+)\}\}',
+                            lambda m: SLOT.format(m.group(1)),
+                            str(email.text))
+        parts = re.split('\x00(\\w+)\x00', email.format_headers())
+        self.static = [part.encode(self.encoding) for part in parts[::2]]
+        self.fields = parts[1::2]
+        self.tail_size = sum(
+            wire_size(email.attachment_header(file_name, name)) +
+            encoded_size(length) + wire_size(b'\n--frontier\n')
+            for file_name, name, length in email.attachment_sizes())
+        email.attachments = None
+
+    def headers(self, recipient: str, fields: dict = None) -> list:
+        """Собираем заголовки и текст письма для получателя."""
+        values = dict(fields or ())
+        values['to'] = recipient
+        values['date'] = datetime.strftime(datetime.now(),
+                                           '%a, %d %b %Y %H:%M:%S')
+        buffers = [self.static[0]]
+        for name, static in zip(self.fields, self.static[1:]):
+            buffers.append(str(values.get(name, '')).encode(self.encoding))
+            buffers.append(static)
+        return buffers
+
+    def size(self, headers: list) -> int:
+        """Размер письма на проводе с заголовками headers и вложениями."""
+        return sum(wire_size(buffer) for buffer in headers) + self.tail_size
+
+    def render(self, headers: list, attachments=None):
+        """
+        Выдаём письмо блоками: заголовки, затем вложения из attachments
+        (или часть файла, если шаблон построен для неё).
+        """
+        yield from headers
+        yield from self.email.iter_attachments(attachments)
@@ -0,0 +1,197 @@
+import asyncio
+import os
+import shutil
+import ssl
+import subprocess
+import tempfile
+import threading
+import time
+
+DEFAULT_CAPABILITIES = ('PIPELINING', 'CHUNKING', 'SIZE 104857600',
+                        '8BITMIME', 'SMTPUTF8', 'AUTH PLAIN LOGIN')
+
+
+def self_signed_context() -> ssl.SSLContext:
+    """
+    Создаём серверный контекст TLS с самоподписанным сертификатом через
+    openssl. Если openssl не установлен, возвращаем None.
+    """
+    if shutil.which('openssl') is None:
+        return None
+    directory = tempfile.mkdtemp()
+    cert = os.path.join(directory, 'cert.pem')
+    key = os.path.join(directory, 'key.pem')
+    try:
+        subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048',
+                        '-nodes', '-days', '1', '-subj', '/CN=localhost',
+                        '-keyout', key, '-out', cert],
+                       check=True, stdout=subprocess.DEVNULL,
+                       stderr=subprocess.DEVNULL)
+        context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        context.load_cert_chain(cert, key)
+        return context
+    except (OSError, subprocess.CalledProcessError, ssl.SSLError):
+        return None
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+class FakeServer:
+    """
+    Локальный ESMTP-сервер на asyncio для нагрузочных тестов. Принимает
+    любые письма, ничего не доставляет и считает транзакции: число писем
+    и получателей, принятые байты и время от MAIL FROM до итогового
+    ответа. Возможности сервера и задержка перед каждым ответом
+    настраиваются; STARTTLS объявляется, если передан контекст TLS.
+    """
+    def __init__(self, capabilities=DEFAULT_CAPABILITIES,
+                 tls: ssl.SSLContext = None, delay: float = 0) -> None:
+        self.capabilities = list(capabilities)
+        self.tls = tls
+        self.delay = delay
+        self.host = '127.0.0.1'
+        self.port = None
+        self.loop = None
+        self.server = None
+        self.thread = None
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        """Обнуляем счётчики между сценариями."""
+        with self.lock:
+            self.messages = 0
+            self.recipients = 0
+            self.bytes = 0
+            self.latencies = []
+            self.connections = 0
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {'messages': self.messages, 'recipients': self.recipients,
+                    'bytes': self.bytes, 'latencies': list(self.latencies),
+                    'connections': self.connections}
+
+    def start(self) -> None:
+        """Запускаем сервер в отдельном потоке со своим циклом событий."""
+        started = threading.Event()
+
+        def serve():
+            self.loop = asyncio.new_event_loop()
+            self.server = self.loop.run_until_complete(
+                asyncio.start_server(self.handle, self.host, 0))
+            self.port = self.server.sockets[0].getsockname()[1]
+            started.set()
+            self.loop.run_forever()
+
+        self.thread = threading.Thread(target=serve, daemon=True)
+        self.thread.start()
+        started.wait()
+
+    def stop(self) -> None:
+        async def close():
+            self.server.close()
+            await self.server.wait_closed()
+
+        asyncio.run_coroutine_threadsafe(close(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    def finish(self, started: float, recipients: int, size: int) -> None:
+        with self.lock:
+            self.messages += 1
+            self.recipients += recipients
+            self.bytes += size
+            self.latencies.append(time.monotonic() - started)
+
+    async def reply(self, writer, *lines: str) -> None:
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        writer.write(''.join(line + '\r\n' for line in lines).encode())
+        await writer.drain()
+
+    async def start_tls(self, reader, writer):
+        """Переводим соединение на TLS и возвращаем новый writer."""
+        if hasattr(writer, 'start_tls'):
+            await writer.start_tls(self.tls)
+            return writer
+        loop = asyncio.get_event_loop()
+        transport = writer.transport
+        protocol = transport.get_protocol()
+        transport = await loop.start_tls(transport, protocol, self.tls,
+                                         server_side=True)
+        return asyncio.StreamWriter(transport, protocol, reader, loop)
+
+    async def handle(self, reader, writer) -> None:
+        with self.lock:
+            self.connections += 1
+        try:
+            await self.session(reader, writer)
+        except (ConnectionError, asyncio.IncompleteReadError, ssl.SSLError):
+            pass
+        finally:
+            writer.close()
+
+    async def session(self, reader, writer) -> None:
+        await self.reply(writer, '220 localhost fake ESMTP')
+        encrypted = False
+        started, recipients, chunks = None, 0, 0
+        while True:
+            line = await reader.readline()
+            if not line:
+                return
+            command = line.decode('utf-8', 'replace').strip()
+            verb = command.split(' ', 1)[0].lower()
+
+            if verb in ('ehlo', 'helo'):
+                lines = ['localhost'] + self.capabilities
+                if self.tls is not None and not encrypted:
+                    lines.append('STARTTLS')
+                await self.reply(writer,
+                                 *['250-' + l for l in lines[:-1]],
+                                 '250 ' + lines[-1])
+            elif verb == 'starttls' and self.tls is not None:
+                await self.reply(writer, '220 ready to start TLS')
+                writer = await self.start_tls(reader, writer)
+                encrypted = True
+            elif verb == 'auth' and command.lower().startswith('auth login'):
+                await self.reply(writer, '334 VXNlcm5hbWU6')
+                await reader.readline()
+                await self.reply(writer, '334 UGFzc3dvcmQ6')
+                await reader.readline()
+                await self.reply(writer, '235 authenticated')
+            elif verb == 'auth':
+                await self.reply(writer, '235 authenticated')
+            elif verb == 'mail':
+                started, recipients = time.monotonic(), 0
+                await self.reply(writer, '250 sender ok')
+            elif verb == 'rcpt':
+                recipients += 1
+                await self.reply(writer, '250 recipient ok')
+            elif verb == 'data':
+                await self.reply(writer, '354 go ahead')
+                size = 0
+                while True:
+                    line = await reader.readline()
+                    if not line or line == b'.\r\n':
+                        break
+                    size += len(line)
+                self.finish(started, recipients, size)
+                await self.reply(writer, '250 queued')
+            elif verb == 'bdat':
+                parts = command.split()
+                size = int(parts[1])
+                await reader.readexactly(size)
+                chunks += size
+                if len(parts) > 2 and parts[2].lower() == 'last':
+                    self.finish(started, recipients, chunks)
+                    chunks = 0
+                    await self.reply(writer, '250 queued')
+                else:
+                    await self.reply(writer, '250 chunk ok')
+            elif verb == 'quit':
+                await self.reply(writer, '221 bye')
+                return
+            else:
+                await self.reply(writer, '250 ok')
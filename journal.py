@@ -0,0 +1,136 @@
+import json
+import os
+import time
+
+
+class Journal:
+    """
+    Журнал рассылки: по записи JSON на строку о каждой обработанной
+    группе получателей. Записи сбрасываются в файл сразу, а fsync
+    выполняется группами — раз в commit_every записей или commit_interval
+    секунд. Когда записей становится больше compact_every, журнал
+    заменяется одним снимком состояния.
+    """
+    def __init__(self, path: str, commit_every: int = 10,
+                 commit_interval: float = 1.0,
+                 compact_every: int = 10000) -> None:
+        self.path = path
+        self.commit_every = commit_every
+        self.commit_interval = commit_interval
+        self.compact_every = compact_every
+        self.file = None
+        self.pending = 0
+        self.records = 0
+        self.committed = time.monotonic()
+
+    def load(self, start: int, end: int) -> tuple:
+        """
+        Восстанавливаем состояние из журнала: позицию, завершённые не по
+        порядку группы, уже отправленные адреса незавершённых окон и
+        получателей для повторной отправки.
+        """
+        position, finished, partial, retry = start, {}, {}, []
+        try:
+            with open(self.path, 'r') as f:
+                lines = f.read().split('\n')
+        except OSError:
+            lines = []
+
+        for line in lines:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            kind = record.get('t')
+            if kind == 'snapshot':
+                if record['start'] != start or record['end'] != end:
+                    position, finished, partial, retry = start, {}, {}, []
+                    break
+                position = record['position']
+                finished = {int(k): v for k, v in record['finished'].items()}
+                partial = {int(k): set(v)
+                           for k, v in record.get('partial', {}).items()}
+                retry = record['retry']
+            elif kind == 'done':
+                finished[record['s']] = record['e']
+                partial.pop(record['s'], None)
+                retry.extend(record['f'])
+            elif kind == 'part':
+                partial.setdefault(record['s'], set()).update(record['i'])
+                retry.extend(record['f'])
+            elif kind in ('retry', 'bounce') and record.get('ok', True) \
+                    and record['r'] in retry:
+                retry.remove(record['r'])
+
+        while position in finished:
+            position = finished.pop(position)
+        partial = {k: v for k, v in partial.items() if k >= position}
+        self.compact(start, end, position, finished, retry, partial)
+        return position, finished, partial, retry
+
+    def append(self, record: dict) -> None:
+        self.file.write(json.dumps(record, separators=(',', ':')) + '\n')
+        self.file.flush()
+        self.pending += 1
+        self.records += 1
+        if self.pending >= self.commit_every or \
+                time.monotonic() - self.committed >= self.commit_interval:
+            self.commit()
+
+    def done(self, start: int, end: int, failed: list) -> None:
+        """Записываем, что группа обработана, и кому отправить не удалось."""
+        self.append({'t': 'done', 's': start, 'e': end, 'f': failed})
+
+    def part(self, start: int, indices: list, failed: list) -> None:
+        """
+        Записываем, каким адресам окна, начинающегося с start, письмо
+        уже ушло.
+        """
+        self.append({'t': 'part', 's': start, 'i': indices, 'f': failed})
+
+    def retried(self, recipient: str, ok: bool) -> None:
+        self.append({'t': 'retry', 'r': recipient, 'ok': ok})
+
+    def bounced(self, recipient: str) -> None:
+        """Записываем, что адрес окончательно исключён из повторов."""
+        self.append({'t': 'bounce', 'r': recipient})
+
+    def commit(self) -> None:
+        """Сбрасываем накопленные записи на диск."""
+        if self.pending:
+            os.fsync(self.file.fileno())
+        self.pending = 0
+        self.committed = time.monotonic()
+
+    def should_compact(self) -> bool:
+        return self.records >= self.compact_every
+
+    def compact(self, start: int, end: int, position: int,
+                finished: dict, retry: list, partial: dict = None) -> None:
+        """Заменяем журнал одним снимком текущего состояния."""
+        partial = {k: sorted(v) for k, v in (partial or {}).items()}
+        if self.file is not None:
+            self.file.close()
+        temporary = self.path + '.tmp'
+        with open(temporary, 'w') as f:
+            f.write(json.dumps({'t': 'snapshot', 'start': start, 'end': end,
+                                'position': position, 'finished': finished,
+                                'partial': partial, 'retry': retry}) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, self.path)
+        self.file = open(self.path, 'a')
+        self.pending = 0
+        self.records = 0
+
+    def close(self, remove: bool = False) -> None:
+        if self.file is None:
+            return
+        self.commit()
+        self.file.close()
+        self.file = None
+        if remove:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
@@ -0,0 +1,83 @@
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import threading
+
+LOGGERS = ('Client', 'Server')
+
+lock = threading.Lock()
+configured_pid = None
+listener = None
+handler = None
+
+
+class SampleFilter(logging.Filter):
+    """
+    Пропускаем записи уровня INFO с вероятностью rate, чтобы подробный
+    журнал длинной рассылки не замедлял её. Предупреждения и ошибки
+    проходят всегда.
+    """
+    def __init__(self, rate: float = 1.0) -> None:
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return record.levelno > logging.INFO or self.rate >= 1 or \
+            random.random() < self.rate
+
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """
+    Кладёт запись в очередь как есть: сообщение форматируется уже в
+    потоке QueueListener, а не в потоке, который отправляет письма.
+    """
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+def setup(verbose: bool = False, sample: float = 1.0,
+          stream=None) -> None:
+    """
+    Настраиваем логгеры Client и Server для процесса: один обработчик с
+    очередью и фоновый поток, который пишет записи в stream (по умолчанию
+    stderr). Повторный вызов только меняет уровень и долю записей.
+    """
+    global configured_pid, listener, handler
+    with lock:
+        if configured_pid != os.getpid():
+            output = logging.StreamHandler(stream)
+            output.setFormatter(logging.Formatter('[{name}]: {message}\n',
+                                                  style='{'))
+            records = queue.Queue()
+            for name in LOGGERS:
+                logger = logging.getLogger(name)
+                if handler is not None:
+                    logger.removeHandler(handler)
+            handler = LazyQueueHandler(records)
+            listener = logging.handlers.QueueListener(records, output)
+            listener.start()
+            configured_pid = os.getpid()
+            for name in LOGGERS:
+                logging.getLogger(name).addHandler(handler)
+            atexit.register(stop)
+
+        handler.filters = [SampleFilter(sample)] if verbose else []
+        for name in LOGGERS:
+            logging.getLogger(name).setLevel(logging.INFO if verbose
+                                             else logging.WARN)
+
+
+def configured() -> bool:
+    return configured_pid == os.getpid()
+
+
+def stop() -> None:
+    """Дописываем оставшиеся в очереди записи и останавливаем поток."""
+    global configured_pid
+    with lock:
+        if listener is not None and configured_pid == os.getpid():
+            listener.stop()
+            configured_pid = None
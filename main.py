@@ -1,13 +1,18 @@
 from argparser import Parser
+import logs
 from simple import run
-from batch import BatchSender
+from batch import BatchSender, ShardedSender
 
 
 def main() -> None:
     try:
         parser = Parser()
         args = parser.parse()
-        if args.batch:
+        logs.setup(args.verbose, args.log_sample)
+        if args.batch and args.processes > 1:
+            sender = ShardedSender(args.batch, args)
+            sender.broadcast()
+        elif args.batch:
             sender = BatchSender(args.batch, args)
             sender.broadcast()
         else:
@@ -0,0 +1,126 @@
+from contextlib import contextmanager
+import bisect
+import json
+import os
+import threading
+import time
+
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1,
+           2.5, 5, 10, 30, 60)
+
+
+class Histogram:
+    """Распределение длительностей по корзинам, как в Prometheus."""
+    def __init__(self, buckets: tuple = BUCKETS) -> None:
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, fraction: float) -> float:
+        """Верхняя граница корзины, в которую попадает квантиль."""
+        rank = fraction * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+    def to_dict(self) -> dict:
+        return {'count': self.count, 'sum': round(self.sum, 6),
+                'p50': self.quantile(0.5), 'p99': self.quantile(0.99),
+                'buckets': dict(zip([str(b) for b in self.buckets] + ['+Inf'],
+                                    self.counts))}
+
+
+class Metrics:
+    """
+    Счётчики и гистограммы длительностей этапов SMTP: подключения,
+    приветствия, EHLO, TLS, AUTH, MAIL, каждого RCPT, передачи письма и
+    ожидания итогового ответа. Подписчики получают каждое наблюдение
+    вызовом callback(name, value).
+    """
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+        self.callbacks = []
+
+    def subscribe(self, callback) -> None:
+        self.callbacks.append(callback)
+
+    def unsubscribe(self, callback) -> None:
+        self.callbacks.remove(callback)
+
+    def observe(self, phase: str, seconds: float) -> None:
+        with self.lock:
+            if phase not in self.histograms:
+                self.histograms[phase] = Histogram()
+            self.histograms[phase].observe(seconds)
+        for callback in self.callbacks:
+            callback(phase, seconds)
+
+    def count(self, name: str, value: int = 1) -> None:
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+        for callback in self.callbacks:
+            callback(name, value)
+
+    @contextmanager
+    def timer(self, phase: str):
+        """Замеряем этап; если он завершился ошибкой, замер не учитывается."""
+        started = time.perf_counter()
+        yield
+        self.observe(phase, time.perf_counter() - started)
+
+    def to_dict(self) -> dict:
+        with self.lock:
+            return {'counters': dict(self.counters),
+                    'phases': {phase: histogram.to_dict() for phase, histogram
+                               in self.histograms.items()}}
+
+    def to_prometheus(self) -> str:
+        """Формируем текстовый формат экспорта Prometheus."""
+        lines = []
+        with self.lock:
+            for name, value in sorted(self.counters.items()):
+                metric, _, label = name.partition(':')
+                labels = '{{code="{}"}}'.format(label) if label else ''
+                lines.append('smtp_{}_total{} {}'.format(metric, labels,
+                                                         value))
+            for phase, histogram in sorted(self.histograms.items()):
+                seen = 0
+                bounds = [str(b) for b in histogram.buckets] + ['+Inf']
+                for bound, count in zip(bounds, histogram.counts):
+                    seen += count
+                    lines.append('smtp_phase_seconds_bucket{{phase="{}",'
+                                 'le="{}"}} {}'.format(phase, bound, seen))
+                lines.append('smtp_phase_seconds_sum{{phase="{}"}} '
+                             '{}'.format(phase, round(histogram.sum, 6)))
+                lines.append('smtp_phase_seconds_count{{phase="{}"}} '
+                             '{}'.format(phase, histogram.count))
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, path: str) -> None:
+        """
+        Записываем метрики в файл: для .prom и .txt в формате Prometheus,
+        иначе в JSON. Файл заменяется целиком, чтобы читатели не видели
+        его недописанным.
+        """
+        if path.endswith(('.prom', '.txt')):
+            content = self.to_prometheus()
+        else:
+            content = json.dumps(self.to_dict(), indent=2, sort_keys=True)
+        temporary = path + '.tmp'
+        with open(temporary, 'w') as f:
+            f.write(content)
+        os.replace(temporary, path)
+
+
+metrics = Metrics()
@@ -0,0 +1,42 @@
+import threading
+
+WINDOW = 1000
+TOO_MANY_RECIPIENTS = 452
+
+
+class RecipientPlanner:
+    """
+    Раскладывает получателей по транзакциям: адреса одного домена идут
+    подряд, а в каждой транзакции не больше limit получателей. Предел
+    уменьшается, если сервер отвечает 452 на часть команд RCPT TO.
+    """
+    def __init__(self, limit: int = 15, window: int = WINDOW) -> None:
+        self.limit = max(limit, 1)
+        self.window = window
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def domain(entry: tuple) -> str:
+        return entry[1].rpartition('@')[2].lower()
+
+    def plan(self, entries: list) -> list:
+        """Делим пары (номер, адрес) на группы для отдельных писем."""
+        entries = sorted(entries, key=self.domain)
+        limit = self.limit
+        return [entries[i:i + limit] for i in range(0, len(entries), limit)]
+
+    def learn(self, accepted: int) -> None:
+        """Запоминаем, сколько получателей сервер принял в одной транзакции."""
+        with self.lock:
+            if 0 < accepted < self.limit:
+                self.limit = accepted
+
+    @staticmethod
+    def deferred(recipients: list, rejected: dict) -> list:
+        """
+        Получатели, которых сервер просил отправить отдельной
+        транзакцией.
+        """
+        return [r for r in recipients
+                if getattr(rejected.get(r), 'code', None) ==
+                TOO_MANY_RECIPIENTS]
@@ -0,0 +1,101 @@
+from argparse import Namespace
+from session import Session
+import threading
+import time
+
+NOOP_AFTER = 5
+
+
+class SessionPool:
+    """Пул авторизованных сессий для каждой тройки (сервер, порт, логин)."""
+    def __init__(self, max_size: int = 4, idle_timeout: float = 60,
+                 max_messages: int = 100,
+                 noop_after: float = NOOP_AFTER) -> None:
+        self.max_size = max(max_size, 1)
+        self.idle_timeout = idle_timeout
+        self.noop_after = noop_after
+        self.max_messages = max_messages
+
+        self.idle = {}
+        self.total = {}
+        self.lock = threading.Condition()
+
+    @staticmethod
+    def key(args: Namespace) -> tuple:
+        return args.host, args.port, args.login
+
+    def borrow(self, args: Namespace) -> Session:
+        """
+        Выдаём живую сессию, при необходимости создавая новую. Сессию,
+        простоявшую дольше noop_after секунд, проверяем командой NOOP;
+        недавно возвращённую выдаём сразу.
+        """
+        self.prune()
+        key = self.key(args)
+        while True:
+            with self.lock:
+                idle = self.idle.setdefault(key, [])
+                while not idle and self.total.get(key, 0) >= self.max_size:
+                    self.lock.wait()
+                if idle:
+                    session, last_used = idle.pop()
+                else:
+                    self.total[key] = self.total.get(key, 0) + 1
+                    return Session(args, self.max_messages)
+
+            idle_for = time.monotonic() - last_used
+            if idle_for > self.idle_timeout:
+                session.quit()
+            elif idle_for <= self.noop_after or session.alive():
+                return session
+            self.discard(key)
+
+    def give_back(self, session: Session, error: Exception = None) -> None:
+        """
+        Возвращаем сессию в пул. После ответов 4xx и обрывов связи сессия
+        закрывается и в пул не попадает.
+        """
+        key = self.key(session.args)
+        if error is not None:
+            session.fail(error)
+            code = getattr(error, 'code', None)
+            if code is not None and 400 <= code < 500:
+                session.quit()
+        if not session.connected:
+            self.discard(key)
+            return
+        with self.lock:
+            self.idle.setdefault(key, []).append((session, time.monotonic()))
+            self.lock.notify()
+
+    def discard(self, key: tuple) -> None:
+        with self.lock:
+            self.total[key] -= 1
+            self.lock.notify()
+
+    def prune(self) -> None:
+        """Закрываем сессии, простоявшие дольше idle_timeout."""
+        now = time.monotonic()
+        expired = []
+        with self.lock:
+            for key, idle in self.idle.items():
+                keep = []
+                for session, last_used in idle:
+                    if now - last_used > self.idle_timeout:
+                        expired.append(session)
+                        self.total[key] -= 1
+                    else:
+                        keep.append((session, last_used))
+                idle[:] = keep
+        for session in expired:
+            session.quit()
+
+    def close(self) -> None:
+        """Закрываем все свободные сессии."""
+        with self.lock:
+            sessions = [s for idle in self.idle.values() for s, _ in idle]
+            for key, idle in self.idle.items():
+                self.total[key] -= len(idle)
+                idle.clear()
+        for session in sessions:
+            session.quit()
@@ -0,0 +1,161 @@
+from hashlib import blake2b
+import math
+import mmap
+import os
+import re
+import struct
+
+HEADER = struct.Struct('<8sQQQ')
+OFFSET = struct.Struct('<Q')
+MAGIC = b'RCPTIDX1'
+READ_BLOCK = 1048576
+
+ADDRESS = re.compile(rb'[^@\s<>,;]+@[^@\s<>,;.][^@\s<>,;]*')
+
+
+def normalize(line: bytes):
+    """Возвращаем адрес с доменом в нижнем регистре или None."""
+    address = line.strip()
+    if not ADDRESS.fullmatch(address):
+        return None
+    local, _, domain = address.rpartition(b'@')
+    return local + b'@' + domain.lower()
+
+
+class BloomFilter:
+    """
+    Фильтр Блума: память фиксирована, ложные срабатывания случаются с
+    частотой error.
+    """
+    def __init__(self, expected: int, error: float = 1e-6) -> None:
+        expected = max(expected, 1)
+        self.size = max(int(-expected * math.log(error) / math.log(2) ** 2),
+                        8)
+        self.hashes = max(int(round(self.size / expected * math.log(2))), 1)
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def add(self, item: bytes) -> bool:
+        """Добавляем элемент; возвращаем True, если он, видимо, уже был."""
+        digest = blake2b(item, digest_size=16).digest()
+        first = int.from_bytes(digest[:8], 'little')
+        second = int.from_bytes(digest[8:], 'little') | 1
+        present = True
+        for i in range(self.hashes):
+            bit = (first + i * second) % self.size
+            byte, mask = bit >> 3, 1 << (bit & 7)
+            if not self.bits[byte] & mask:
+                present = False
+                self.bits[byte] |= mask
+        return present
+
+
+def count_lines(path: str) -> int:
+    """Считаем строки файла, читая его крупными блоками."""
+    lines = 0
+    last = b'\n'
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(READ_BLOCK)
+            if not block:
+                break
+            lines += block.count(b'\n')
+            last = block[-1:]
+    return lines + (last != b'\n')
+
+
+class RecipientIndex:
+    """
+    Индекс файла получателей: проверенные, нормализованные адреса без
+    повторов в файле .rcpt и смещения каждого из них в файле .idx. Индекс
+    строится за один проход и перестраивается, если исходный файл изменился.
+    """
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.addresses_path = path + '.rcpt'
+        self.index_path = path + '.idx'
+        self.addresses = None
+        self.offsets = None
+        self.count = 0
+        self.skipped = 0
+        self.duplicates = 0
+
+    @classmethod
+    def open(cls, path: str, error: float = 1e-6) -> 'RecipientIndex':
+        index = cls(path)
+        if not index.fresh():
+            index.build(error)
+        index.load()
+        return index
+
+    def fresh(self) -> bool:
+        stat = os.stat(self.path)
+        try:
+            with open(self.index_path, 'rb') as f:
+                magic, size, mtime, _ = HEADER.unpack(f.read(HEADER.size))
+        except (OSError, struct.error):
+            return False
+        return magic == MAGIC and size == stat.st_size and \
+            mtime == stat.st_mtime_ns and \
+            os.path.exists(self.addresses_path)
+
+    def build(self, error: float = 1e-6) -> None:
+        """
+        Проходим по файлу и записываем индекс. Фильтр повторов строится
+        по числу строк, которое считаем отдельным быстрым проходом.
+        """
+        stat = os.stat(self.path)
+        seen = BloomFilter(count_lines(self.path), error)
+        count = position = 0
+        temporary = self.index_path + '.tmp'
+        with open(self.path, 'rb') as source, \
+                open(self.addresses_path, 'wb') as addresses, \
+                open(temporary, 'wb') as index:
+            index.write(HEADER.pack(MAGIC, stat.st_size,
+                                    stat.st_mtime_ns, 0))
+            for line in source:
+                address = normalize(line)
+                if address is None:
+                    if line.strip():
+                        self.skipped += 1
+                    continue
+                if seen.add(address):
+                    self.duplicates += 1
+                    continue
+                index.write(OFFSET.pack(position))
+                addresses.write(address + b'\n')
+                position += len(address) + 1
+                count += 1
+            index.write(OFFSET.pack(position))
+            index.seek(0)
+            index.write(HEADER.pack(MAGIC, stat.st_size,
+                                    stat.st_mtime_ns, count))
+        os.replace(temporary, self.index_path)
+
+    def load(self) -> None:
+        with open(self.index_path, 'rb') as f:
+            self.offsets = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.count = HEADER.unpack_from(self.offsets)[3]
+        self.addresses = open(self.addresses_path, 'rb')
+
+    def offset(self, i: int) -> int:
+        return OFFSET.unpack_from(self.offsets,
+                                  HEADER.size + i * OFFSET.size)[0]
+
+    def read(self, start: int, end: int) -> list:
+        """Возвращаем адреса с номерами от start до end."""
+        end = min(end, self.count)
+        if start >= end:
+            return []
+        first = self.offset(start)
+        self.addresses.seek(first)
+        data = self.addresses.read(self.offset(end) - first)
+        return data.decode('utf-8').split('\n')[:-1]
+
+    def __len__(self) -> int:
+        return self.count
+
+    def close(self) -> None:
+        if self.addresses is not None:
+            self.addresses.close()
+        if self.offsets is not None:
+            self.offsets.close()
@@ -0,0 +1,91 @@
+import heapq
+import itertools
+import random
+import threading
+import time
+
+
+class RetryQueue:
+    """
+    Очередь отложенных повторов, упорядоченная по времени следующей
+    попытки. Временные ошибки (4xx и обрывы связи) откладываются с
+    экспоненциально растущей паузой со случайным разбросом, постоянные
+    (5xx) и слишком старые попадают в список отказов.
+    """
+    def __init__(self, base_delay: float = 60, max_delay: float = 3600,
+                 max_age: float = 86400, jitter: float = 0.5) -> None:
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_age = max_age
+        self.jitter = jitter
+        self.heap = []
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+        self.bounces = []
+
+    @staticmethod
+    def permanent(error: Exception) -> bool:
+        code = getattr(error, 'code', None)
+        return code is not None and 500 <= code < 600
+
+    def schedule(self, recipient: str, attempts: int = 0,
+                 first_failed: float = None, delay: float = 0) -> None:
+        now = time.time()
+        entry = (now + delay, next(self.counter), recipient,
+                 attempts, now if first_failed is None else first_failed)
+        with self.lock:
+            heapq.heappush(self.heap, entry)
+
+    def fail(self, recipient: str, error: Exception, attempts: int = 0,
+             first_failed: float = None) -> bool:
+        """
+        Учитываем неудачную попытку. Возвращаем True, если адрес снова
+        поставлен в очередь, и False, если он попал в отказы.
+        """
+        now = time.time()
+        first_failed = now if first_failed is None else first_failed
+        if self.permanent(error):
+            reason = getattr(error, 'message', error)
+        elif now - first_failed >= self.max_age:
+            reason = 'Gave up after {} attempts: {}'.format(
+                attempts + 1, getattr(error, 'message', error))
+        else:
+            delay = min(self.max_delay, self.base_delay * 2 ** attempts)
+            delay *= random.uniform(1 - self.jitter, 1)
+            self.schedule(recipient, attempts + 1, first_failed, delay)
+            return True
+        with self.lock:
+            self.bounces.append((recipient, reason))
+        return False
+
+    def take_bounces(self) -> list:
+        """Забираем накопившиеся отказы вместе с причинами."""
+        with self.lock:
+            bounces, self.bounces = self.bounces, []
+        return bounces
+
+    def due(self) -> list:
+        """Забираем из очереди все адреса, время которых уже наступило."""
+        now = time.time()
+        ready = []
+        with self.lock:
+            while self.heap and self.heap[0][0] <= now:
+                _, _, recipient, attempts, first_failed = \
+                    heapq.heappop(self.heap)
+                ready.append((recipient, attempts, first_failed))
+        return ready
+
+    def wait_time(self) -> float:
+        """Сколько секунд осталось до ближайшего повтора."""
+        with self.lock:
+            if not self.heap:
+                return 0
+            return max(self.heap[0][0] - time.time(), 0)
+
+    def pending(self) -> list:
+        with self.lock:
+            return [entry[2] for entry in self.heap]
+
+    def __len__(self) -> int:
+        with self.lock:
+            return len(self.heap)
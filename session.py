@@ -0,0 +1,83 @@
+from argparse import Namespace
+from smtp import SMTP, SMTPException
+
+
+class Session:
+    """Авторизованное соединение, через которое отправляется много писем."""
+    def __init__(self, args: Namespace, limit: int = 0) -> None:
+        self.args = args
+        self.limit = limit
+        self.smtp = SMTP(args.verbose,
+                         verify=not getattr(args, 'insecure', False))
+        self.implicit_tls = getattr(args, 'ssl', False) or args.port == 465
+        self.connected = False
+        self.in_transaction = False
+        self.sent = 0
+
+    def open(self) -> None:
+        """Подключаемся, шифруем соединение и авторизуемся."""
+        self.smtp.connect(self.args.host, self.args.port, self.implicit_tls)
+        self.smtp.hello()
+        if self.args.no_ssl is not True and not self.implicit_tls:
+            self.smtp.encrypt()
+        self.smtp.authorize(self.args.login, self.args.password)
+        self.connected = True
+        self.in_transaction = False
+        self.sent = 0
+
+    def acquire(self) -> SMTP:
+        """Возвращаем клиент, готовый к новой транзакции."""
+        if self.connected and self.limit and self.sent >= self.limit:
+            self.quit()
+        if self.connected and self.in_transaction:
+            try:
+                self.smtp.reset()
+            except (SMTPException, OSError):
+                self.drop()
+        if not self.connected:
+            self.open()
+        self.in_transaction = True
+        return self.smtp
+
+    def alive(self) -> bool:
+        """Проверяем командой NOOP, что соединение ещё работает."""
+        if not self.connected:
+            return False
+        try:
+            self.smtp.noop()
+        except (SMTPException, OSError):
+            self.drop()
+            return False
+        return True
+
+    def release(self) -> None:
+        """Отмечаем успешную отправку письма."""
+        self.in_transaction = False
+        self.sent += 1
+
+    def fail(self, error: Exception) -> None:
+        """
+        Обрабатываем ошибку транзакции: если сервер ответил кодом, то
+        соединение живо и будет сброшено командой RSET, иначе закрываем его.
+        """
+        if isinstance(error, SMTPException) and error.code is not None \
+                and error.code != 421:
+            return
+        self.drop()
+
+    def drop(self) -> None:
+        """Забываем соединение без вежливого завершения."""
+        self.smtp.close()
+        self.connected = False
+        self.in_transaction = False
+
+    def quit(self) -> None:
+        """Завершаем соединение командой QUIT."""
+        if not self.connected:
+            return
+        try:
+            self.smtp.disconnect()
+        except (SMTPException, OSError):
+            self.smtp.close()
+        self.connected = False
+        self.in_transaction = False
@@ -1,77 +1,159 @@
-from smtp import SMTP, SMTPException
-from zipfile import ZipFile
-from email_builder import Email
+from smtp import SMTPException, MessageTooLarge, capabilities_for
+from pool import SessionPool
+from attachment_cache import AttachmentCache
+from throttle import Throttles
+from zip_stream import ZipStream, READ_BLOCK
+from email_builder import Email, EmailTemplate, encoded_size
 from argparse import Namespace
+import logging
 import os
-
-
-def run(args) -> None:
-    smtp = SMTP(args.verbose)
+import shutil
+import tempfile
+import time
+
+PART_RESERVE = 1024
+
+
+def run(args, pool: SessionPool = None, cache: AttachmentCache = None,
+        templates: dict = None, throttles: Throttles = None,
+        attempts: int = 0) -> dict:
+    own_pool = pool is None
+    if own_pool:
+        pool = SessionPool(max_size=1)
+    if throttles is None:
+        throttles = Throttles.from_args(args)
+    throttle = throttles.get(args.host)
+    client = logging.getLogger('Client')
     args.attachments = []
     attch_parts = []
 
-    open_attachments(args, smtp)
+    open_attachments(args, client)
     open_named_attachments(args)
 
-    if args.zip:
-        zip_attachments(args)
+    spooled = zip_attachments(args) if args.zip else None
 
     if args.max_file_size:
         split_attachments(args, attch_parts)
 
     i = 0
+    failures = 0
+    error = None
+    rejected_all = {}
     without_attch = not args.attachments and not attch_parts
     while args.attachments or attch_parts or without_attch:
+        part = attch_parts[0] if attch_parts else None
+        error = oversized(args, i, part, cache, templates)
+        if error is not None:
+            client.warning(error.message)
+            break
+        throttle.wait(len(args.recipients))
+        session = pool.borrow(args)
         try:
-            smtp.connect(args.host, args.port)
-            smtp.hello()
-            if args.no_ssl is not True:
-                smtp.encrypt()
-            smtp.authorize(args.login, args.password)
-            smtp.mail_from(args.sender)
-            for recipient in args.recipients:
-                smtp.mail_to(recipient)
-
-            email = Email(args.sender, args.recipient, args.name,
-                          cc=set(args.cc),
-                          attachments=set(args.attachments)
-                          if i == 0 else None,
-                          attch_part=attch_parts[0]
-                          if not without_attch else None,
-                          subject=args.subject if i == 0 else
-                          '{} - {}'.format(args.subject, i + 1),
-                          text=args.text if i == 0 else 'Letter continuation.',
-                          encoding=smtp.encoding)
-
-            smtp.send_letter(email.to_string())
-            smtp.disconnect()
+            started = time.monotonic()
+            smtp = session.acquire()
+            size = None
+            with smtp.metrics.timer('render'):
+                if templates is None:
+                    email = build_email(args, i, part, smtp.encoding, cache)
+                    content = email.chunks()
+                    size = email.size()
+                else:
+                    key = (i, smtp.encoding)
+                    if key not in templates:
+                        templates[key] = EmailTemplate(
+                            build_email(args, i, part, smtp.encoding, cache))
+                    headers = templates[key].headers(
+                        args.recipient, {'recipient': args.recipient})
+                    content = templates[key].render(
+                        headers, args.attachments if i == 0 else None)
+                    size = templates[key].size(headers)
+
+            rejected = smtp.send_message(args.sender, args.recipients,
+                                         content, size)
+            for recipient, reason in rejected.items():
+                client.warning('Recipient %s was rejected: %s',
+                               recipient, reason.message)
+            rejected_all.update(rejected)
+            session.release()
+            pool.give_back(session)
+            throttle.success(time.monotonic() - started, rejected)
 
             for file, _ in args.attachments:
                 file.close()
-            if args.zip:
-                os.remove('attachments.zip')
 
             if without_attch:
                 break
 
             i += 1
             args.attachments.clear()
-            attch_parts.pop(0)
+            if attch_parts:
+                attch_parts.pop(0)
 
         except (SMTPException, OSError) as e:
-            smtp.client.warning('An error occurred '
-                                'during the runtime: {}'.format(e.message))
-            smtp.close()
-
-
-def open_attachments(args: Namespace, smtp: SMTP):
+            client.warning('An error occurred during the runtime: '
+                           '{}'.format(getattr(e, 'message', e)))
+            pool.give_back(session, e)
+            delay = throttle.failure(e)
+            failures += 1
+            if attempts and failures >= attempts or \
+                    isinstance(e, MessageTooLarge):
+                error = e
+                break
+            time.sleep(delay)
+
+    if error is not None:
+        for file, _ in args.attachments:
+            file.close()
+    if spooled is not None:
+        os.remove(spooled)
+    if own_pool:
+        pool.close()
+    if error is not None:
+        raise error
+    return rejected_all
+
+
+def build_email(args: Namespace, i: int, part: tuple, encoding: str,
+                cache: AttachmentCache = None) -> Email:
+    return Email(args.sender, args.recipient, args.name,
+                 cc=set(args.cc),
+                 attachments=set(args.attachments) if i == 0 else None,
+                 attch_part=part,
+                 subject=args.subject if i == 0 else
+                 '{} - {}'.format(args.subject, i + 1),
+                 text=args.text if i == 0 else 'Letter continuation.',
+                 encoding=encoding,
+                 streaming=True,
+                 cache=cache)
+
+
+def oversized(args: Namespace, i: int, part: tuple,
+              cache: AttachmentCache = None,
+              templates: dict = None) -> MessageTooLarge:
+    """
+    Проверяем письмо по пределу SIZE, известному с прошлых подключений
+    к серверу, чтобы не подключаться ради заведомо отклонённого письма.
+    Письма из готовых шаблонов уже проверены при первой отправке.
+    """
+    capabilities = capabilities_for(args.host, args.port)
+    if capabilities is None or not capabilities.size:
+        return None
+    if templates and any(key[0] == i for key in templates):
+        return None
+    size = build_email(args, i, part, capabilities.encoding, cache).size()
+    if capabilities.fits(size):
+        return None
+    return MessageTooLarge('Message size {} exceeds server limit '
+                           '{}.'.format(size, capabilities.size), 552)
+
+
+def open_attachments(args: Namespace, client: logging.Logger):
     for f in args.attachment:
         try:
             args.attachments.append((open(f, 'rb'), None))
         except OSError as e:
-            smtp.client.warn('An error occurred while opening '
-                             'the file {}: {}'.format(e.filename,
-                                                      e.strerror))
+            client.warning('An error occurred while opening '
+                           'the file {}: {}'.format(e.filename, e.strerror))
             continue
 
 
@@ -83,26 +165,65 @@ def open_named_attachments(args: Namespace):
             continue
 
 
-def zip_attachments(args: Namespace):
-    with ZipFile('attachments.zip', 'w') as zip_file:
-        for f, _ in args.attachments:
-            zip_file.write(f.name)
-
+def zip_attachments(args: Namespace) -> str:
+    """
+    Заменяем вложения одним zip-архивом, который собирается в памяти по
+    мере отправки. Если архив потом придётся делить на части, он
+    сохраняется во временный файл; возвращаем путь к нему.
+    """
+    paths = [f.name for f, _ in args.attachments]
+    for f, _ in args.attachments:
+        f.close()
     args.attachments.clear()
-    args.attachments.append((open('attachments.zip', 'rb'), None))
+    archive = ZipStream(paths)
+    if not args.max_file_size:
+        args.attachments.append((archive, None))
+        return None
+
+    with tempfile.NamedTemporaryFile(prefix='attachments-', suffix='.zip',
+                                     delete=False) as f:
+        shutil.copyfileobj(archive, f, READ_BLOCK)
+    args.attachments.append((open(f.name, 'rb'), ZipStream.name))
+    return f.name
+
+
+def part_size(max_size: int) -> int:
+    """
+    Наибольшая часть файла, которая после кодирования в base64 со
+    строками по 76 символов и CRLF займёт не больше max_size байт.
+    """
+    return max(max_size // 78, 1) * 57
+
+
+def part_overhead(args: Namespace, path: str) -> int:
+    """
+    Размер письма с пустой частью файла path: заголовки, текст и
+    заголовок вложения. PART_RESERVE оставляем на адреса получателей и
+    дату, которые у каждого письма свои.
+    """
+    return max(build_email(args, i, (path, 0, 0), 'utf-8').size()
+               for i in (0, 1)) + PART_RESERVE
 
 
 def split_attachments(args: Namespace, attch_parts: list):
+    """
+    Заменяем файлы, которые не помещаются в письмо, описаниями частей
+    (путь, смещение, длина). Сами данные читаются при отправке части.
+    Каждое письмо с частью вместе с заголовками не больше max_file_size.
+    """
+    if args.max_file_size <= 0:
+        return
     big_files = []
     for file in args.attachments:
-        if os.path.getsize(file[0].name) > args.max_file_size > 0:
+        length = os.fstat(file[0].fileno()).st_size
+        overhead = part_overhead(args, file[0].name)
+        if encoded_size(length) + overhead > args.max_file_size:
+            size = part_size(max(args.max_file_size - overhead, 1))
             big_files.append(file)
-            part = file[0].read(args.max_file_size)
-            attch_parts.append((file[0].name, part))
-            while part != b'':
-                part = file[0].read(args.max_file_size)
-                attch_parts.append((file[0].name, part))
-            attch_parts.pop()
+            attch_parts.extend((file[0].name, offset,
+                                min(size, length - offset))
+                               for offset in range(0, length, size))
 
     for file in big_files:
         args.attachments.remove(file)
+        file[0].close()
@@ -1,41 +1,182 @@
+from contextlib import contextmanager
 import base64
 import socket
 import ssl
 import logging
+import logs
+import re
+import threading
+import time
+from metrics import metrics as default_metrics
+
+
+CHUNK_SIZE = 65536
+BDAT_CHUNK_SIZE = 1048576
+IOV_MAX = 1024
+UNCLEAN = re.compile(rb'\r(?!\n)|(?<!\r)\n|\n\.')
+
+tls_lock = threading.Lock()
+tls_contexts = {}
+tls_sessions = {}
+known_capabilities = {}
+
+
+def tls_context(host: str, verify: bool = True) -> ssl.SSLContext:
+    """
+    Возвращаем общий для процесса контекст TLS для сервера, чтобы не
+    создавать его и не загружать сертификаты при каждом подключении.
+    """
+    with tls_lock:
+        key = (host, verify)
+        if key not in tls_contexts:
+            context = ssl.create_default_context()
+            if not verify:
+                context.check_hostname = False
+                context.verify_mode = ssl.CERT_NONE
+            tls_contexts[key] = context
+        return tls_contexts[key]
 
 
 class SMTPException(Exception):
     """Основной класс исключений."""
-    def __init__(self, message) -> None:
+    def __init__(self, message, code: int = None) -> None:
         self.message = message
+        self.code = code
+
+
+class Reply:
+    """Разобранный ответ сервера: код и все строки ответа."""
+    def __init__(self, lines: list) -> None:
+        self.raw = b''.join(lines)
+        self.lines = [line[4:].rstrip(b'\r\n') for line in lines]
+        code = lines[-1][:3]
+        self.code = int(code) if code.isdigit() else None
+
+    def startswith(self, prefix: bytes) -> bool:
+        return self.raw.startswith(prefix)
+
+    def __str__(self) -> str:
+        """Текст ответа для журнала; строится, только если запись выводится."""
+        return self.raw.decode('utf-8', 'replace').rstrip('\r\n')
+
+
+class MessageTooLarge(SMTPException):
+    """Письмо больше, чем сервер согласен принять по расширению SIZE."""
+
+
+class MessageRejected(SMTPException):
+    """
+    Сервер отклонил получателей или само письмо в ответ на RCPT, DATA
+    или его содержимое. В отличие от ошибок подключения, EHLO, AUTH и
+    MAIL FROM, такой ответ относится к получателям; в rejected — ответы
+    для каждого из них, если они известны.
+    """
+    def __init__(self, message, code: int = None,
+                 rejected: dict = None) -> None:
+        super().__init__(message, code)
+        self.rejected = rejected or {}
+
+
+class Capabilities:
+    """
+    Возможности сервера из ответа на EHLO: ключевые слова расширений и их
+    параметры.
+    """
+    def __init__(self, extensions: dict = None) -> None:
+        self.extensions = dict(extensions or {})
+
+    @classmethod
+    def parse(cls, lines: list) -> 'Capabilities':
+        """Разбираем строки ответа на EHLO, кроме первой с именем сервера."""
+        extensions = {}
+        for line in lines[1:]:
+            line = line.decode('ascii', 'replace')
+            keyword, _, params = line.partition(' ')
+            extensions[keyword.upper()] = params
+        return cls(extensions)
+
+    def has(self, name: str) -> bool:
+        return name.upper() in self.extensions
+
+    @property
+    def size(self) -> int:
+        """Наибольший размер письма в байтах, 0 — предел не объявлен."""
+        size = self.extensions.get('SIZE', '').strip()
+        return int(size) if size.isdigit() else 0
+
+    @property
+    def auth(self) -> set:
+        """Механизмы авторизации, объявленные сервером."""
+        return set(self.extensions.get('AUTH', '').upper().split())
+
+    @property
+    def pipelining(self) -> bool:
+        return self.has('PIPELINING')
+
+    @property
+    def chunking(self) -> bool:
+        return self.has('CHUNKING')
+
+    @property
+    def eightbitmime(self) -> bool:
+        return self.has('8BITMIME')
+
+    @property
+    def smtputf8(self) -> bool:
+        return self.has('SMTPUTF8')
+
+    @property
+    def starttls(self) -> bool:
+        return self.has('STARTTLS')
+
+    @property
+    def encoding(self) -> str:
+        return 'utf-8' if self.smtputf8 else 'ascii'
+
+    @property
+    def recipient_limit(self) -> int:
+        """Предел получателей в одной транзакции из LIMITS RCPTMAX=."""
+        for param in self.extensions.get('LIMITS', '').split():
+            name, _, value = param.partition('=')
+            if name.upper() == 'RCPTMAX' and value.isdigit():
+                return int(value)
+        return 0
+
+    def fits(self, size: int) -> bool:
+        """Проверяем, что письмо размером size не превышает SIZE."""
+        return not self.size or size <= self.size
+
+
+def capabilities_for(host: str, port: int) -> Capabilities:
+    """Возможности сервера по последнему EHLO в этом процессе или None."""
+    with tls_lock:
+        return known_capabilities.get((host, port))
 
 
 class SMTP:
     """Класс для общения с сервером и отправки писем."""
-    def __init__(self, verbose=False) -> None:
+    def __init__(self, verbose=False, verify: bool = True,
+                 metrics=None) -> None:
         """Инициализируем клиент."""
         self.sock = socket.socket()
         self.enc_sock = None
+        self.host = None
+        self.port = None
+        self.verify = verify
         self.encrypted = False
+        self.greeted = False
+        self.authorized = False
+        self.buffer = bytearray()
+        self.capabilities = Capabilities()
         self.sock.settimeout(10)
         self.retries = 3
         self.encoding = 'ascii'
+        self.metrics = default_metrics if metrics is None else metrics
 
+        if not logs.configured():
+            logs.setup(verbose)
         self.client = logging.getLogger('Client')
         self.server = logging.getLogger('Server')
-        self.client.setLevel(logging.INFO)
-        self.server.setLevel(logging.INFO)
-
-        log_handler = logging.StreamHandler()
-        if verbose:
-            log_handler.setLevel(logging.INFO)
-        else:
-            log_handler.setLevel(logging.WARN)
-        log_fmt = logging.Formatter('[{name}]: {message}\n',
-                                    style='{')
-        log_handler.setFormatter(log_fmt)
-        self.client.addHandler(log_handler)
-        self.server.addHandler(log_handler)
 
         self.client.info('Client initialized.')
 
@@ -44,18 +185,29 @@ class SMTP:
         if self.enc_sock is not None:
             self.enc_sock.close()
 
-    def connect(self, host: str, port: int) -> None:
-        """Подключаемся к серверу."""
+    def connect(self, host: str, port: int,
+                implicit_tls: bool = False) -> None:
+        """
+        Подключаемся к серверу. При implicit_tls (SMTPS, порт 465)
+        шифрование включается сразу, до приветствия сервера.
+        """
         self.client.info('Connecting to server.')
+        self.host = host
+        self.port = port
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         for i in range(self.retries):
             try:
-                self.sock.connect((host, port))
+                with self.metrics.timer('connect'):
+                    self.sock.connect((host, port))
                 self.client.info('Connected successfully.')
             except (socket.timeout, OSError):
-                self.client.info('Attempt {} unsuccessful, '
-                                 'retrying.'.format(i))
+                self.client.info('Attempt %d unsuccessful, retrying.', i)
+                self.metrics.count('retries')
                 continue
             else:
+                if implicit_tls:
+                    with self.metrics.timer('tls'):
+                        self.wrap_socket()
                 return
         raise SMTPException('Server unavailable.')
 
@@ -65,63 +217,165 @@ class SMTP:
             content = content + b'\r\n'
         else:
             content = self.to_bytes(content + '\r\n')
+        self.sendall(content)
 
+    def sendall(self, data) -> None:
+        """Передаём данные в текущий сокет и учитываем их в метриках."""
         if self.encrypted:
-            self.enc_sock.sendall(content)
+            self.enc_sock.sendall(data)
         else:
-            self.sock.sendall(content)
+            self.sock.sendall(data)
+        self.metrics.count('bytes_sent', len(data))
 
-    def receive(self) -> bytes:
-        """Получаем ответ сервера на отправленную команду."""
+    def send_buffers(self, buffers: list) -> None:
+        """
+        Передаём несколько буферов без их склейки. По открытому соединению
+        используем sendmsg, отправляя всё за один системный вызов. Через
+        TLS мелкие буферы склеиваем в блоки до CHUNK_SIZE байт, чтобы
+        каждый не уходил отдельной записью TLS.
+        """
+        if self.encrypted or not hasattr(self.sock, 'sendmsg'):
+            batch = bytearray()
+            for buffer in buffers:
+                if batch and len(batch) + len(buffer) > CHUNK_SIZE:
+                    self.sendall(batch)
+                    batch = bytearray()
+                if len(buffer) >= CHUNK_SIZE:
+                    self.sendall(buffer)
+                else:
+                    batch += buffer
+            if batch:
+                self.sendall(batch)
+            return
+
+        views = [memoryview(b).cast('B') for b in buffers if len(b)]
+        first = 0
+        while first < len(views):
+            sent = self.sock.sendmsg(views[first:first + IOV_MAX])
+            self.metrics.count('bytes_sent', sent)
+            while sent:
+                if sent >= len(views[first]):
+                    sent -= len(views[first])
+                    first += 1
+                else:
+                    views[first] = views[first][sent:]
+                    sent = 0
+
+    def fill(self) -> None:
+        """Дочитываем в буфер очередной блок данных из сокета."""
+        sock = self.enc_sock if self.encrypted else self.sock
         for i in range(self.retries):
             try:
-                answer = b''
-                while not answer.endswith(b'\r\n'):
-                    part = self.enc_sock.recv(1) if self.encrypted \
-                        else self.sock.recv(1)
-                    answer += part
-                self.server.info(answer)
-                return answer
+                part = sock.recv(CHUNK_SIZE)
             except socket.timeout:
+                self.metrics.count('retries')
                 continue
+            if not part:
+                raise SMTPException('Connection closed by server.')
+            self.buffer += part
+            return
         raise SMTPException('Server didn\'t send any response.')
 
+    def read_line(self) -> bytes:
+        """Забираем из буфера одну строку ответа вместе с CRLF."""
+        start = 0
+        while True:
+            end = self.buffer.find(b'\r\n', start)
+            if end >= 0:
+                line = bytes(self.buffer[:end + 2])
+                del self.buffer[:end + 2]
+                return line
+            start = max(len(self.buffer) - 1, 0)
+            self.fill()
+
+    def reply(self) -> Reply:
+        """Получаем полный, возможно многострочный, ответ сервера."""
+        lines = [self.read_line()]
+        while lines[-1][3:4] == b'-':
+            lines.append(self.read_line())
+        reply = Reply(lines)
+        self.metrics.count('replies:{}'.format(reply.code))
+        self.server.info('%s', reply)
+        return reply
+
+    def receive(self) -> bytes:
+        """Получаем ответ сервера на отправленную команду."""
+        return self.reply().raw
+
+    @property
+    def extensions(self) -> dict:
+        return self.capabilities.extensions
+
+    @extensions.setter
+    def extensions(self, extensions: dict) -> None:
+        self.capabilities = Capabilities(extensions)
+
     def hello(self) -> None:
-        """Отправляем команду приветствия."""
+        """
+        Отправляем команду приветствия и запоминаем возможности сервера,
+        в том числе для следующих подключений к нему.
+        """
+        if not self.greeted:
+            with self.metrics.timer('greeting'):
+                self.check_code(b'220')
+            self.greeted = True
         self.client.info('Sending greeting to server.')
-        self.send('ehlo localhost')
-        self.check_code(b'220')
+        with self.metrics.timer('ehlo'):
+            self.send('ehlo localhost')
+            resp = self.check_code(b'250')
+        self.capabilities = Capabilities.parse(resp.lines)
+        self.encoding = self.capabilities.encoding
+        with tls_lock:
+            known_capabilities[(self.host, self.port)] = self.capabilities
+
+    def has_extension(self, name: str) -> bool:
+        """Проверяем, объявил ли сервер расширение в ответе на EHLO."""
+        return self.capabilities.has(name)
+
+    def recipient_limit(self) -> int:
+        return self.capabilities.recipient_limit
 
     def start_tls(self) -> None:
         """Начинаем передачу по защищённому соединению."""
         self.client.info('Sending TLS connection request.')
         self.send('starttls')
-        while True:
-            resp = self.receive()
-            if b'SMTPUTF8' in resp:
-                self.encoding = 'utf-8'
-            if not resp.startswith(b'250'):
-                raise SMTPException('Unable to establish a secure connection.')
-            if resp.startswith(b'250 '):
-                break
-        resp = self.receive()
+        resp = self.reply()
         if not resp.startswith(b'220'):
-            raise SMTPException('Unable to establish a secure connection.')
+            raise SMTPException('Unable to establish a secure connection.',
+                                resp.code)
 
     def wrap_socket(self) -> None:
-        """Оборачиваем сокет в зашифрованный формат."""
-        self.client.info('Secure socket ready.')
-        self.enc_sock = ssl.wrap_socket(self.sock,
-                                        ssl_version=ssl.PROTOCOL_SSLv23)
+        """
+        Оборачиваем сокет в зашифрованный формат. Если с этим сервером
+        уже было соединение, предлагаем возобновить его сессию TLS.
+        """
+        self.buffer.clear()
+        with tls_lock:
+            session = tls_sessions.get((self.host, self.port))
+        self.enc_sock = tls_context(self.host, self.verify).wrap_socket(
+            self.sock, server_hostname=self.host, session=session)
         self.encrypted = True
+        self.remember_session()
+        self.client.info('Secure socket ready%s.',
+                         ' (session resumed)'
+                         if self.enc_sock.session_reused else '')
+
+    def remember_session(self) -> None:
+        """Сохраняем сессию TLS для следующих подключений к серверу."""
+        if self.encrypted and self.enc_sock.session is not None:
+            with tls_lock:
+                tls_sessions[(self.host, self.port)] = self.enc_sock.session
 
     def encrypt(self) -> None:
         """
-        Запрашиваем передачу данных по защищённому соединению и
-        оборачиваем сокет.
+        Запрашиваем передачу данных по защищённому соединению, оборачиваем
+        сокет и заново запрашиваем возможности сервера: полученные до TLS
+        больше не действуют (RFC 3207).
         """
-        self.start_tls()
-        self.wrap_socket()
+        with self.metrics.timer('tls'):
+            self.start_tls()
+            self.wrap_socket()
+        self.hello()
 
     def auth(self) -> None:
         """Запускаем процесс авторизации."""
@@ -132,36 +386,126 @@ class SMTP:
     def login(self, login: str) -> None:
         """Отправляем логин для сервера."""
         self.client.info('Sending login.')
-        self.send(base64.b64encode(self.to_bytes(login)), b64=True)
+        self.send(encode_credential(login, self.encoding), b64=True)
         self.check_code(b'334')
 
     def password(self, password: str) -> None:
         """Отправляем пароль для сервера."""
         self.client.info('Sending password.')
-        self.send(base64.b64encode(self.to_bytes(password)), b64=True)
+        self.send(encode_credential(password, self.encoding), b64=True)
+        self.check_code(b'235')
+
+    def auth_plain(self, login: str, password: str) -> None:
+        """
+        Авторизуемся механизмом PLAIN, передавая логин и пароль сразу в
+        команде AUTH: нужен один обмен с сервером вместо трёх.
+        """
+        self.client.info('Sending plain auth request.')
+        self.send(b'auth plain ' +
+                  plain_credentials(login, password, self.encoding), b64=True)
         self.check_code(b'235')
 
     def authorize(self, login: str, password: str) -> None:
-        """Авторизуемся на севрере."""
-        self.auth()
-        self.login(login)
-        self.password(password)
+        """
+        Авторизуемся на сервере: механизмом PLAIN, если сервер его
+        объявил, иначе LOGIN. Уже авторизованное соединение повторно не
+        авторизуется.
+        """
+        if self.authorized:
+            return
+        with self.metrics.timer('auth'):
+            if 'PLAIN' in self.capabilities.auth:
+                self.auth_plain(login, password)
+            else:
+                self.auth()
+                self.login(login)
+                self.password(password)
+        self.authorized = True
         self.client.info('Authorized successfully.')
 
-    def mail_from(self, sender: str) -> None:
+    def mail_params(self, size: int = None) -> str:
+        """Параметры MAIL FROM: размер письма и 8BITMIME, если объявлены."""
+        params = ''
+        if size is not None and self.capabilities.size:
+            params += ' SIZE={}'.format(size)
+        if self.capabilities.eightbitmime:
+            params += ' BODY=8BITMIME'
+        return params
+
+    def mail_from(self, sender: str, size: int = None) -> None:
         """Отправляем серверу адрес отправителя."""
         self.client.info('Sending sender name.')
-        self.send('mail from: <{}>'.format(sender))
-        resp = self.receive()
-
-        if not resp.startswith(b'250'):
-            raise SMTPException(resp)
+        with self.metrics.timer('mail'):
+            self.send('mail from: <{}>{}'.format(sender,
+                                                 self.mail_params(size)))
+            self.check_code(b'250')
 
     def mail_to(self, recipient: str) -> None:
         """Отправляем серверу адрес получателя."""
         self.client.info('Sending recipient name')
-        self.send('rcpt to: <{}>'.format(recipient))
-        self.check_code(b'250')
+        with self.metrics.timer('rcpt'):
+            self.send('rcpt to: <{}>'.format(recipient))
+            self.check_code(b'250')
+
+    def envelope(self, sender: str, recipients: list,
+                 data: bool = True, size: int = None) -> dict:
+        """
+        Передаём отправителя, получателей и, если нужно, команду DATA.
+        Если сервер поддерживает PIPELINING, все команды уходят одним
+        пакетом. Возвращаем отклонённых получателей вместе с ответами.
+        Получатели сверх объявленного сервером предела не отправляются
+        и возвращаются с кодом 452.
+        """
+        limit = self.recipient_limit()
+        if limit and len(recipients) > limit:
+            rejected = self.envelope(sender, recipients[:limit], data,
+                                     size)
+            for recipient in recipients[limit:]:
+                rejected[recipient] = SMTPException('Too many recipients.',
+                                                    452)
+            return rejected
+
+        if not self.has_extension('PIPELINING'):
+            self.mail_from(sender, size)
+            rejected = {}
+            for recipient in recipients:
+                try:
+                    self.mail_to(recipient)
+                except SMTPException as e:
+                    if e.code is None:
+                        raise
+                    rejected[recipient] = e
+            check_envelope(recipients, rejected)
+            if data:
+                with rejects_message():
+                    self.data()
+            return rejected
+
+        self.client.info('Sending pipelined envelope.')
+        commands = ['mail from: <{}>{}'.format(sender,
+                                               self.mail_params(size))]
+        commands.extend('rcpt to: <{}>'.format(r) for r in recipients)
+        if data:
+            commands.append('data')
+        started = time.perf_counter()
+        self.send('\r\n'.join(commands))
+
+        sender_resp = self.reply()
+        self.metrics.observe('mail', time.perf_counter() - started)
+        replies = []
+        for _ in recipients:
+            replies.append(self.reply())
+            self.metrics.observe('rcpt', time.perf_counter() - started)
+        rejected = rejected_recipients(recipients, replies)
+        data_resp = self.reply() if data else None
+
+        if data and data_resp.startswith(b'354') and \
+                (not sender_resp.startswith(b'250') or
+                 len(rejected) == len(recipients)):
+            self.send('.')
+            self.reply()
+        check_envelope(recipients, rejected, sender_resp, data_resp)
+        return rejected
 
     def data(self) -> None:
         """Начинаем передачу содержимого письма."""
@@ -169,12 +513,102 @@ class SMTP:
         self.send('data')
         self.check_code(b'354')
 
-    def letter(self, content: str) -> None:
-        """Передаём серверу содержимое письма."""
+    def letter(self, content) -> None:
+        """
+        Передаём серверу содержимое письма с CRLF в концах строк,
+        удвоенными точками в начале строк и завершающей точкой. Блоки
+        собираются в пачки по CHUNK_SIZE байт и уходят через send_buffers.
+        """
         self.client.info('Sending the letter.')
-        self.send(content)
-        self.send('.\r\n')
-        self.check_code(b'250')
+        with self.metrics.timer('data'):
+            batch, size = [], 0
+            for piece in normalized(self.body_chunks(content)):
+                batch.append(piece)
+                size += len(piece)
+                if size >= CHUNK_SIZE:
+                    self.send_buffers(batch)
+                    batch, size = [], 0
+            self.send_buffers(batch)
+        with self.metrics.timer('final'):
+            self.check_code(b'250')
+
+    def bdat(self, content) -> None:
+        """
+        Передаём письмо командами BDAT (RFC 3030) блоками по
+        BDAT_CHUNK_SIZE байт. При PIPELINING не ждём ответа на каждый
+        блок, а читаем все ответы в конце. Список буферов уходит одной
+        командой BDAT.
+        """
+        self.client.info('Sending the letter in chunks.')
+        if isinstance(content, list):
+            content = list(normalized(content, terminate=False))
+            size = sum(len(buffer) for buffer in content)
+            command = 'bdat {} last\r\n'.format(size).encode('ascii')
+            with self.metrics.timer('data'):
+                self.send_buffers([command] + content)
+            with self.metrics.timer('final'):
+                self.check_code(b'250')
+            return
+
+        pipelining = self.has_extension('PIPELINING')
+        started = time.perf_counter()
+        pending = 0
+        chunks = chunked(normalized(self.body_chunks(content),
+                                    terminate=False), BDAT_CHUNK_SIZE)
+        chunk = next(chunks, b'')
+        while True:
+            following = next(chunks, None)
+            last = following is None
+            command = 'bdat {}{}\r\n'.format(len(chunk),
+                                             ' last' if last else '')
+            self.send_buffers([command.encode('ascii'), chunk])
+            pending += 1
+            if last:
+                self.metrics.observe('data', time.perf_counter() - started)
+                started = time.perf_counter()
+            if not pipelining or last:
+                self.check_codes(b'250', pending)
+                pending = 0
+            if last:
+                self.metrics.observe('final', time.perf_counter() - started)
+                break
+            chunk = following
+
+    def body_chunks(self, content):
+        """Представляем содержимое письма последовательностью блоков байт."""
+        if isinstance(content, str):
+            return [self.to_bytes(content)]
+        if isinstance(content, (bytes, bytearray, memoryview)) or \
+                hasattr(content, 'read'):
+            return chunked(content, CHUNK_SIZE)
+        return content
+
+    def send_message(self, sender: str, recipients: list, content,
+                     size: int = None) -> dict:
+        """
+        Отправляем письмо целиком: конверт и содержимое. Если сервер
+        поддерживает CHUNKING, используем BDAT, иначе DATA. Письмо больше
+        объявленного в SIZE отклоняем, не начиная транзакцию.
+        """
+        if size is None:
+            size = message_size(content)
+        if size is not None and not self.capabilities.fits(size):
+            raise MessageTooLarge('Message size {} exceeds server limit '
+                                  '{}.'.format(size, self.capabilities.size),
+                                  552)
+        chunking = self.has_extension('CHUNKING')
+        with self.metrics.timer('message'):
+            rejected = self.envelope(sender, recipients, data=not chunking,
+                                     size=size)
+            with rejects_message():
+                if chunking:
+                    self.bdat(content)
+                else:
+                    self.letter(content)
+        self.metrics.count('messages')
+        self.metrics.count('recipients', len(recipients) - len(rejected))
+        self.client.info('Mail sent successfully.')
+        return rejected
 
     def send_letter(self, content: str) -> None:
         """Отправляем письмо."""
@@ -182,22 +616,189 @@ class SMTP:
         self.letter(content)
         self.client.info('Mail sent successfully.')
 
+    def noop(self) -> None:
+        """Проверяем, что сервер всё ещё отвечает."""
+        self.send('noop')
+        self.check_code(b'250')
+
+    def reset(self) -> None:
+        """Сбрасываем текущую транзакцию, не разрывая соединение."""
+        self.client.info('Resetting transaction.')
+        self.send('rset')
+        self.check_code(b'250')
+
     def disconnect(self) -> None:
         """Закрываем соединение."""
         self.client.info('Closing connection.')
         self.send('quit')
+        self.remember_session()
         self.sock.close()
-        self.sock = socket.socket()
-        self.encrypted = False
+        self.close()
 
     def close(self) -> None:
         self.sock = socket.socket()
+        self.sock.settimeout(10)
         self.encrypted = False
+        self.greeted = False
+        self.authorized = False
+        self.buffer.clear()
+        self.capabilities = Capabilities()
 
-    def check_code(self, ok_code: bytes) -> None:
-        resp = self.receive()
+    def check_code(self, ok_code: bytes) -> Reply:
+        resp = self.reply()
         if not resp.startswith(ok_code):
-            raise SMTPException(resp)
+            raise SMTPException(resp.raw, resp.code)
+        return resp
+
+    def check_codes(self, ok_code: bytes, count: int) -> None:
+        """
+        Читаем ответы на count команд, отправленных без ожидания. Ошибку
+        по первому неудачному ответу поднимаем только после того, как
+        прочитаны все: иначе следующая команда получит чужой ответ.
+        """
+        error = None
+        for _ in range(count):
+            resp = self.reply()
+            if error is None and not resp.startswith(ok_code):
+                error = SMTPException(resp.raw, resp.code)
+        if error is not None:
+            raise error
 
     def to_bytes(self, s: str) -> bytes:
         return s.encode(self.encoding)
+
+
+def encode_credential(value: str, encoding: str) -> bytes:
+    """Логин или пароль в base64 для механизма LOGIN."""
+    return base64.b64encode(value.encode(encoding))
+
+
+def plain_credentials(login: str, password: str, encoding: str) -> bytes:
+    """Логин и пароль в base64 для механизма PLAIN (RFC 4616)."""
+    return base64.b64encode(b'\0' + login.encode(encoding) + b'\0' +
+                            password.encode(encoding))
+
+
+def rejected_recipients(recipients: list, replies: list) -> dict:
+    """Сопоставляем получателей с ответами на RCPT и выбираем отклонённых."""
+    return {recipient: SMTPException(resp.raw, resp.code)
+            for recipient, resp in zip(recipients, replies)
+            if not resp.startswith(b'250') and not resp.startswith(b'251')}
+
+
+def check_envelope(recipients: list, rejected: dict, sender_resp=None,
+                   data_resp=None) -> None:
+    """
+    Поднимаем SMTPException, если сервер не принял отправителя, ни
+    одного получателя или команду DATA.
+    """
+    if sender_resp is not None and not sender_resp.startswith(b'250'):
+        raise SMTPException(sender_resp.raw, sender_resp.code)
+    if not recipients:
+        raise SMTPException('No recipients were given.')
+    if len(rejected) == len(recipients):
+        raise MessageRejected('All recipients were rejected.',
+                              rejected[recipients[-1]].code, rejected)
+    if data_resp is not None and not data_resp.startswith(b'354'):
+        raise MessageRejected(data_resp.raw, data_resp.code)
+
+
+@contextmanager
+def rejects_message():
+    """
+    Ответ сервера с кодом ошибки внутри блока относится к письму, а не
+    к соединению: поднимаем его как MessageRejected.
+    """
+    try:
+        yield
+    except MessageRejected:
+        raise
+    except SMTPException as e:
+        if e.code is None:
+            raise
+        raise MessageRejected(e.message, e.code) from e
+
+
+def message_size(content) -> int:
+    """Размер письма в байтах, если его можно узнать не читая источник."""
+    if isinstance(content, str):
+        return len(content.encode('utf-8'))
+    if isinstance(content, (bytes, bytearray, memoryview)):
+        return len(content)
+    if isinstance(content, list):
+        return sum(len(buffer) for buffer in content)
+    return None
+
+
+def normalized(chunks, terminate: bool = True):
+    """
+    Приводим поток блоков письма к виду, которого требует SMTP: строки
+    заканчиваются CRLF, а к строкам, начинающимся с точки, добавляется
+    ещё одна точка (RFC 5321, 4.5.2). Если terminate, в конце выдаём
+    строку из одной точки, иначе только приводим концы строк (для BDAT
+    точки не удваиваются). Блоки, в которых нет одиночных CR и LF и
+    строк с точкой в начале, выдаются как есть, без копирования.
+    """
+    line_start = True
+    carry = b''
+    for chunk in chunks:
+        if not len(chunk):
+            continue
+        if carry:
+            chunk = carry + bytes(chunk)
+            carry = b''
+        if UNCLEAN.search(chunk) is None and \
+                not (terminate and line_start and chunk[0] == 46):
+            yield chunk
+        else:
+            data = bytes(chunk)
+            if data.endswith(b'\r'):
+                carry = b'\r'
+                data = data[:-1]
+            if b'\r' in data:
+                data = data.replace(b'\r\n', b'\n').replace(b'\r', b'\n')
+            data = data.replace(b'\n', b'\r\n')
+            if terminate:
+                data = data.replace(b'\n.', b'\n..')
+                if line_start and data.startswith(b'.'):
+                    data = b'.' + data
+            if not data:
+                continue
+            yield data
+            chunk = data
+        line_start = chunk[-1] == 10
+
+    if carry:
+        yield b'\r\n'
+        line_start = True
+    if terminate:
+        yield b'.\r\n' if line_start else b'\r\n.\r\n'
+
+
+def chunked(source, size: int):
+    """
+    Нарезаем содержимое письма на блоки по size байт. Источником может
+    быть байтовая строка, файл, открытый в двоичном режиме, или итератор
+    байтовых блоков.
+    """
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        view = memoryview(source)
+        for start in range(0, len(view), size):
+            yield view[start:start + size]
+        return
+
+    if hasattr(source, 'read'):
+        while True:
+            chunk = source.read(size)
+            if not chunk:
+                return
+            yield chunk
+
+    buffer = bytearray()
+    for part in source:
+        buffer += part
+        while len(buffer) >= size:
+            yield bytes(buffer[:size])
+            del buffer[:size]
+    if buffer:
+        yield bytes(buffer)
@@ -0,0 +1,121 @@
+import asyncio
+import os
+import ssl
+import sys
+import unittest
+from unittest.mock import patch
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.path.pardir))
+
+import async_smtp
+import smtp
+
+
+class FakeServer:
+    def __init__(self, extensions=()):
+        self.extensions = list(extensions)
+        self.commands = []
+        self.messages = []
+
+    async def handle(self, reader, writer):
+        writer.write(b'220 fake ready\r\n')
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            command = line.strip().decode()
+            self.commands.append(command)
+            verb = command.split(' ')[0].lower()
+            if verb == 'ehlo':
+                lines = ['localhost'] + self.extensions
+                for ext in lines[:-1]:
+                    writer.write('250-{}\r\n'.format(ext).encode())
+                writer.write('250 {}\r\n'.format(lines[-1]).encode())
+            elif verb == 'rcpt' and 'bad' in command:
+                writer.write(b'550 no such user\r\n')
+            elif verb == 'data':
+                writer.write(b'354 go ahead\r\n')
+                await writer.drain()
+                body = b''
+                while True:
+                    line = await reader.readline()
+                    if line == b'.\r\n':
+                        break
+                    body += line
+                self.messages.append(body[:-2])
+                writer.write(b'250 queued\r\n')
+            elif verb == 'quit':
+                writer.write(b'221 bye\r\n')
+                await writer.drain()
+                writer.close()
+                break
+            else:
+                writer.write(b'250 ok\r\n')
+            await writer.drain()
+
+
+class TestAsyncSMTP(unittest.TestCase):
+    def deliver(self, fake, recipients):
+        async def scenario():
+            server = await asyncio.start_server(fake.handle, '127.0.0.1', 0)
+            port = server.sockets[0].getsockname()[1]
+            client = async_smtp.AsyncSMTP()
+            await client.connect('127.0.0.1', port)
+            await client.hello()
+            rejected = await client.send_message('a@b.c', recipients,
+                                                 'Hello!')
+            await client.disconnect()
+            server.close()
+            await server.wait_closed()
+            return rejected
+
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(scenario())
+        finally:
+            loop.close()
+
+    def test_delivers_message(self):
+        fake = FakeServer()
+        rejected = self.deliver(fake, ['x@b.c', 'bad@b.c'])
+        self.assertEqual(list(rejected), ['bad@b.c'])
+        self.assertEqual(fake.messages, [b'Hello!'])
+        self.assertEqual(fake.commands[-1], 'quit')
+
+    def test_pipelined_delivery(self):
+        fake = FakeServer(['PIPELINING', 'SMTPUTF8'])
+        self.assertEqual(self.deliver(fake, ['x@b.c']), {})
+        self.assertEqual(fake.messages, [b'Hello!'])
+
+    def test_rejects_all_recipients(self):
+        with self.assertRaises(smtp.SMTPException):
+            self.deliver(FakeServer(['PIPELINING']), ['bad@b.c'])
+
+    def test_starttls_without_loop_support(self):
+        class Loop:
+            pass
+
+        client = async_smtp.AsyncSMTP()
+        client.writer = object()
+        loop = asyncio.new_event_loop()
+        try:
+            with patch('async_smtp.asyncio.get_event_loop',
+                       return_value=Loop()), \
+                    self.assertRaises(smtp.SMTPException) as error:
+                loop.run_until_complete(client.wrap_socket(
+                    ssl.create_default_context()))
+        finally:
+            loop.close()
+        self.assertIn('3.7', error.exception.message)
+
+    def test_empty_recipient_list(self):
+        for extensions in ((), ['PIPELINING']):
+            with self.assertRaises(smtp.SMTPException) as error:
+                self.deliver(FakeServer(extensions), [])
+            self.assertEqual(error.exception.message,
+                             'No recipients were given.')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from base64 import encodebytes
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.path.pardir))
+
+import attachment_cache
+
+
+class TestAttachmentCache(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.files = []
+        for i in range(3):
+            name = os.path.join(self.dir, 'file_{}'.format(i))
+            with open(name, 'wb') as f:
+                f.write(os.urandom(1000 * (i + 1)))
+            self.files.append(open(name, 'rb'))
+
+    def encoded(self, cache, file):
+        return b''.join(cache.encoded(file))
+
+    def expected(self, file):
+        with open(file.name, 'rb') as f:
+            return encodebytes(f.read())
+
+    def test_encodes_once(self):
+        cache = attachment_cache.AttachmentCache()
+        for _ in range(3):
+            self.assertEqual(self.encoded(cache, self.files[0]),
+                             self.expected(self.files[0]))
+        self.assertEqual(cache.misses, 1)
+        self.assertEqual(cache.hits, 2)
+
+    def test_changed_file_is_reencoded(self):
+        cache = attachment_cache.AttachmentCache()
+        self.encoded(cache, self.files[0])
+        with open(self.files[0].name, 'ab') as f:
+            f.write(b'more')
+        self.assertEqual(self.encoded(cache, self.files[0]),
+                         self.expected(self.files[0]))
+        self.assertEqual(cache.misses, 2)
+
+    def test_evicts_least_recently_used(self):
+        cache = attachment_cache.AttachmentCache(max_bytes=4200)
+        for file in self.files:
+            self.encoded(cache, file)
+        self.assertLessEqual(cache.size, 4200)
+        self.assertNotIn(cache.key(self.files[0]), cache.memory)
+
+    def test_spills_to_disk(self):
+        spill = os.path.join(self.dir, 'spill')
+        cache = attachment_cache.AttachmentCache(max_bytes=100,
+                                                 spill_dir=spill)
+        first = self.encoded(cache, self.files[2])
+        second = self.encoded(cache, self.files[2])
+        self.assertEqual(first, self.expected(self.files[2]))
+        self.assertEqual(first, second)
+        self.assertEqual(cache.hits, 1)
+        self.assertEqual(len(os.listdir(spill)), 1)
+        cache.close()
+
+    def tearDown(self):
+        for file in self.files:
+            file.close()
+        shutil.rmtree(self.dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
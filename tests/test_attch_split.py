@@ -8,7 +8,7 @@ from filecmp import cmp
 sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
                              os.path.pardir))
 
-from simple import split_attachments
+from simple import build_email, split_attachments, PART_RESERVE
 
 
 def ignore_warnings(test_func):
@@ -21,17 +21,17 @@ def ignore_warnings(test_func):
 
 def merge_parts(parts: list):
     files = {}
-    for part in parts:
-        if part[0] in files:
-            files[part[0]] += part[1]
-        else:
-            files[part[0]] = part[1]
+    for path, offset, length in parts:
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            files[path] = files.get(path, b'') + f.read(length)
     return files
 
 
 class TestAttachmentsSplit(unittest.TestCase):
     def setUp(self):
-        self.n = Namespace()
+        self.n = Namespace(sender='a@b.c', recipient='x@b.c', name='A',
+                           cc=[], subject='Report', text='See attached.')
         self.n.attachments = []
         self.n.attch_parts = []
 
@@ -72,6 +72,7 @@ class TestAttachmentsSplit(unittest.TestCase):
         self.assertEqual(len(self.n.attachments), 6)
 
         self.compare_files(['big'], merge_parts(self.n.attch_parts))
+        self.assert_parts_fit()
 
     @ignore_warnings
     def test_split_big_and_medium_files(self):
@@ -83,6 +84,12 @@ class TestAttachmentsSplit(unittest.TestCase):
         self.assertEqual(len(self.n.attachments), 3)
 
         self.compare_files(['big', 'medium'], merge_parts(self.n.attch_parts))
+        self.assert_parts_fit()
+
+    def assert_parts_fit(self):
+        for i, part in enumerate(self.n.attch_parts):
+            size = build_email(self.n, i, part, 'utf-8').size()
+            self.assertLessEqual(size + PART_RESERVE, self.n.max_file_size)
 
     def compare_files(self, names: list, new_files: dict):
         for name in names:
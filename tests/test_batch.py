@@ -0,0 +1,342 @@
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+from argparse import Namespace
+from unittest.mock import patch
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.path.pardir))
+
+import batch
+from argparser import Parser
+from email_builder import encoded_size
+from fake_server import FakeServer
+
+
+def make_args(**kwargs):
+    args = Namespace(host='localhost', port=25, login='login',
+                     password='password', no_ssl=True, verbose=False,
+                     batch_bcc=False, rcpt_limit=15, session_limit=100,
+                     cache_size=1,
+                     cache_dir=None, workers=1, host_connections=4,
+                     retry_delay=60, retry_max_age=86400)
+    for key, value in kwargs.items():
+        setattr(args, key, value)
+    return args
+
+
+class TestBatchSender(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.dir = tempfile.mkdtemp()
+        os.chdir(self.dir)
+        self.addresses = ['user{}@example.com'.format(i) for i in range(50)]
+        with open('list.txt', 'w') as f:
+            f.write('\n'.join(self.addresses[:10] + ['invalid'] +
+                              self.addresses[10:]) + '\n')
+
+    @patch('batch.run')
+    def test_sends_every_valid_recipient(self, patched_run):
+        sent = []
+        patched_run.side_effect = lambda args, *_, **__: sent.append(
+            args.recipient) or {}
+        batch.BatchSender('list.txt', make_args()).broadcast()
+        self.assertEqual(sent, self.addresses)
+
+    @patch('batch.run')
+    def test_parallel_delivery(self, patched_run):
+        sent = []
+
+        def deliver(args, *_, **__):
+            time.sleep(random.random() / 100)
+            sent.append(args.recipient)
+            return {}
+
+        patched_run.side_effect = deliver
+        sender = batch.BatchSender('list.txt', make_args(workers=8))
+        sender.broadcast()
+        self.assertEqual(sorted(sent), sorted(self.addresses))
+        self.assertEqual(sender.position, 50)
+
+    def test_position_waits_for_earlier_groups(self):
+        sender = batch.BatchSender('list.txt', make_args())
+        sender.complete(10, 20)
+        self.assertEqual(sender.position, 0)
+        sender.complete(0, 10)
+        self.assertEqual(sender.position, 20)
+
+    def test_shard_bounds(self):
+        self.assertEqual(batch.shard_bounds(10, 3), [(0, 3), (3, 6), (6, 10)])
+        self.assertEqual(batch.shard_bounds(2, 4), [(0, 1), (1, 2)])
+
+    @patch('batch.run')
+    def test_shard_stops_at_its_end(self, patched_run):
+        sent = []
+        patched_run.side_effect = lambda args, *_, **__: sent.extend(
+            args.recipients) or {}
+        for i, (start, end) in enumerate(batch.shard_bounds(50, 3)):
+            batch.BatchSender('list.txt', make_args(batch_bcc=True),
+                              start, end, i).broadcast()
+        self.assertEqual(sorted(sent), sorted(self.addresses))
+
+    @patch('batch.run')
+    def test_skips_duplicates(self, patched_run):
+        with open('list.txt', 'a') as f:
+            f.write('USER1@EXAMPLE.COM\nuser2@Example.com\n')
+        sent = []
+        patched_run.side_effect = lambda args, *_, **__: sent.append(
+            args.recipient) or {}
+        batch.BatchSender('list.txt', make_args()).broadcast()
+        self.assertEqual(sent, self.addresses + ['USER1@example.com'])
+
+    @patch('batch.run')
+    def test_resumes_from_journal(self, patched_run):
+        with open('journal.jsonl', 'w') as f:
+            f.write('{"t": "snapshot", "start": 0, "end": 50, '
+                    '"position": 40, "finished": {}, "retry": []}\n'
+                    '{"t": "done", "s": 40, "e": 41, "f": []}\n'
+                    '{"t": "done", "s": 45, "e": 46, "f": []}\n'
+                    '{"t": "done", "s": 46, "e": 4')
+        sent = []
+        patched_run.side_effect = lambda args, *_, **__: sent.append(
+            args.recipient) or {}
+        sender = batch.BatchSender('list.txt', make_args())
+        self.assertEqual(sender.position, 41)
+        sender.broadcast()
+        self.assertEqual(sent, self.addresses[41:45] + self.addresses[46:])
+        self.assertFalse(os.path.exists('journal.jsonl'))
+
+    @patch('batch.run')
+    def test_journals_every_group(self, patched_run):
+        def deliver(args, *_, **__):
+            if args.recipient == self.addresses[3]:
+                raise batch.SMTPException('closed')
+            if args.recipient == self.addresses[5]:
+                raise KeyboardInterrupt
+            return {}
+
+        patched_run.side_effect = deliver
+        with self.assertRaises(KeyboardInterrupt):
+            batch.BatchSender('list.txt', make_args()).broadcast()
+        sender = batch.BatchSender('list.txt', make_args())
+        self.assertEqual(sender.position, 5)
+        self.assertEqual(sender.queue.pending(), [self.addresses[3]])
+
+    @patch('batch.run')
+    def test_worker_error_keeps_journal(self, patched_run):
+        def deliver(args, *_, **__):
+            if args.recipient == self.addresses[20]:
+                raise RuntimeError('broken template')
+            return {}
+
+        patched_run.side_effect = deliver
+        with self.assertRaises(RuntimeError):
+            batch.BatchSender('list.txt', make_args(workers=4)).broadcast()
+        self.assertTrue(os.path.exists('journal.jsonl'))
+        sent = []
+        patched_run.side_effect = lambda args, *_, **__: sent.append(
+            args.recipient) or {}
+        batch.BatchSender('list.txt', make_args()).broadcast()
+        self.assertIn(self.addresses[20], sent)
+        self.assertFalse(os.path.exists('journal.jsonl'))
+
+    @patch('batch.run')
+    def test_snapshot_keeps_running_retries(self, patched_run):
+        attempts = []
+
+        def deliver(args, *_, **__):
+            attempts.append(args.recipient)
+            if args.recipient != self.addresses[3]:
+                return {}
+            if attempts.count(args.recipient) == 1:
+                return {args.recipient: batch.SMTPException(
+                    b'451 try later\r\n', 451)}
+            sender.journal.compact_every = 0
+            sender.save()
+            raise KeyboardInterrupt
+
+        patched_run.side_effect = deliver
+        sender = batch.BatchSender('list.txt', make_args(retry_delay=0.01))
+        with self.assertRaises(KeyboardInterrupt):
+            sender.broadcast()
+        sender = batch.BatchSender('list.txt', make_args())
+        self.assertEqual(sender.queue.pending(), [self.addresses[3]])
+
+    @patch('batch.run')
+    def test_sharded_delivery(self, patched_run):
+        def deliver(args, *_, **__):
+            with open('sent.{}'.format(os.getpid()), 'a') as f:
+                f.write(args.recipient + '\n')
+            return {}
+
+        patched_run.side_effect = deliver
+        sender = batch.ShardedSender('list.txt', make_args(processes=3))
+        self.assertEqual(sender.broadcast(), [])
+        self.assertEqual(sender.progress(), 1)
+        sent = []
+        for name in os.listdir('.'):
+            if name.startswith('sent.'):
+                with open(name) as f:
+                    sent.extend(f.read().split())
+        self.assertEqual(sorted(sent), sorted(self.addresses))
+
+    @patch('batch.SHARD_POLL', 0.05)
+    @patch('batch.run')
+    def test_sharded_delivery_survives_failed_shard(self, patched_run):
+        def deliver(args, *_, **__):
+            if args.recipient == self.addresses[0]:
+                raise RuntimeError('broken template')
+            if args.recipient == self.addresses[49]:
+                os._exit(3)
+            return {}
+
+        patched_run.side_effect = deliver
+        sender = batch.ShardedSender('list.txt', make_args(processes=3))
+        with self.assertRaises(RuntimeError):
+            sender.broadcast()
+        self.assertEqual(sorted(sender.errors), [0, 2])
+        self.assertEqual(list(sender.failed), [1])
+
+    def test_late_done_message_clears_shard_error(self):
+        sender = batch.ShardedSender('list.txt', make_args(processes=3))
+        running = {1}
+        sender.errors[1] = 0
+        sender.receive(('done', 1, []), running)
+        self.assertEqual(sender.errors, {})
+        self.assertEqual(sender.failed, {1: []})
+        self.assertEqual(running, set())
+
+    @patch('batch.run')
+    def test_retries_temporary_and_bounces_permanent(self, patched_run):
+        attempts = {}
+
+        def deliver(args, *_, **__):
+            attempts[args.recipient] = attempts.get(args.recipient, 0) + 1
+            if args.recipient == self.addresses[1]:
+                raise batch.MessageRejected(b'550 no such user\r\n', 550)
+            if args.recipient == self.addresses[2] and \
+                    attempts[args.recipient] < 3:
+                return {args.recipient: batch.SMTPException(
+                    b'451 try later\r\n', 451)}
+            return {}
+
+        patched_run.side_effect = deliver
+        sender = batch.BatchSender('list.txt',
+                                   make_args(retry_delay=0.01))
+        self.assertEqual(sender.broadcast(), [self.addresses[1]])
+        self.assertEqual(attempts[self.addresses[1]], 1)
+        self.assertEqual(attempts[self.addresses[2]], 3)
+        with open('bounces.txt') as f:
+            self.assertEqual(f.read(), '{}\t550 no such user\n'.format(
+                self.addresses[1]))
+
+    @patch('batch.run')
+    def test_auth_failure_stops_without_bounces(self, patched_run):
+        patched_run.side_effect = batch.SMTPException(
+            b'535 authentication failed\r\n', 535)
+        with self.assertRaises(batch.SMTPException):
+            batch.BatchSender('list.txt', make_args(workers=4)).broadcast()
+        self.assertFalse(os.path.exists('bounces.txt'))
+        self.assertTrue(os.path.exists('journal.jsonl'))
+
+    @patch('batch.run')
+    def test_connection_failure_defers_group(self, patched_run):
+        attempts = []
+
+        def deliver(args, *_, **__):
+            attempts.append(args.recipient)
+            if len(attempts) == 1:
+                raise batch.SMTPException(b'421 too busy\r\n', 421)
+            return {}
+
+        patched_run.side_effect = deliver
+        sender = batch.BatchSender('list.txt', make_args(retry_delay=0.01))
+        self.assertEqual(sender.broadcast(), [])
+        self.assertEqual(attempts.count(self.addresses[0]), 2)
+        self.assertFalse(os.path.exists('bounces.txt'))
+
+    @patch('batch.run')
+    def test_groups_recipients_by_domain(self, patched_run):
+        addresses = ['a{}@{}.com'.format(i, 'xy'[i % 2]) for i in range(10)]
+        with open('list.txt', 'w') as f:
+            f.write('\n'.join(addresses) + '\n')
+        groups = []
+        patched_run.side_effect = lambda args, *_, **__: groups.append(
+            list(args.recipients)) or {}
+        batch.BatchSender('list.txt',
+                          make_args(batch_bcc=True, rcpt_limit=3)).broadcast()
+        self.assertEqual(groups, [addresses[0:6:2], addresses[6:10:2] +
+                                  addresses[1:2], addresses[3:9:2],
+                                  addresses[9:]])
+
+    @patch('batch.run')
+    def test_learns_recipient_limit(self, patched_run):
+        transactions = []
+
+        def deliver(args, *_, **__):
+            transactions.append(len(args.recipients))
+            return {recipient: batch.SMTPException('452 too many', 452)
+                    for recipient in args.recipients[4:]}
+
+        patched_run.side_effect = deliver
+        sender = batch.BatchSender('list.txt', make_args(batch_bcc=True))
+        self.assertEqual(sender.broadcast(), [])
+        self.assertEqual(sender.planner.limit, 4)
+        self.assertEqual(transactions[:4], [15, 4, 4, 3])
+        self.assertTrue(all(size <= 4 for size in transactions[1:]))
+        self.assertEqual(sum(transactions), 50 + 11)
+        self.assertEqual(len(sender.queue), 0)
+
+    @patch('batch.run')
+    def test_resumes_partial_window(self, patched_run):
+        with open('journal.jsonl', 'w') as f:
+            f.write('{"t": "part", "s": 0, "i": [0, 1, 2], "f": []}\n')
+        sent = []
+        patched_run.side_effect = lambda args, *_, **__: sent.extend(
+            args.recipients) or {}
+        batch.BatchSender('list.txt', make_args(batch_bcc=True)).broadcast()
+        self.assertEqual(sorted(sent), sorted(self.addresses[3:]))
+
+    @patch('batch.run')
+    def test_dumps_metrics(self, patched_run):
+        patched_run.side_effect = lambda args, *_, **__: {}
+        batch.BatchSender('list.txt', make_args(
+            metrics='metrics.prom', metrics_interval=0)).broadcast()
+        with open('metrics.prom') as f:
+            self.assertTrue(f.read().endswith('\n'))
+
+    def test_sends_attachment_to_every_recipient(self):
+        with open('list.txt', 'w') as f:
+            f.write('\n'.join(self.addresses[:6]) + '\n')
+        with open('att.bin', 'wb') as f:
+            f.write(os.urandom(200000))
+        server = FakeServer()
+        server.start()
+        try:
+            for workers in (1, 4):
+                server.reset()
+                args = Parser().parse(
+                    ['--host', server.host, '-p', str(server.port), '-l',
+                     'a@localhost', '--password', 'secret', '--no-ssl',
+                     '-r', 'r@localhost', '-t', 'Hello!', '-a', 'att.bin',
+                     '--batch', 'list.txt', '-w', str(workers)])
+                sender = batch.BatchSender('list.txt', args)
+                self.assertEqual(sender.broadcast(), [])
+                stats = server.stats()
+                self.assertEqual(stats['messages'], 6)
+                self.assertGreater(stats['bytes'],
+                                   6 * encoded_size(200000))
+        finally:
+            server.stop()
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+import os
+import sys
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.path.pardir))
+
+import bench
+from fake_server import FakeServer
+from smtp import SMTP
+
+
+class TestFakeServer(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeServer()
+        self.server.start()
+
+    def test_counts_messages(self):
+        client = SMTP()
+        client.connect(self.server.host, self.server.port)
+        client.hello()
+        client.authorize('login', 'password')
+        self.assertTrue(client.capabilities.chunking)
+        client.send_message('a@b.c', ['x@b.c', 'y@b.c'], [b'Hello!'])
+        client.extensions = {}
+        client.send_message('a@b.c', ['x@b.c'], 'Hello!')
+        client.disconnect()
+        stats = self.server.stats()
+        self.assertEqual(stats['messages'], 2)
+        self.assertEqual(stats['recipients'], 3)
+        self.assertEqual(len(stats['latencies']), 2)
+
+    def tearDown(self):
+        self.server.stop()
+
+
+class TestBench(unittest.TestCase):
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(bench.percentile(values, 0.5), 51)
+        self.assertEqual(bench.percentile(values, 0.99), 99)
+        self.assertEqual(bench.percentile([], 0.5), 0)
+
+    def test_compare(self):
+        baseline = {'single': {'msgs_per_sec': 100, 'p99_ms': 10,
+                               'peak_rss_kb': 1000}}
+        results = {'single': {'msgs_per_sec': 95, 'p99_ms': 12,
+                              'peak_rss_kb': 900},
+                   'batch': {'msgs_per_sec': 1}}
+        regressions = bench.compare(results, baseline, 0.1)
+        self.assertEqual(len(regressions), 1)
+        self.assertTrue(regressions[0].startswith('single: p99_ms'))
+
+
+if __name__ == '__main__':
+    unittest.main()
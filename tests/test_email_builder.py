@@ -0,0 +1,116 @@
+import io
+import os
+import sys
+import tempfile
+import unittest
+from base64 import b64decode
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.path.pardir))
+
+import email_builder
+import smtp
+
+
+def sent(chunks) -> bytes:
+    return b''.join(smtp.normalized(chunks, terminate=False))
+
+
+class NamedBytesIO(io.BytesIO):
+    name = 'data.bin'
+
+
+class TestStreamingEmail(unittest.TestCase):
+    def setUp(self):
+        self.content = os.urandom(3 * email_builder.ENCODE_BLOCK + 100)
+
+    def make_email(self, streaming: bool):
+        attachment = (NamedBytesIO(self.content), None)
+        return email_builder.Email('a@b.c', 'x@b.c', 'A',
+                                   attachments={attachment},
+                                   subject='Hi', text='Hello',
+                                   streaming=streaming)
+
+    def test_streaming_matches_string(self):
+        email = self.make_email(True)
+        self.assertEqual(email.to_string().split('Date:')[1],
+                         self.make_email(False).to_string().split('Date:')[1])
+
+    def test_size_matches_content(self):
+        for length in (0, 1, 56, 57, 58, len(self.content)):
+            self.content = os.urandom(length)
+            email = self.make_email(True)
+            self.assertEqual(email.size(), len(sent(email.chunks())))
+
+    def test_chunks_are_bounded(self):
+        chunks = list(self.make_email(True).chunks())
+        self.assertGreater(len(chunks), 4)
+        for chunk in chunks:
+            self.assertLessEqual(len(chunk),
+                                 email_builder.ENCODE_BLOCK * 4 // 3 * 2)
+
+    def test_base64_lines_are_wrapped(self):
+        text = b''.join(self.make_email(True).chunks()).decode()
+        body = text.split('\n\n\n')[-1].split('\n--frontier')[0]
+        lines = body.split('\n')
+        self.assertTrue(all(len(line) <= 76 for line in lines))
+        self.assertEqual(b64decode(''.join(lines)), self.content)
+
+    def test_part_is_read_from_file(self):
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(self.content)
+            f.flush()
+            email = email_builder.Email('a@b.c', 'x@b.c', 'A',
+                                        attch_part=(f.name, 570, 1000),
+                                        streaming=True)
+            data = b''.join(email.chunks())
+            self.assertEqual(email.size(), len(sent(email.chunks())))
+        body = data.decode().split('\n\n\n')[-1].split('\n--frontier')[0]
+        self.assertEqual(b64decode(body), self.content[570:1570])
+
+
+class TestEmailTemplate(unittest.TestCase):
+    def attachments(self):
+        return [(NamedBytesIO(b'attachment'), None)]
+
+    def make_template(self):
+        email = email_builder.Email('a@b.c', 'x@b.c', 'A',
+                                    attachments=self.attachments(),
+                                    subject='Hi', text='Hello, {{name}}!',
+                                    streaming=True)
+        return email_builder.EmailTemplate(email)
+
+    def test_substitutes_recipient_and_fields(self):
+        template = self.make_template()
+        text = b''.join(template.render(template.headers(
+            'y@b.c', {'name': 'Bob'}), self.attachments())).decode()
+        self.assertIn('To: y@b.c\n', text)
+        self.assertIn('Hello, Bob!', text)
+        self.assertIn('YXR0YWNobWVudA==', text)
+        self.assertNotIn('\x00', text)
+
+    def test_reuses_static_buffers(self):
+        template = self.make_template()
+        first = template.headers('x@b.c')
+        second = template.headers('y@b.c')
+        self.assertIs(first[0], second[0])
+
+    def test_size_matches_rendered_email(self):
+        template = self.make_template()
+        headers = template.headers('y@b.c', {'name': 'Bob'})
+        self.assertEqual(template.size(headers), len(sent(
+            template.render(headers, self.attachments()))))
+
+    def test_renders_attachments_of_each_run(self):
+        template = self.make_template()
+        self.assertIsNone(template.email.attachments)
+        headers = template.headers('x@b.c')
+        for _ in range(2):
+            attachments = self.attachments()
+            self.assertIn(b'YXR0YWNobWVudA==', b''.join(
+                template.render(headers, attachments)))
+            attachments[0][0].close()
+
+
+if __name__ == '__main__':
+    unittest.main()
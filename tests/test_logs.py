@@ -0,0 +1,46 @@
+import io
+import logging
+import os
+import sys
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.path.pardir))
+
+import logs
+from smtp import SMTP, Reply
+
+
+class TestLogs(unittest.TestCase):
+    def setUp(self):
+        self.stream = io.StringIO()
+        logs.stop()
+        logs.setup(True, stream=self.stream)
+
+    def test_single_handler_per_process(self):
+        handlers = list(logging.getLogger('Client').handlers)
+        for _ in range(3):
+            SMTP(verbose=True)
+        logs.setup(True, stream=self.stream)
+        self.assertEqual(logging.getLogger('Client').handlers, handlers)
+
+    def test_records_are_written_by_listener(self):
+        logging.getLogger('Server').info('%s', Reply([b'250 ok\r\n']))
+        logs.stop()
+        self.assertEqual(self.stream.getvalue(), '[Server]: 250 ok\n\n')
+
+    def test_sampling_keeps_warnings(self):
+        logs.setup(True, sample=0, stream=self.stream)
+        client = logging.getLogger('Client')
+        client.info('dropped')
+        client.warning('kept')
+        logs.stop()
+        self.assertEqual(self.stream.getvalue(), '[Client]: kept\n\n')
+
+    def tearDown(self):
+        logs.stop()
+        logs.setup(False)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.path.pardir))
+
+from fake_server import FakeServer
+from metrics import Histogram, Metrics
+from smtp import SMTP
+
+
+class TestMetrics(unittest.TestCase):
+    def test_histogram(self):
+        histogram = Histogram((0.1, 1))
+        for value in (0.05, 0.5, 0.6, 2):
+            histogram.observe(value)
+        self.assertEqual(histogram.counts, [1, 2, 1])
+        self.assertEqual(histogram.quantile(0.5), 1)
+        self.assertEqual(histogram.quantile(0.99), float('inf'))
+
+    def test_callbacks_and_failed_phases(self):
+        metrics = Metrics()
+        seen = []
+        metrics.subscribe(lambda name, value: seen.append(name))
+        with metrics.timer('connect'):
+            pass
+        with self.assertRaises(OSError):
+            with metrics.timer('auth'):
+                raise OSError
+        metrics.count('replies:250', 2)
+        self.assertEqual(seen, ['connect', 'replies:250'])
+        text = metrics.to_prometheus()
+        self.assertIn('smtp_replies_total{code="250"} 2\n', text)
+        self.assertIn('smtp_phase_seconds_count{phase="connect"} 1\n', text)
+
+    def test_smtp_phases(self):
+        server = FakeServer()
+        server.start()
+        metrics = Metrics()
+        try:
+            client = SMTP(metrics=metrics)
+            client.connect(server.host, server.port)
+            client.hello()
+            client.authorize('login', 'password')
+            client.send_message('a@b.c', ['x@b.c', 'y@b.c'], [b'Hello!'])
+            client.disconnect()
+        finally:
+            server.stop()
+        snapshot = metrics.to_dict()
+        for phase in ('connect', 'greeting', 'ehlo', 'auth', 'mail', 'data',
+                      'final', 'message'):
+            self.assertEqual(snapshot['phases'][phase]['count'], 1, phase)
+        self.assertEqual(snapshot['phases']['rcpt']['count'], 2)
+        self.assertEqual(snapshot['counters']['messages'], 1)
+        self.assertEqual(snapshot['counters']['recipients'], 2)
+        self.assertGreater(snapshot['counters']['bytes_sent'], 6)
+
+    def test_dump(self):
+        directory = tempfile.mkdtemp()
+        try:
+            metrics = Metrics()
+            metrics.count('messages')
+            path = os.path.join(directory, 'metrics.json')
+            metrics.dump(path)
+            with open(path) as f:
+                self.assertEqual(json.load(f)['counters'], {'messages': 1})
+            self.assertEqual(os.listdir(directory), ['metrics.json'])
+        finally:
+            shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    unittest.main()
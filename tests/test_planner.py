@@ -0,0 +1,36 @@
+import os
+import sys
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.path.pardir))
+
+from planner import RecipientPlanner
+from smtp import SMTPException
+
+
+class TestRecipientPlanner(unittest.TestCase):
+    def test_groups_by_domain(self):
+        entries = list(enumerate(['a@x.com', 'b@Y.com', 'c@x.com',
+                                  'd@y.com', 'e@x.com']))
+        groups = RecipientPlanner(2).plan(entries)
+        self.assertEqual(groups, [[(0, 'a@x.com'), (2, 'c@x.com')],
+                                  [(4, 'e@x.com'), (1, 'b@Y.com')],
+                                  [(3, 'd@y.com')]])
+
+    def test_learns_only_lower_limit(self):
+        planner = RecipientPlanner(10)
+        planner.learn(4)
+        planner.learn(7)
+        planner.learn(0)
+        self.assertEqual(planner.limit, 4)
+
+    def test_deferred(self):
+        rejected = {'a': SMTPException('full', 452),
+                    'b': SMTPException('no such user', 550)}
+        self.assertEqual(RecipientPlanner.deferred(['a', 'b', 'c'], rejected),
+                         ['a'])
+
+
+if __name__ == '__main__':
+    unittest.main()
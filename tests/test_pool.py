@@ -0,0 +1,82 @@
+import os
+import sys
+import unittest
+from argparse import Namespace
+from unittest.mock import patch
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.path.pardir))
+
+import pool
+from smtp import SMTPException
+
+
+def make_args(host='localhost'):
+    return Namespace(host=host, port=25, login='login',
+                     password='password', no_ssl=True, verbose=False)
+
+
+class TestSessionPool(unittest.TestCase):
+    @patch('session.SMTP')
+    def test_reuses_returned_session(self, patched_smtp):
+        p = pool.SessionPool()
+        first = p.borrow(make_args())
+        first.acquire()
+        first.release()
+        p.give_back(first)
+        second = p.borrow(make_args())
+        self.assertIs(first, second)
+        patched_smtp.return_value.noop.assert_not_called()
+
+    @patch('session.SMTP')
+    def test_separates_hosts(self, patched_smtp):
+        p = pool.SessionPool()
+        first = p.borrow(make_args('a'))
+        first.acquire()
+        p.give_back(first)
+        second = p.borrow(make_args('b'))
+        self.assertIsNot(first, second)
+
+    @patch('session.SMTP')
+    def test_evicts_dead_session(self, patched_smtp):
+        p = pool.SessionPool(noop_after=-1)
+        first = p.borrow(make_args())
+        first.acquire()
+        p.give_back(first)
+        patched_smtp.return_value.noop.side_effect = SMTPException('closed')
+        second = p.borrow(make_args())
+        self.assertIsNot(first, second)
+        self.assertEqual(p.total[p.key(make_args())], 1)
+
+    @patch('session.SMTP')
+    def test_evicts_after_temporary_failure(self, patched_smtp):
+        p = pool.SessionPool()
+        first = p.borrow(make_args())
+        first.acquire()
+        p.give_back(first, SMTPException(b'451 try later\r\n', 451))
+        patched_smtp.return_value.disconnect.assert_called_once()
+        self.assertEqual(p.total[p.key(make_args())], 0)
+
+    @patch('session.SMTP')
+    def test_drops_expired_session(self, patched_smtp):
+        p = pool.SessionPool(idle_timeout=-1)
+        first = p.borrow(make_args())
+        first.acquire()
+        p.give_back(first)
+        p.prune()
+        self.assertEqual(p.idle[p.key(make_args())], [])
+        patched_smtp.return_value.disconnect.assert_called_once()
+
+    @patch('session.SMTP')
+    def test_borrow_prunes_expired_sessions(self, patched_smtp):
+        p = pool.SessionPool(idle_timeout=-1)
+        first = p.borrow(make_args('a'))
+        first.acquire()
+        p.give_back(first)
+        p.borrow(make_args('b'))
+        self.assertEqual(p.idle[p.key(make_args('a'))], [])
+        self.assertEqual(p.total[p.key(make_args('a'))], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
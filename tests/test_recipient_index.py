@@ -0,0 +1,80 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.path.pardir))
+
+import recipient_index
+
+
+class TestRecipientIndex(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'list.txt')
+        with open(self.path, 'w') as f:
+            f.write('a@example.com\n'
+                    'not an address\n'
+                    '\n'
+                    '  b@Example.COM  \n'
+                    'a@EXAMPLE.com\n'
+                    'two@at@example.com\n'
+                    'c@example.com\n')
+
+    def test_builds_clean_index(self):
+        index = recipient_index.RecipientIndex.open(self.path)
+        self.assertEqual(len(index), 3)
+        self.assertEqual(index.read(0, 3), ['a@example.com',
+                                            'b@example.com',
+                                            'c@example.com'])
+        self.assertEqual(index.read(1, 2), ['b@example.com'])
+        self.assertEqual(index.read(3, 5), [])
+        index.close()
+
+    def test_keeps_every_short_address(self):
+        with open(self.path, 'w') as f:
+            f.write('\n'.join('u{}@d.org'.format(i) for i in range(5)))
+        index = recipient_index.RecipientIndex.open(self.path)
+        self.assertEqual(index.read(0, 5),
+                         ['u{}@d.org'.format(i) for i in range(5)])
+        self.assertEqual(index.duplicates, 0)
+        index.close()
+
+    def test_count_lines(self):
+        self.assertEqual(recipient_index.count_lines(self.path), 7)
+        with open(self.path, 'ab') as f:
+            f.write(b'last@example.com')
+        self.assertEqual(recipient_index.count_lines(self.path), 8)
+
+    def test_counts_skipped_lines(self):
+        index = recipient_index.RecipientIndex(self.path)
+        index.build()
+        self.assertEqual(index.skipped, 2)
+        self.assertEqual(index.duplicates, 1)
+
+    def test_rebuilds_stale_index(self):
+        recipient_index.RecipientIndex.open(self.path).close()
+        self.assertTrue(recipient_index.RecipientIndex(self.path).fresh())
+        with open(self.path, 'a') as f:
+            f.write('d@example.com\n')
+        self.assertFalse(recipient_index.RecipientIndex(self.path).fresh())
+        index = recipient_index.RecipientIndex.open(self.path)
+        self.assertEqual(index.read(3, 4), ['d@example.com'])
+        index.close()
+
+    def test_bloom_filter(self):
+        bloom = recipient_index.BloomFilter(1000)
+        self.assertFalse(bloom.add(b'a@example.com'))
+        self.assertTrue(bloom.add(b'a@example.com'))
+        false_positives = sum(bloom.add('{}@x.com'.format(i).encode())
+                              for i in range(1000))
+        self.assertLess(false_positives, 3)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+import os
+import sys
+import unittest
+from unittest.mock import patch
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.path.pardir))
+
+import retry
+from smtp import SMTPException
+
+
+class TestRetryQueue(unittest.TestCase):
+    @patch('retry.time.time')
+    def test_backoff_grows(self, patched_time):
+        patched_time.return_value = 1000
+        queue = retry.RetryQueue(base_delay=10, jitter=0)
+        error = SMTPException(b'451 try later\r\n', 451)
+        self.assertTrue(queue.fail('a@b.c', error))
+        self.assertEqual(queue.due(), [])
+        self.assertEqual(queue.wait_time(), 10)
+
+        patched_time.return_value = 1010
+        (recipient, attempts, first_failed), = queue.due()
+        self.assertEqual((recipient, attempts, first_failed),
+                         ('a@b.c', 1, 1000))
+        queue.fail(recipient, error, attempts, first_failed)
+        self.assertEqual(queue.wait_time(), 20)
+
+    def test_permanent_failure_bounces(self):
+        queue = retry.RetryQueue()
+        self.assertFalse(queue.fail(
+            'a@b.c', SMTPException(b'550 no such user\r\n', 550)))
+        self.assertEqual(len(queue), 0)
+        self.assertEqual(queue.take_bounces(),
+                         [('a@b.c', b'550 no such user\r\n')])
+        self.assertEqual(queue.take_bounces(), [])
+
+    @patch('retry.time.time')
+    def test_gives_up_after_max_age(self, patched_time):
+        patched_time.return_value = 5000
+        queue = retry.RetryQueue(max_age=100)
+        self.assertFalse(queue.fail('a@b.c', SMTPException('closed'),
+                                    attempts=4, first_failed=4000))
+        self.assertEqual(len(queue.take_bounces()), 1)
+
+    def test_orders_by_due_time(self):
+        queue = retry.RetryQueue()
+        queue.schedule('late@b.c', delay=100)
+        queue.schedule('first@b.c')
+        queue.schedule('second@b.c')
+        self.assertEqual([entry[0] for entry in queue.due()],
+                         ['first@b.c', 'second@b.c'])
+        self.assertEqual(queue.pending(), ['late@b.c'])
+
+
+if __name__ == '__main__':
+    unittest.main()
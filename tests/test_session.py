@@ -0,0 +1,59 @@
+import os
+import sys
+import unittest
+from argparse import Namespace
+from unittest.mock import patch
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.path.pardir))
+
+import session
+from smtp import SMTPException
+
+
+def make_args():
+    return Namespace(host='localhost', port=25, login='login',
+                     password='password', no_ssl=True, verbose=False)
+
+
+class TestSession(unittest.TestCase):
+    @patch('session.SMTP')
+    def test_reuses_connection(self, patched_smtp):
+        s = session.Session(make_args())
+        for _ in range(3):
+            s.acquire()
+            s.release()
+        patched_smtp.return_value.connect.assert_called_once()
+        patched_smtp.return_value.authorize.assert_called_once()
+        patched_smtp.return_value.reset.assert_not_called()
+
+    @patch('session.SMTP')
+    def test_reconnects_after_limit(self, patched_smtp):
+        s = session.Session(make_args(), limit=2)
+        for _ in range(5):
+            s.acquire()
+            s.release()
+        self.assertEqual(patched_smtp.return_value.connect.call_count, 3)
+        self.assertEqual(patched_smtp.return_value.disconnect.call_count, 2)
+
+    @patch('session.SMTP')
+    def test_resets_after_rejected_transaction(self, patched_smtp):
+        s = session.Session(make_args())
+        s.acquire()
+        s.fail(SMTPException(b'550 no such user\r\n', 550))
+        s.acquire()
+        patched_smtp.return_value.reset.assert_called_once()
+        patched_smtp.return_value.connect.assert_called_once()
+
+    @patch('session.SMTP')
+    def test_reconnects_after_drop(self, patched_smtp):
+        s = session.Session(make_args())
+        s.acquire()
+        s.fail(SMTPException('Connection closed by server.'))
+        s.acquire()
+        patched_smtp.return_value.reset.assert_not_called()
+        self.assertEqual(patched_smtp.return_value.connect.call_count, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
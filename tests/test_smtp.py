@@ -1,4 +1,5 @@
 import os
+import socket
 import sys
 import unittest
 from unittest.mock import patch, Mock, call
@@ -39,6 +40,24 @@ class TestSockets(unittest.TestCase):
         patched_recv.side_effect = [b'hi', b' how', b' are', b' you?\r\n']
         self.assertEqual(smtp.SMTP().receive(), b'hi how are you?\r\n')
 
+    @patch('smtp.socket.socket.recv')
+    def test_receive_multiline_reply(self, patched_recv):
+        patched_recv.side_effect = [b'250-smtp.example.com\r\n250-PIPE',
+                                    b'LINING\r\n250 SMTPUTF8\r\n221 bye\r\n']
+        s = smtp.SMTP()
+        reply = s.reply()
+        self.assertEqual(reply.code, 250)
+        self.assertEqual(reply.lines, [b'smtp.example.com', b'PIPELINING',
+                                       b'SMTPUTF8'])
+        self.assertEqual(s.receive(), b'221 bye\r\n')
+        self.assertEqual(patched_recv.call_count, 2)
+
+    @patch('smtp.socket.socket.recv')
+    def test_closed_connection(self, patched_recv):
+        patched_recv.return_value = b''
+        with self.assertRaises(smtp.SMTPException):
+            smtp.SMTP().receive()
+
     @patch('smtp.socket.socket.recv')
     def test_socket_timeout(self, patched_recv):
         patched_recv.side_effect = smtp.socket.timeout
@@ -47,7 +66,7 @@ class TestSockets(unittest.TestCase):
 
     @patch('smtp.socket.socket.recv')
     def test_error_code_raises_exception(self, patched_recv):
-        patched_recv.return_value = b'230-hi\r\n'
+        patched_recv.return_value = b'230 hi\r\n'
         with self.assertRaises(smtp.SMTPException):
             smtp.SMTP().check_code(b'220')
 
@@ -61,9 +80,7 @@ class TestSockets(unittest.TestCase):
     @patch('smtp.socket.socket.recv')
     @patch('smtp.socket.socket.sendall')
     def test_start_tls(self, patched_sendall, patched_recv):
-        patched_recv.side_effect = [b'250-go ahead\r\n',
-                                    b'250 go ahead\r\n',
-                                    b'220 go ahead\r\n']
+        patched_recv.side_effect = [b'220 go ahead\r\n']
         smtp.SMTP().start_tls()
         patched_sendall.assert_called_with(b'starttls\r\n')
 
@@ -71,48 +88,132 @@ class TestSockets(unittest.TestCase):
     @patch('smtp.socket.socket.sendall')
     def test_start_tls_error(self, _, patched_recv):
         with self.assertRaises(smtp.SMTPException):
-            patched_recv.side_effect = [b'334-tls is not allowed!\r\n']
+            patched_recv.side_effect = [b'454 tls is not allowed!\r\n']
             smtp.SMTP().start_tls()
         with self.assertRaises(smtp.SMTPException):
-            patched_recv.side_effect = [b'250-go ahead\r\n',
-                                        b'250 go ahead\r\n',
-                                        b'334-error!\r\n']
+            patched_recv.side_effect = [b'454-tls is\r\n',
+                                        b'454 not allowed!\r\n']
             smtp.SMTP().start_tls()
 
-    @patch('smtp.ssl.wrap_socket')
-    def test_wrap_socket(self, patched_wrap):
+    @patch('smtp.tls_context')
+    def test_wrap_socket(self, patched_context):
         s = smtp.SMTP()
         s.sock = Mock(smtp.socket.socket)
-        patched_wrap.return_value = Mock(smtp.socket.socket)
+        wrapped = Mock(smtp.ssl.SSLSocket)
+        wrapped.session = 'session'
+        patched_context.return_value.wrap_socket.return_value = wrapped
+        s.host, s.port = 'smtp.example.com', 587
         s.wrap_socket()
-        self.assertIsInstance(s.enc_sock, smtp.socket.socket)
+        self.assertIs(s.enc_sock, wrapped)
         self.assertEqual(s.encrypted, True)
+        patched_context.return_value.wrap_socket.assert_called_with(
+            s.sock, server_hostname='smtp.example.com', session=None)
+
+        s.sock = Mock(smtp.socket.socket)
+        s.wrap_socket()
+        patched_context.return_value.wrap_socket.assert_called_with(
+            s.sock, server_hostname='smtp.example.com', session='session')
+        smtp.tls_sessions.clear()
+
+    def test_shared_tls_context(self):
+        self.assertIs(smtp.tls_context('smtp.example.com'),
+                      smtp.tls_context('smtp.example.com'))
+        self.assertIsNot(smtp.tls_context('smtp.example.com'),
+                         smtp.tls_context('smtp.example.com', False))
 
+    @patch('smtp.SMTP.wrap_socket')
+    @patch('smtp.socket.socket.connect')
+    def test_implicit_tls(self, patched_connect, patched_wrap):
+        smtp.SMTP().connect('smtp.example.com', 465, implicit_tls=True)
+        patched_wrap.assert_called_once()
+
+    @patch('smtp.socket.socket.connect')
+    def test_connect_disables_nagle(self, patched_connect):
+        s = smtp.SMTP()
+        s.connect('smtp.example.com', 25)
+        self.assertTrue(s.sock.getsockopt(socket.IPPROTO_TCP,
+                                          socket.TCP_NODELAY))
+
+    @patch('smtp.SMTP.hello')
     @patch('smtp.SMTP.start_tls')
     @patch('smtp.SMTP.wrap_socket')
-    def test_encrypt(self, patched_wrap, patched_starttls):
+    def test_encrypt(self, patched_wrap, patched_starttls, patched_hello):
         smtp.SMTP().encrypt()
         patched_wrap.assert_called_once()
         patched_starttls.assert_called_once()
+        patched_hello.assert_called_once()
+
+    @patch('smtp.socket.socket.sendall')
+    @patch('smtp.socket.socket.recv')
+    def test_hello_parses_capabilities(self, patched_recv, patched_send):
+        patched_recv.side_effect = [b'220 ready\r\n250-mx.example.com\r\n'
+                                    b'250-SIZE 1000\r\n250-8BITMIME\r\n'
+                                    b'250-AUTH PLAIN login\r\n'
+                                    b'250-STARTTLS\r\n250 SMTPUTF8\r\n',
+                                    b'250-mx.example.com\r\n'
+                                    b'250 PIPELINING\r\n']
+        s = smtp.SMTP()
+        s.host, s.port = 'capabilities.example.com', 25
+        s.hello()
+        self.assertEqual(s.capabilities.size, 1000)
+        self.assertEqual(s.capabilities.auth, {'PLAIN', 'LOGIN'})
+        self.assertTrue(s.capabilities.starttls)
+        self.assertTrue(s.capabilities.eightbitmime)
+        self.assertEqual(s.encoding, 'utf-8')
+        s.hello()
+        self.assertFalse(s.capabilities.starttls)
+        self.assertTrue(s.capabilities.pipelining)
+        self.assertEqual(s.encoding, 'ascii')
+        self.assertIs(smtp.capabilities_for('capabilities.example.com', 25),
+                      s.capabilities)
+
+    @patch('smtp.SMTP.envelope')
+    def test_rejects_oversized_message(self, patched_envelope):
+        s = smtp.SMTP()
+        s.extensions = {'SIZE': '10'}
+        with self.assertRaises(smtp.MessageTooLarge):
+            s.send_message('a@b.c', ['x@b.c'], [b'0123456', b'789a'])
+        patched_envelope.assert_not_called()
+
+    @patch('smtp.socket.socket.sendall')
+    @patch('smtp.socket.socket.recv')
+    def test_mail_from_parameters(self, patched_recv, patched_send):
+        patched_recv.return_value = b'250 ok\r\n'
+        s = smtp.SMTP()
+        s.extensions = {'SIZE': '1000', '8BITMIME': ''}
+        s.mail_from('a@b.c', 42)
+        patched_send.assert_called_with(b'mail from: <a@b.c> SIZE=42 '
+                                        b'BODY=8BITMIME\r\n')
 
     @patch('smtp.socket.socket.sendall')
     @patch('smtp.socket.socket.recv')
     def test_auth(self, patched_recv, patched_sendall):
-        patched_recv.side_effect = [b'334-ok\r\n',
-                                    b'334-ok\r\n',
-                                    b'235-ok\r\n']
+        patched_recv.side_effect = [b'334 ok\r\n',
+                                    b'334 ok\r\n',
+                                    b'235 ok\r\n']
         smtp.SMTP().authorize('login', 'password')
         calls = [call(b'auth login\r\n'),
                  call(b'bG9naW4=\r\n'),
                  call(b'cGFzc3dvcmQ=\r\n')]
         patched_sendall.assert_has_calls(calls)
 
+    @patch('smtp.socket.socket.sendall')
+    @patch('smtp.socket.socket.recv')
+    def test_auth_plain(self, patched_recv, patched_sendall):
+        patched_recv.side_effect = [b'235 ok\r\n']
+        s = smtp.SMTP()
+        s.extensions = {'AUTH': 'LOGIN PLAIN'}
+        s.authorize('login', 'password')
+        s.authorize('login', 'password')
+        patched_sendall.assert_called_once_with(
+            b'auth plain AGxvZ2luAHBhc3N3b3Jk\r\n')
+
     @patch('smtp.socket.socket.sendall')
     @patch('smtp.socket.socket.recv')
     def test_mail_from(self, patched_recv, patched_send):
         s = smtp.SMTP()
         s.sock = Mock(smtp.socket.socket)
-        patched_recv.return_value = b'250-ok\r\n'
+        patched_recv.return_value = b'250 ok\r\n'
         smtp.SMTP().mail_from('someone@gmail.com')
         patched_send.assert_called_with(b'mail from: <someone@gmail.com>\r\n')
 
@@ -121,7 +222,7 @@ class TestSockets(unittest.TestCase):
     def test_mail_from_error(self, patched_recv, patched_send):
         s = smtp.SMTP()
         s.sock = Mock(smtp.socket.socket)
-        patched_recv.return_value = b'334-bad sender\r\n'
+        patched_recv.return_value = b'334 bad sender\r\n'
         with self.assertRaises(smtp.SMTPException):
             smtp.SMTP().mail_from('someone@gmail.com')
             patched_send.assert_called_with(b'mail from: '
@@ -132,7 +233,7 @@ class TestSockets(unittest.TestCase):
     def test_mail_to(self, patched_recv, patched_send):
         s = smtp.SMTP()
         s.sock = Mock(smtp.socket.socket)
-        patched_recv.return_value = b'250-ok\r\n'
+        patched_recv.return_value = b'250 ok\r\n'
         smtp.SMTP().mail_to('someone@gmail.com')
         patched_send.assert_called_with(b'rcpt to: <someone@gmail.com>\r\n')
 
@@ -141,12 +242,209 @@ class TestSockets(unittest.TestCase):
     def test_mail_to_error(self, patched_recv, patched_send):
         s = smtp.SMTP()
         s.sock = Mock(smtp.socket.socket)
-        patched_recv.return_value = b'334-bad sender\r\n'
+        patched_recv.return_value = b'334 bad sender\r\n'
         with self.assertRaises(smtp.SMTPException):
             smtp.SMTP().mail_to('someone@gmail.com')
             patched_send.assert_called_with(b'rcpt to: '
                                             b'<someone@gmail.com>\r\n')
 
+    @patch('smtp.socket.socket.sendall')
+    @patch('smtp.socket.socket.recv')
+    def test_pipelined_envelope(self, patched_recv, patched_send):
+        patched_recv.side_effect = [b'250 ok\r\n250 ok\r\n550 no such user'
+                                    b'\r\n250 ok\r\n354 go ahead\r\n']
+        s = smtp.SMTP()
+        s.extensions = {'PIPELINING': ''}
+        rejected = s.envelope('a@b.c', ['x@b.c', 'y@b.c', 'z@b.c'])
+        self.assertEqual(list(rejected), ['y@b.c'])
+        self.assertEqual(rejected['y@b.c'].code, 550)
+        patched_send.assert_called_once_with(b'mail from: <a@b.c>\r\n'
+                                             b'rcpt to: <x@b.c>\r\n'
+                                             b'rcpt to: <y@b.c>\r\n'
+                                             b'rcpt to: <z@b.c>\r\n'
+                                             b'data\r\n')
+
+    @patch('smtp.socket.socket.sendall')
+    @patch('smtp.socket.socket.recv')
+    def test_pipelined_envelope_all_rejected(self, patched_recv,
+                                             patched_send):
+        patched_recv.side_effect = [b'250 ok\r\n550 no such user\r\n'
+                                    b'354 go ahead\r\n', b'554 no valid '
+                                    b'recipients\r\n']
+        s = smtp.SMTP()
+        s.extensions = {'PIPELINING': ''}
+        with self.assertRaises(smtp.MessageRejected) as error:
+            s.envelope('a@b.c', ['x@b.c'])
+        self.assertEqual(list(error.exception.rejected), ['x@b.c'])
+        patched_send.assert_called_with(b'.\r\n')
+
+    @patch('smtp.socket.socket.sendall')
+    @patch('smtp.socket.socket.recv')
+    def test_sender_rejection_is_not_message_rejection(self, patched_recv,
+                                                       patched_send):
+        patched_recv.side_effect = [b'550 sender blocked\r\n250 ok\r\n'
+                                    b'554 no valid recipients\r\n']
+        s = smtp.SMTP()
+        s.extensions = {'PIPELINING': ''}
+        with self.assertRaises(smtp.SMTPException) as error:
+            s.envelope('a@b.c', ['x@b.c'])
+        self.assertNotIsInstance(error.exception, smtp.MessageRejected)
+        self.assertEqual(error.exception.code, 550)
+
+    @patch('smtp.socket.socket.sendall')
+    @patch('smtp.socket.socket.recv')
+    def test_envelope_without_recipients(self, patched_recv, patched_send):
+        patched_recv.return_value = b'250 ok\r\n'
+        with self.assertRaises(smtp.SMTPException) as error:
+            smtp.SMTP().envelope('a@b.c', [])
+        self.assertEqual(error.exception.message, 'No recipients were given.')
+
+    def test_plain_credentials(self):
+        self.assertEqual(smtp.plain_credentials('user', 'pass', 'ascii'),
+                         b'AHVzZXIAcGFzcw==')
+
+    @patch('smtp.socket.socket.sendall')
+    @patch('smtp.socket.socket.recv')
+    def test_envelope_respects_rcptmax(self, patched_recv, patched_send):
+        patched_recv.side_effect = [b'250 ok\r\n250 ok\r\n250 ok\r\n'
+                                    b'354 go ahead\r\n']
+        s = smtp.SMTP()
+        s.extensions = {'PIPELINING': '', 'LIMITS': 'MAILMAX=5 RCPTMAX=2'}
+        rejected = s.envelope('a@b.c', ['x@b.c', 'y@b.c', 'z@b.c'])
+        self.assertEqual(list(rejected), ['z@b.c'])
+        self.assertEqual(rejected['z@b.c'].code, 452)
+        self.assertNotIn(b'z@b.c', patched_send.call_args[0][0])
+
+    @patch('smtp.socket.socket.sendall')
+    @patch('smtp.socket.socket.recv')
+    def test_envelope_without_pipelining(self, patched_recv, patched_send):
+        patched_recv.side_effect = [b'250 ok\r\n', b'550 no such user\r\n',
+                                    b'250 ok\r\n', b'354 go ahead\r\n']
+        rejected = smtp.SMTP().envelope('a@b.c', ['x@b.c', 'y@b.c'])
+        self.assertEqual(list(rejected), ['x@b.c'])
+        self.assertEqual(patched_send.call_count, 4)
+
+    @patch('smtp.CHUNK_SIZE', 4)
+    def test_send_buffers_over_tls_joins_small_buffers(self):
+        s = smtp.SMTP()
+        s.encrypted = True
+        s.enc_sock = Mock(smtp.socket.socket)
+        s.send_buffers([b'a', b'bc', b'd', b'efghij', b'k'])
+        self.assertEqual(s.enc_sock.sendall.call_args_list,
+                         [call(bytearray(b'abcd')), call(b'efghij'),
+                          call(bytearray(b'k'))])
+
+    @patch('smtp.BDAT_CHUNK_SIZE', 4)
+    @patch('smtp.SMTP.send_buffers')
+    @patch('smtp.socket.socket.recv')
+    def test_bdat(self, patched_recv, patched_send):
+        patched_recv.side_effect = [b'250 ok\r\n', b'250 ok\r\n',
+                                    b'250 ok\r\n']
+        smtp.SMTP().bdat(b'0123456789')
+        calls = [call([b'bdat 4\r\n', b'0123']),
+                 call([b'bdat 4\r\n', b'4567']),
+                 call([b'bdat 2 last\r\n', b'89'])]
+        self.assertEqual(patched_send.call_args_list, calls)
+
+    @patch('smtp.BDAT_CHUNK_SIZE', 4)
+    @patch('smtp.SMTP.send_buffers')
+    @patch('smtp.socket.socket.recv')
+    def test_pipelined_bdat(self, patched_recv, patched_send):
+        patched_recv.side_effect = [b'250 ok\r\n250 ok\r\n250 ok\r\n']
+        s = smtp.SMTP()
+        s.extensions = {'PIPELINING': ''}
+        s.bdat(iter([b'01', b'2345', b'6789']))
+        self.assertEqual(patched_send.call_count, 3)
+        self.assertEqual(patched_recv.call_count, 1)
+
+    @patch('smtp.BDAT_CHUNK_SIZE', 4)
+    @patch('smtp.SMTP.send_buffers')
+    @patch('smtp.socket.socket.recv')
+    def test_pipelined_bdat_error_reads_all_replies(self, patched_recv,
+                                                    patched_send):
+        patched_recv.side_effect = [b'250 ok\r\n554 rejected\r\n'
+                                    b'503 no transaction\r\n'
+                                    b'250 reset\r\n']
+        s = smtp.SMTP()
+        s.extensions = {'PIPELINING': ''}
+        with self.assertRaises(smtp.SMTPException) as error:
+            s.bdat(iter([b'01', b'2345', b'6789']))
+        self.assertEqual(error.exception.code, 554)
+        self.assertEqual(s.reply().code, 250)
+
+    @patch('smtp.SMTP.letter')
+    @patch('smtp.SMTP.bdat')
+    @patch('smtp.SMTP.envelope')
+    def test_send_message_prefers_chunking(self, patched_envelope,
+                                           patched_bdat, patched_letter):
+        patched_envelope.return_value = {}
+        s = smtp.SMTP()
+        s.extensions = {'CHUNKING': ''}
+        s.send_message('a@b.c', ['x@b.c'], 'text')
+        patched_envelope.assert_called_with('a@b.c', ['x@b.c'], data=False,
+                                            size=4)
+        patched_bdat.assert_called_once_with('text')
+        s.extensions = {}
+        s.send_message('a@b.c', ['x@b.c'], 'text')
+        patched_envelope.assert_called_with('a@b.c', ['x@b.c'], data=True,
+                                            size=4)
+        patched_letter.assert_called_once_with('text')
+
+    @patch('smtp.socket.socket.sendmsg', create=True)
+    def test_send_buffers(self, patched_sendmsg):
+        sent = []
+
+        def sendmsg(views):
+            data = b''.join(bytes(v) for v in views)[:3]
+            sent.append(data)
+            return len(data)
+
+        patched_sendmsg.side_effect = sendmsg
+        smtp.SMTP().send_buffers([b'ab', b'', b'cde', b'fgh'])
+        self.assertEqual(b''.join(sent), b'abcdefgh')
+
+    @patch('smtp.socket.socket.recv')
+    @patch('smtp.socket.socket.sendmsg')
+    def test_letter_is_terminated_once(self, patched_sendmsg, patched_recv):
+        sent = []
+
+        def sendmsg(views):
+            sent.append(b''.join(bytes(v) for v in views))
+            return len(sent[-1])
+
+        patched_sendmsg.side_effect = sendmsg
+        patched_recv.return_value = b'250 ok\r\n'
+        smtp.SMTP().letter(iter([b'Hi\n', b'.hidden\r\n']))
+        self.assertEqual(b''.join(sent), b'Hi\r\n..hidden\r\n.\r\n')
+
+
+class TestNormalized(unittest.TestCase):
+    def normalize(self, chunks, terminate=True):
+        return b''.join(smtp.normalized(chunks, terminate))
+
+    def test_clean_chunks_are_not_copied(self):
+        chunk = memoryview(b'line one\r\nline two\r\n')
+        result = list(smtp.normalized([chunk]))
+        self.assertIs(result[0], chunk)
+        self.assertEqual(result[1:], [b'.\r\n'])
+
+    def test_line_endings(self):
+        self.assertEqual(self.normalize([b'a\nb\rc\r\nd']),
+                         b'a\r\nb\r\nc\r\nd\r\n.\r\n')
+
+    def test_crlf_split_between_chunks(self):
+        self.assertEqual(self.normalize([b'a\r', b'\nb\r', b'\r\n']),
+                         b'a\r\nb\r\n\r\n.\r\n')
+        self.assertEqual(self.normalize([b'a\r']), b'a\r\n.\r\n')
+
+    def test_dot_stuffing(self):
+        self.assertEqual(self.normalize([b'.a\n.', b'b\r\n', b'.\r\n']),
+                         b'..a\r\n..b\r\n..\r\n.\r\n')
+
+    def test_without_terminator(self):
+        self.assertEqual(self.normalize([b'.a\nb'], terminate=False),
+                         b'.a\r\nb')
+
 
 if __name__ == '__main__':
     unittest.main()
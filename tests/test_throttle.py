@@ -0,0 +1,89 @@
+import json
+import os
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.path.pardir))
+
+import throttle
+from smtp import SMTPException
+
+
+class TestTokenBucket(unittest.TestCase):
+    def test_unlimited(self):
+        bucket = throttle.TokenBucket()
+        started = time.monotonic()
+        for _ in range(1000):
+            bucket.acquire()
+        self.assertLess(time.monotonic() - started, 0.5)
+
+    def test_limits_rate(self):
+        bucket = throttle.TokenBucket(rate=50, burst=1)
+        started = time.monotonic()
+        for _ in range(6):
+            bucket.acquire()
+        self.assertGreaterEqual(time.monotonic() - started, 0.09)
+
+
+class TestThrottle(unittest.TestCase):
+    def test_decreases_on_throttling(self):
+        t = throttle.Throttle(rate=10)
+        t.failure(SMTPException(b'421 slow down\r\n', 421))
+        self.assertEqual(t.messages.rate, 5)
+        t.failure(SMTPException(b'550 no such user\r\n', 550))
+        self.assertEqual(t.messages.rate, 5)
+
+    def test_increases_after_success(self):
+        t = throttle.Throttle(rate=10, increase=1)
+        t.failure(SMTPException(b'451 try later\r\n', 451))
+        t.success()
+        t.success()
+        self.assertEqual(t.messages.rate, 7)
+        for _ in range(10):
+            t.success()
+        self.assertEqual(t.messages.rate, 10)
+
+    def test_decreases_on_partly_throttled_recipients(self):
+        t = throttle.Throttle(rate=10)
+        t.success(rejected={'a@b.c': SMTPException(b'550 no user\r\n',
+                                                   550)})
+        self.assertEqual(t.messages.rate, 10)
+        t.success(rejected={'b@b.c': SMTPException(b'450 slow down\r\n',
+                                                   450)})
+        self.assertEqual(t.messages.rate, 5)
+
+    def test_backoff_grows(self):
+        t = throttle.Throttle(base_delay=1, max_delay=8)
+        delays = [t.failure(SMTPException('closed')) for _ in range(6)]
+        self.assertLessEqual(delays[0], 1)
+        self.assertGreaterEqual(delays[3], 4)
+        self.assertLessEqual(max(delays), 8)
+        t.success()
+        self.assertLessEqual(t.failure(SMTPException('closed')), 1)
+
+    def test_slows_down_on_latency(self):
+        t = throttle.Throttle(rate=10, target_latency=1)
+        t.success(latency=2)
+        self.assertAlmostEqual(t.messages.rate, 9)
+
+
+class TestThrottles(unittest.TestCase):
+    def test_per_host_settings(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.json',
+                                         delete=False) as f:
+            f.write(json.dumps({'slow.example.com': {'rate': 2}}))
+        try:
+            throttles = throttle.Throttles(rate=20, config=f.name)
+        finally:
+            os.remove(f.name)
+        self.assertEqual(throttles.get('slow.example.com').max_rate, 2)
+        self.assertEqual(throttles.get('fast.example.com').max_rate, 20)
+        self.assertIs(throttles.get('fast.example.com'),
+                      throttles.get('fast.example.com'))
+
+
+if __name__ == '__main__':
+    unittest.main()
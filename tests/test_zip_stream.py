@@ -0,0 +1,94 @@
+import io
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import zipfile
+from argparse import Namespace
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.path.pardir))
+
+from simple import zip_attachments
+from zip_stream import ZipStream
+
+
+class TestZipStream(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.files = {'text.txt': b'hello world\n' * 10000,
+                      'photo.jpg': os.urandom(5000),
+                      'random.bin': os.urandom(3000),
+                      'empty.txt': b''}
+        self.paths = []
+        for name, data in self.files.items():
+            path = os.path.join(self.dir, name)
+            with open(path, 'wb') as f:
+                f.write(data)
+            self.paths.append(path)
+
+    def test_archive_is_valid(self):
+        data = ZipStream(self.paths, workers=2).read()
+        with zipfile.ZipFile(io.BytesIO(data)) as archive:
+            self.assertIsNone(archive.testzip())
+            for name, content in self.files.items():
+                self.assertEqual(archive.read(name), content)
+            methods = {i.filename: i.compress_type
+                       for i in archive.infolist()}
+        self.assertEqual(methods['text.txt'], zipfile.ZIP_DEFLATED)
+        self.assertEqual(methods['photo.jpg'], zipfile.ZIP_STORED)
+        self.assertEqual(methods['random.bin'], zipfile.ZIP_STORED)
+
+    def test_utf8_names(self):
+        path = os.path.join(self.dir, 'отчёт.txt')
+        with open(path, 'wb') as f:
+            f.write(b'report')
+        data = ZipStream([path, self.paths[0]]).read()
+        with zipfile.ZipFile(io.BytesIO(data)) as archive:
+            self.assertEqual(archive.read('отчёт.txt'), b'report')
+            flags = [i.flag_bits & 0x800 for i in archive.infolist()]
+        self.assertEqual(flags, [0x800, 0])
+
+    def test_same_names_stay_distinct(self):
+        paths = []
+        for directory, data in (('a', b'first'), ('b', b'second'),
+                                ('c', b'third')):
+            os.mkdir(os.path.join(self.dir, directory))
+            paths.append(os.path.join(self.dir, directory, 'report.txt'))
+            with open(paths[-1], 'wb') as f:
+                f.write(data)
+        with zipfile.ZipFile(io.BytesIO(ZipStream(paths).read())) as archive:
+            self.assertEqual(archive.namelist(), ['report.txt',
+                                                  'report (1).txt',
+                                                  'report (2).txt'])
+            self.assertEqual(archive.read('report (1).txt'), b'second')
+
+    def test_size_and_rewind(self):
+        stream = ZipStream(self.paths)
+        size = stream.seek(0, io.SEEK_END)
+        stream.seek(0)
+        first = b''.join(iter(lambda: stream.read(1000), b''))
+        stream.seek(0)
+        self.assertEqual(stream.read(), first)
+        self.assertEqual(len(first), size)
+
+    def test_zip_attachments_keeps_cwd_clean(self):
+        cwd = os.getcwd()
+        os.chdir(self.dir)
+        try:
+            args = Namespace(attachments=[(open(p, 'rb'), None)
+                                          for p in self.paths],
+                             max_file_size=0)
+            self.assertIsNone(zip_attachments(args))
+            self.assertIsInstance(args.attachments[0][0], ZipStream)
+            self.assertEqual(sorted(os.listdir('.')), sorted(self.files))
+        finally:
+            os.chdir(cwd)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
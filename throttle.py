@@ -0,0 +1,157 @@
+from argparse import Namespace
+import json
+import random
+import threading
+import time
+
+THROTTLE_CODES = (421, 450, 451)
+
+
+class TokenBucket:
+    """Ограничиваем число событий в секунду; rate = 0 — без ограничений."""
+    def __init__(self, rate: float = 0, burst: float = None) -> None:
+        self.lock = threading.Lock()
+        self.rate = rate
+        self.burst = burst
+        self.tokens = self.capacity()
+        self.updated = time.monotonic()
+
+    def capacity(self) -> float:
+        return self.burst if self.burst else max(self.rate, 1)
+
+    def set_rate(self, rate: float) -> None:
+        with self.lock:
+            self.refill()
+            self.rate = rate
+            self.tokens = min(self.tokens, self.capacity())
+
+    def refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity(),
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, count: float = 1) -> None:
+        """Ждём, пока в ведре наберётся нужное число жетонов."""
+        while True:
+            with self.lock:
+                if self.rate <= 0:
+                    return
+                self.refill()
+                needed = min(count, self.capacity())
+                if self.tokens >= needed:
+                    self.tokens -= count
+                    return
+                delay = (needed - self.tokens) / self.rate
+            time.sleep(delay)
+
+
+class Throttle:
+    """
+    Скорость отправки на один сервер. Растёт понемногу после успешных
+    писем и резко падает после ответов 421/450/451 или при росте задержки
+    сверх target_latency (AIMD). После ошибок выдерживаем паузу, которая
+    экспоненциально растёт с каждой ошибкой подряд.
+    """
+    def __init__(self, rate: float = 0, recipient_rate: float = 0,
+                 min_rate: float = 0.1, increase: float = 0.1,
+                 decrease: float = 0.5, target_latency: float = 0,
+                 base_delay: float = 1, max_delay: float = 300) -> None:
+        self.max_rate = rate
+        self.max_recipient_rate = recipient_rate
+        self.min_rate = min_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.target_latency = target_latency
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+        self.messages = TokenBucket(rate)
+        self.recipients = TokenBucket(recipient_rate)
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.observed_rate = 0
+        self.last_success = None
+
+    def wait(self, recipients: int = 1) -> None:
+        """Ждём разрешения отправить письмо указанному числу получателей."""
+        self.messages.acquire(1)
+        self.recipients.acquire(recipients)
+
+    def success(self, latency: float = 0, rejected: dict = None) -> None:
+        """
+        Учитываем отправленное письмо. Если сервер отложил часть
+        получателей (rejected) кодами 421/450/451, скорость снижаем.
+        """
+        throttled = any(getattr(error, 'code', None) in THROTTLE_CODES
+                        for error in (rejected or {}).values())
+        with self.lock:
+            self.failures = 0
+            now = time.monotonic()
+            if self.last_success is not None and now > self.last_success:
+                rate = 1 / (now - self.last_success)
+                self.observed_rate = rate if not self.observed_rate else \
+                    0.8 * self.observed_rate + 0.2 * rate
+            self.last_success = now
+
+            if throttled:
+                self.scale(self.decrease)
+            elif self.target_latency and latency > self.target_latency:
+                self.scale(0.9)
+            elif self.messages.rate:
+                rate = self.messages.rate + self.increase
+                if self.max_rate:
+                    rate = min(rate, self.max_rate)
+                self.messages.set_rate(rate)
+                self.scale_recipients()
+
+    def failure(self, error: Exception) -> float:
+        """Учитываем ошибку и возвращаем паузу перед следующей попыткой."""
+        with self.lock:
+            self.failures += 1
+            if getattr(error, 'code', None) in THROTTLE_CODES:
+                self.scale(self.decrease)
+            delay = min(self.max_delay,
+                        self.base_delay * 2 ** (self.failures - 1))
+            return delay * random.uniform(0.5, 1)
+
+    def scale(self, factor: float) -> None:
+        rate = self.messages.rate or self.observed_rate or 1
+        self.messages.set_rate(max(rate * factor, self.min_rate))
+        self.scale_recipients()
+
+    def scale_recipients(self) -> None:
+        if self.max_recipient_rate and self.max_rate:
+            self.recipients.set_rate(max(
+                self.max_recipient_rate * self.messages.rate / self.max_rate,
+                self.min_rate))
+
+
+class Throttles:
+    """
+    Ограничители скорости по серверам. Настройки для конкретных серверов
+    читаются из JSON-файла вида {"smtp.example.com": {"rate": 5}}.
+    """
+    def __init__(self, rate: float = 0, recipient_rate: float = 0,
+                 config: str = None) -> None:
+        self.defaults = {'rate': rate, 'recipient_rate': recipient_rate}
+        self.settings = {}
+        self.throttles = {}
+        self.lock = threading.Lock()
+        if config is not None:
+            with open(config, 'r') as f:
+                self.settings = json.loads(f.read())
+
+    @classmethod
+    def from_args(cls, args: Namespace) -> 'Throttles':
+        return cls(getattr(args, 'rate', 0),
+                   getattr(args, 'recipient_rate', 0),
+                   getattr(args, 'throttle_config', None))
+
+    def get(self, host: str) -> Throttle:
+        with self.lock:
+            if host not in self.throttles:
+                settings = dict(self.defaults)
+                settings.update(self.settings.get(host, {}))
+                self.throttles[host] = Throttle(**settings)
+            return self.throttles[host]
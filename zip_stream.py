@@ -0,0 +1,218 @@
+from concurrent.futures import ThreadPoolExecutor
+from mimetypes import guess_type
+import io
+import os
+import struct
+import time
+import zlib
+
+READ_BLOCK = 1048576
+ZIP_LIMIT = 0xFFFFFFFF
+
+COMPRESSED_TYPES = {'application/zip', 'application/gzip',
+                    'application/x-gzip', 'application/x-bzip2',
+                    'application/x-xz', 'application/x-7z-compressed',
+                    'application/x-rar-compressed', 'application/pdf',
+                    'application/java-archive', 'application/epub+zip',
+                    'image/jpeg', 'image/png', 'image/gif', 'image/webp'}
+
+
+def already_compressed(name: str) -> bool:
+    """Проверяем по MIME-типу, что сжимать файл повторно бесполезно."""
+    mime = guess_type(name)[0] or ''
+    return mime in COMPRESSED_TYPES or \
+        mime.startswith(('video/', 'audio/',
+                         'application/vnd.openxmlformats',
+                         'application/vnd.oasis.opendocument'))
+
+
+def dos_time(mtime: float) -> tuple:
+    t = time.localtime(mtime)
+    if t.tm_year < 1980:
+        return 0, (1 << 5) | 1
+    return (t.tm_hour << 11 | t.tm_min << 5 | t.tm_sec // 2,
+            (t.tm_year - 1980) << 9 | t.tm_mon << 5 | t.tm_mday)
+
+
+def unique_names(paths: list) -> list:
+    """
+    Имена файлов в архиве. Одинаковые имена файлов из разных каталогов
+    дополняем номером: report.txt, report (1).txt. Регистр не учитываем,
+    чтобы файлы не перезаписали друг друга и при распаковке в Windows.
+    """
+    names, used = [], set()
+    for path in paths:
+        name = os.path.basename(path)
+        stem, ext = os.path.splitext(name)
+        number = 0
+        while name.lower() in used:
+            number += 1
+            name = '{} ({}){}'.format(stem, number, ext)
+        used.add(name.lower())
+        names.append(name)
+    return names
+
+
+class Member:
+    """Файл архива: контрольная сумма, размеры и, если сжат, данные."""
+    def __init__(self, path: str, name: str = None) -> None:
+        self.path = path
+        self.name = (name or os.path.basename(path)).encode('utf-8')
+        stat = os.stat(path)
+        self.time, self.date = dos_time(stat.st_mtime)
+        self.mode = stat.st_mode
+        self.crc = 0
+        self.size = 0
+        self.data = None
+        self.compressed_size = 0
+
+    @property
+    def method(self) -> int:
+        return 0 if self.data is None else zlib.DEFLATED
+
+    @property
+    def flags(self) -> int:
+        return 0x800 if any(byte > 0x7F for byte in self.name) else 0
+
+    def compress(self) -> 'Member':
+        """
+        Считаем CRC и сжимаем файл. Уже сжатые форматы и файлы, которые
+        от сжатия не уменьшились, сохраняются как есть и при выдаче
+        архива читаются с диска.
+        """
+        store = already_compressed(self.path)
+        compressor = None if store else \
+            zlib.compressobj(6, zlib.DEFLATED, -15)
+        chunks = []
+        with open(self.path, 'rb') as f:
+            while True:
+                block = f.read(READ_BLOCK)
+                if not block:
+                    break
+                self.crc = zlib.crc32(block, self.crc)
+                self.size += len(block)
+                if compressor is not None:
+                    chunks.append(compressor.compress(block))
+        if compressor is not None:
+            chunks.append(compressor.flush())
+            compressed_size = sum(len(chunk) for chunk in chunks)
+            if compressed_size < self.size:
+                self.data = chunks
+                self.compressed_size = compressed_size
+        if self.data is None:
+            self.compressed_size = self.size
+        if self.compressed_size > ZIP_LIMIT:
+            raise ValueError('File {} is too large for a zip archive '
+                             'without ZIP64.'.format(self.path))
+        return self
+
+    def local_header(self) -> bytes:
+        return struct.pack('<IHHHHHIIIHH', 0x04034b50, 20, self.flags,
+                           self.method, self.time, self.date, self.crc,
+                           self.compressed_size, self.size,
+                           len(self.name), 0) + self.name
+
+    def central_header(self, offset: int) -> bytes:
+        return struct.pack('<IHHHHHHIIIHHHHHII', 0x02014b50, 20, 20,
+                           self.flags, self.method, self.time, self.date,
+                           self.crc, self.compressed_size, self.size,
+                           len(self.name), 0, 0, 0, 0,
+                           (self.mode & 0xFFFF) << 16, offset) + self.name
+
+    def blocks(self):
+        yield self.local_header()
+        if self.data is not None:
+            yield from self.data
+            return
+        with open(self.path, 'rb') as f:
+            while True:
+                block = f.read(READ_BLOCK)
+                if not block:
+                    return
+                yield block
+
+
+class ZipStream:
+    """
+    Zip-архив из нескольких файлов, который читается как файл, но нигде
+    не сохраняется. Файлы сжимаются параллельно в пуле потоков (zlib
+    отпускает GIL), а архив выдаётся по мере готовности его частей.
+    """
+    name = 'attachments.zip'
+
+    def __init__(self, paths: list, workers: int = None) -> None:
+        self.paths = list(paths)
+        self.names = unique_names(self.paths)
+        self.workers = workers or os.cpu_count() or 1
+        self.members = None
+        self.blocks = None
+        self.buffer = bytearray()
+        self.closed = False
+
+    def iter_members(self):
+        """Выдаём сжатые файлы по порядку, сжимая их один раз."""
+        if self.members is not None:
+            yield from self.members
+            return
+
+        members = []
+        with ThreadPoolExecutor(self.workers) as executor:
+            for member in executor.map(Member.compress,
+                                       map(Member, self.paths, self.names)):
+                members.append(member)
+                yield member
+        self.members = members
+
+    def iter_blocks(self):
+        offset = 0
+        directory = []
+        for member in self.iter_members():
+            directory.append(member.central_header(offset))
+            yield from member.blocks()
+            offset += len(member.local_header()) + member.compressed_size
+        directory = b''.join(directory)
+        if offset > ZIP_LIMIT or len(self.paths) > 0xFFFF:
+            raise ValueError('Attachments are too large for a zip archive '
+                             'without ZIP64.')
+        yield directory
+        yield struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, len(self.paths),
+                          len(self.paths), len(directory), offset, 0)
+
+    def size(self) -> int:
+        """Размер архива; для этого все файлы сжимаются заранее."""
+        if self.members is None:
+            for _ in self.iter_members():
+                pass
+        return sum(30 + 46 + 2 * len(member.name) + member.compressed_size
+                   for member in self.members) + 22
+
+    def read(self, size: int = -1) -> bytes:
+        if self.blocks is None:
+            self.blocks = self.iter_blocks()
+        while size < 0 or len(self.buffer) < size:
+            block = next(self.blocks, None)
+            if block is None:
+                break
+            self.buffer += block
+        if size < 0:
+            size = len(self.buffer)
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        """Поддерживаем только возврат в начало и переход в конец архива."""
+        self.buffer.clear()
+        if whence == io.SEEK_END and offset == 0:
+            self.blocks = iter(())
+            return self.size()
+        if whence == io.SEEK_SET and offset == 0:
+            self.blocks = None
+            return 0
+        raise io.UnsupportedOperation('ZipStream can only seek to its start '
+                                      'or end.')
+
+    def close(self) -> None:
+        self.blocks = None
+        self.buffer.clear()
+        self.closed = True